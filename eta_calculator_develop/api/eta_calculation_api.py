@@ -1,25 +1,54 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from utils.tomtom_recalculation import TomTomRecalculation
 from utils.tomtom_service import TomTom
+from utils.eta_history import eta_history
+from utils.eta_extrapolation import eta_extrapolator
+from utils.http_client import request_source, tomtom_client
+from utils.routing_cache import routing_cache
+from utils.route_cache import route_cache
+from utils.route_update_queue import RouteUpdateQueue
+from utils.recalculation_worker import RecalculationWorker
+from utils.route_optimizer import RouteOptimizer
+from utils.traffic_refresh import TRAFFIC_SOURCE, TrafficRefresher
+from utils.travel_matrix import route_points, travel_matrices
+from utils.zip_delay import zip_delays
 from model.delivery import Delivery
-from fastapi import FastAPI, APIRouter, status, UploadFile, HTTPException
-from utils.preprocess_service import PreProcess
+from fastapi import FastAPI, APIRouter, Query, status, UploadFile, HTTPException
+from utils.preprocess_service import CsvLimitError, CsvValidationError, PreProcess
 from utils.postprocess_service import PostProcess
 from model.travel_data import TravelData
-from controller.db.eta_calculator_db import EtaDb
-from model.device_message import DeliveryMessage
-from model.response import Response
+from controller.db.eta_calculator_db import EtaDb, RouteVersionConflict
+from controller.db.route_document import ROUTE_FIELDS, SCHEMA_VERSION, RouteDocument
+from model.device_message import BulkDeliveryReport, DeliveryMessage, DeliveryUpdateResult
+from model.response import RecalculationStatus, Response
+from model.upload import BatchUploadReport, RouteUploadResult
 
 from loguru import logger
+import asyncio
+import csv
+import io
 import json
 import os
+import re
+import time
+import zipfile
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from fastapi.responses import StreamingResponse
 from controller.db.db_setting import ROUTE_DBDependency
+from utils.geocoding_cache import geocoding_cache
+from utils.geocoding_service import GeocodingError, geocoder
 import datetime
 
 eta_api_router = APIRouter(tags=["Eta-Calculator"])
 
+BATCH_MAX_PARALLEL_ROUTES = int(os.environ.get('BATCH_MAX_PARALLEL_ROUTES', 8))
+ROUTE_FILE_NAME = re.compile(r'^\d{4}_\d{2}_\d{2}_.+\.csv$')
+ROUTE_UPDATE_MAX_ATTEMPTS = int(os.environ.get('ROUTE_UPDATE_MAX_ATTEMPTS', 3))
+BULK_UPDATE_MAX_ITEMS = int(os.environ.get('BULK_UPDATE_MAX_ITEMS', 1000))
+ROUTE_LIST_BATCH_SIZE = int(os.environ.get('ROUTE_LIST_BATCH_SIZE', 50))
+ROUTE_LIST_CSV_HEADER = ["ginc", "id", "indirizzo", "città", "provincia", "numero civico", "cap", "telefono", "orario",
+                         "consegnato", "orario consegna"]
+
 app = FastAPI()
 
 
@@ -44,10 +73,137 @@ async def create_upload_file(file: UploadFile,
     Raises:
         HTTPException:
             - 409 Conflict: If a route with the same unique identifier (trace ID) already exists in the database.
+            - 413 Request Entity Too Large: If the file exceeds the configured size or number of rows.
+            - 422 Unprocessable Entity: If some rows of the file are not valid or some addresses cannot be geocoded.
             - 500 Internal Server Error: If there is an error saving the route in the database.
     """
 
-    delivery_list, date, trace_id = await PreProcess.digest_csv(file)
+    travel_data = await process_route_file(file, route_db)
+
+    csv_file = PostProcess.generate_csv(travel_data)
+    response = StreamingResponse(
+        csv_file,
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=route.csv"}
+    )
+    return response
+
+
+@eta_api_router.post("/upload_route_files/")
+async def create_upload_files(files: List[UploadFile],
+                              route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> StreamingResponse:
+    """
+    Handles the upload of many route CSV files at once, either as separate files or inside zip archives,
+    and processes the routes concurrently.
+
+    Steps:
+    1. **Collect the routes**: Every CSV file, and every CSV file found inside a zip archive, is a route. Its name must
+       follow the yyyy_mm_dd_idNumber format.
+    2. **Process the routes**: The routes are processed concurrently, as in /upload_route_file/, sharing the geocoder
+       and TomTom quotas. At most BATCH_MAX_PARALLEL_ROUTES routes are processed at the same time.
+    3. **Aggregate the results**: A failure in one route does not stop the others.
+
+    Returns:
+        StreamingResponse: A zip archive containing report.json, with the outcome of every route,
+        and the CSV file of every route successfully processed, named after its ginc.
+
+    Raises:
+        HTTPException:
+            - 400 Bad Request: If an uploaded archive is not a valid zip file.
+    """
+
+    started = time.monotonic()
+    route_files = []
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(file.file)
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f"{file.filename} is not a valid zip archive.")
+            route_files.extend(ArchiveMember(archive, info) for info in archive.infolist()
+                               if not info.is_dir() and info.filename.lower().endswith('.csv'))
+        else:
+            route_files.append(file)
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_PARALLEL_ROUTES)
+    seen_ginc = set()
+
+    async def process(route_file) -> Tuple[RouteUploadResult, Optional[TravelData]]:
+        file_name = os.path.basename(route_file.filename)
+        if not ROUTE_FILE_NAME.match(file_name):
+            return RouteUploadResult(file_name=file_name, status_code=status.HTTP_400_BAD_REQUEST,
+                                     detail="the file name must follow the yyyy_mm_dd_idNumber.csv format"), None
+        ginc = file_name[11:-4]
+        if ginc in seen_ginc:
+            return RouteUploadResult(file_name=file_name, ginc=ginc, status_code=status.HTTP_409_CONFLICT,
+                                     detail="the same ginc appears more than once in the batch"), None
+        seen_ginc.add(ginc)
+
+        async with semaphore:
+            try:
+                travel_data = await process_route_file(route_file, route_db)
+            except HTTPException as ex:
+                return RouteUploadResult(file_name=file_name, ginc=ginc, status_code=ex.status_code,
+                                         detail=ex.detail), None
+            except Exception as ex:
+                logger.error(f"error processing {file_name}: {ex}")
+                return RouteUploadResult(file_name=file_name, ginc=ginc,
+                                         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(ex)), None
+
+        return RouteUploadResult(file_name=file_name, ginc=ginc, status_code=status.HTTP_201_CREATED,
+                                 stops=len(travel_data.stops)), travel_data
+
+    results = await asyncio.gather(*[process(route_file) for route_file in route_files])
+
+    report = BatchUploadReport(
+        routes=[result for result, _ in results],
+        created=sum(1 for _, travel_data in results if travel_data is not None),
+        failed=sum(1 for _, travel_data in results if travel_data is None),
+        elapsed_seconds=round(time.monotonic() - started, 3))
+    logger.info(f"batch upload: {report.created} routes created, {report.failed} failed "
+                f"in {report.elapsed_seconds}s")
+
+    archive_file = io.BytesIO()
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('report.json', report.model_dump_json(indent=2))
+        for result, travel_data in results:
+            if travel_data is not None:
+                archive.writestr(f"{result.ginc}.csv", PostProcess.generate_csv(travel_data).getvalue())
+    archive_file.seek(0)
+
+    return StreamingResponse(
+        archive_file,
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=routes.zip"}
+    )
+
+
+async def process_route_file(file, route_db: AsyncIOMotorDatabase) -> TravelData:
+    """
+    Runs the whole upload pipeline on a single route file: CSV parsing, geocoding, TomTom optimization,
+    address association, ZIP code delays and storage.
+
+    Args:
+        file: The CSV file of the route, exposing `filename` and an asynchronous `read(size)`.
+        route_db (AsyncIOMotorDatabase): The database connection instance.
+
+    Returns:
+        TravelData: The route stored in the database.
+
+    Raises:
+        HTTPException: With the status codes documented in /upload_route_file/.
+    """
+
+    try:
+        delivery_list, date, trace_id = await PreProcess.digest_csv(file)
+    except CsvValidationError as ex:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail={'message': str(ex),
+                                    'errors': [error.model_dump() for error in ex.errors]})
+    except CsvLimitError as ex:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=str(ex))
     logger.info(f'il trace_id è {trace_id}')
 
     route = await EtaDb.get_route_object(route_db, trace_id)
@@ -55,33 +211,32 @@ async def create_upload_file(file: UploadFile,
     if route or route is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail=f"route with the same ginc is alredy registered in db.")
-    coordinates, raw_travel_data = PreProcess.populate_travel_data(
-        delivery_list)
-    ordered_travel_data = TomTom.order_travel_data(
-        coordinates)
+    try:
+        coordinates, raw_travel_data = await PreProcess.populate_travel_data(
+            delivery_list)
+    except GeocodingError as ex:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail={'message': str(ex),
+                                    'failures': [failure.model_dump() for failure in ex.report.failures]})
+    waypoint_order = await RouteOptimizer.upload_waypoint_order(coordinates)
+    ordered_travel_data = await TomTom.order_travel_data(
+        coordinates, waypoint_order=waypoint_order)
     complete_travel_data = PostProcess.associate_address(
         raw_travel_data, ordered_travel_data)
 
-    with open("./eta_to_notification_develop/zip_code.json") as cap_file:
-        cap_delays = json.load(cap_file)
-        # logger.info(cap_delays)
-
     delay_travel_data = PostProcess.update_eta(
-        complete_travel_data, cap_delays, default_delay=int(os.getenv('DEFAULT_DELAY', 100)))
+        complete_travel_data, zip_delays.delays, default_delay=zip_delays.default_delay)
     delay_travel_data.ginc = trace_id
+    delay_travel_data.recalculated_at = delay_travel_data.routed_at = datetime.datetime.now(datetime.timezone.utc)
     # logger.info(delay_travel_data)
 
     save_response = await EtaDb.add_new_object(route_db, delay_travel_data)
 
     if save_response:
         logger.info("trace saved in db")
-        csv_file = PostProcess.generate_csv(delay_travel_data)
-        response = StreamingResponse(
-            csv_file,
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename=route.csv"}
-        )
-        return response
+        eta_history.record(delay_travel_data, 'upload')
+        travel_matrices.schedule(route_db, delay_travel_data)
+        return delay_travel_data
     else:
         logger.info("error in store trace inside db")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -113,6 +268,81 @@ async def get_route_object_by_ginc(ginc: str,
                             detail=f"route information not found.")
 
 
+@eta_api_router.get("/routes_by_date/")
+async def get_routes_by_date(personal_id: str,
+                             format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                             fields: Optional[str] = None,
+                             batch_size: int = Query(ROUTE_LIST_BATCH_SIZE, ge=1, le=1000),
+                             route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> StreamingResponse:
+    """
+    Streams every route of a day, ordered by ginc, while it is read from the database.
+
+    Args:
+        personal_id (str): The day of the routes.
+        format (str): ndjson, one route per line, or csv, one row per shipment with its ETA and delivery status.
+        fields (Optional[str]): Only for ndjson, the comma-separated TravelData fields to be returned
+            (personal_id, ginc, version, summary, stops, delivered_stops); all of them by default.
+        batch_size (int): The number of routes fetched from the database at a time.
+
+    Returns:
+        StreamingResponse: The routes of the day; the whole day is never held in memory.
+
+    Raises:
+        HTTPException: If an unknown field is requested (422).
+    """
+
+    if format == "csv":
+        projection = RouteDocument.projection([field for field in ROUTE_FIELDS if field != 'version'])
+        cursor = EtaDb.stream_routes_by_date(route_db, personal_id, projection, batch_size)
+        return StreamingResponse(route_csv_lines(cursor), media_type="text/csv",
+                                 headers={"Content-Disposition": f"attachment; filename={personal_id}.csv"})
+
+    selected_fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else list(ROUTE_FIELDS)
+    unknown_fields = [field for field in selected_fields if field not in ROUTE_FIELDS]
+    if unknown_fields:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"unknown fields {unknown_fields}, the fields are {list(ROUTE_FIELDS)}")
+
+    cursor = EtaDb.stream_routes_by_date(route_db, personal_id, RouteDocument.projection(selected_fields), batch_size)
+
+    async def lines():
+        async for document in cursor:
+            yield json.dumps(RouteDocument.decode_fields(document, selected_fields)) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def route_csv_lines(cursor):
+    """
+    Converts the routes read from `cursor` into CSV lines, one per shipment, route by route.
+    """
+    line = io.StringIO()
+    csv_writer = csv.writer(line)
+
+    def row(values) -> str:
+        line.seek(0)
+        line.truncate()
+        csv_writer.writerow(values)
+        return line.getvalue()
+
+    yield row(ROUTE_LIST_CSV_HEADER)
+    async for document in cursor:
+        travel_data = TravelData.parse_mongo(document)
+        yield "".join(row([
+            travel_data.ginc,
+            delivery.gsin,
+            delivery.address.address,
+            delivery.address.city,
+            delivery.address.district,
+            delivery.address.house_number,
+            delivery.address.zip_code,
+            delivery.address.telephone_number,
+            delivery.eta.isoformat(),
+            delivery.delivered,
+            delivery.delivered_at.isoformat() if delivery.delivered_at else ""
+        ]) for delivery in PostProcess.process_stops(travel_data))
+
+
 @eta_api_router.post("/route_delete/", status_code=status.HTTP_200_OK)
 async def delete_trace(ginc: str,
                        route_db: AsyncIOMotorDatabase = ROUTE_DBDependency):
@@ -144,55 +374,436 @@ async def delete_trace(ginc: str,
 async def route_update(update: DeliveryMessage,
                        route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> Response:
     """
-    Update the delivery status of a specific order and recalculate route details.
+    Record the delivery of a specific order and schedule the recalculation of the route details.
 
     Steps:
-    1. Mark the specified delivery as delivered (delivered=true).
-    2. Stores the route marked as delivered=true inside the list travel_data.delivered _tops
-    3. Recalculate the route using TomTom's services(it doesn't calculate the optimal delivery sequence).
-    4. Adjust ETA based on ZIP code delays.
-    5. Send SMS notifications for both the completed delivery and the next scheduled delivery.
-    6. Save the updated route in the database.
+    1. Mark the specified delivery as delivered (delivered=true) with a single atomic database write,
+       which also marks the recalculation of the route as pending.
+    2. Request the recalculation to the background worker and return the route right away. The worker stores
+       the delivered stops inside the list travel_data.delivered_stops, recalculates the route using TomTom's
+       services (it doesn't calculate the optimal delivery sequence) and adjusts the ETAs based on ZIP code delays
+       (see `recalculate_route`); its progress can be read from /route_status/.
+
+    The routes still stored in the original document format are updated and recalculated synchronously,
+    as the confirmations of a bulk update are (see `apply_route_updates`).
 
     Args:
         update (DeliveryMessage): The delivery update information (ginc, gsin and delivery_time).
 
     Returns:
-        Response: The updated route response.
+        Response: The route with the delivery recorded and the ETAs of the last recalculation.
 
     Raises:
-        HTTPException: If the route is not found (404) or if an error occurs during saving (500).
+        HTTPException: If the route is not found (404), if it keeps changing concurrently (409)
+            or if an error occurs during saving (500).
     """
 
+    travel_data = await EtaDb.mark_delivered(route_db, update.ginc, update.gsin, update.delivery_time)
+    if travel_data is not None:
+        recalculation_worker.request(route_db, update.ginc)
+        return PostProcess.create_response(travel_data)
+
+    # nothing was written: the route is unknown, in the original format, or the shipment is not to be delivered
     list_travel_data = await EtaDb.get_route_object(route_db, update.ginc)
-    old_travel_data = list_travel_data[0]
+    if not list_travel_data:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"route information not found.")
+    travel_data = list_travel_data[0]
+    if travel_data.schema_version != SCHEMA_VERSION:
+        travel_data = await route_update_queue.submit(route_db, update)
+    else:
+        logger.info("not possible to update route file, shipment already delivered or not in the route")
+    return PostProcess.create_response(travel_data)
+
+
+async def apply_route_updates(route_db: AsyncIOMotorDatabase, ginc: str,
+                              updates: List[DeliveryMessage], source: str = 'delivery') -> TravelData:
+    """
+    Applies a batch of delivery confirmations of the same route with a single recalculation.
+
+    Steps:
+    1. Read the route and mark every confirmed delivery.
+    2. Recalculate the route with TomTom and adjust the ETAs with the ZIP code delays. After a delivery the ETAs
+       are only shifted by the observed deviation, when it is small and TomTom recalculated the route recently
+       (see `EtaExtrapolator`); otherwise, with ETA_ENGINE=matrix, the route is recalculated with its
+       travel matrix (see `TravelMatrixService`).
+    3. Save the changed fields, marking the recalculation as done, only if the route is still at the version
+       it was read at;
+       on a version conflict start again from step 1, up to ROUTE_UPDATE_MAX_ATTEMPTS times.
+
+    Args:
+        ginc (str): The identifier of the route.
+        updates (List[DeliveryMessage]): The confirmations, in arrival order.
+        source (str): What triggered the recalculation, as recorded in the ETA history.
+
+    Returns:
+        TravelData: The updated route.
+
+    Raises:
+        HTTPException: If the route is not found (404), if it keeps changing concurrently (409)
+            or if an error occurs during saving (500).
+    """
+
+    for attempt in range(ROUTE_UPDATE_MAX_ATTEMPTS):
+        list_travel_data = await EtaDb.get_route_object(route_db, ginc)
+        if not list_travel_data:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"route information not found.")
+        travel_data = list_travel_data[0]
+        already_delivered = {stop.gsin for stop in travel_data.delivered_stops}
+        planned_gsins = [stop.gsin for stop in travel_data.stops]
+
+        for update in updates:
+            travel_data = TomTomRecalculation.update_route(travel_data, update)
+        # the stops delivered through /route_update/ are still in stops
+        travel_data = TomTomRecalculation.update_travel_data_delivers(travel_data)
+        moved_gsins = [stop.gsin for stop in travel_data.delivered_stops if stop.gsin not in already_delivered]
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if source == 'delivery' and eta_extrapolator.extrapolate(travel_data, planned_gsins, moved_gsins):
+            delay_travel_data = travel_data
+        else:
+            matrix = None
+            if travel_matrices.enabled and source == 'delivery':
+                matrix = await EtaDb.get_route_matrix(route_db, ginc)
+                travel_matrices.record_recalculation(matrix is not None)
+            request_source_token = request_source.set(source)
+            try:
+                ordered_travel_data = await TomTomRecalculation.order_travel_data(travel_data, matrix)
+            finally:
+                request_source.reset(request_source_token)
+            delay_travel_data = PostProcess.update_eta(
+                ordered_travel_data, zip_delays.delays, default_delay=zip_delays.default_delay)
+
+        delay_travel_data.recalculation_status = 'done'
+        delay_travel_data.recalculated_at = now
+        try:
+            save_response = await EtaDb.update_route_partial(route_db, delay_travel_data, moved_gsins)
+        except RouteVersionConflict as ex:
+            logger.info(f"{ex}, attempt {attempt + 1} of {ROUTE_UPDATE_MAX_ATTEMPTS}")
+            continue
+
+        if save_response:
+            logger.info(f"trace {ginc} updated in db with {len(updates)} deliveries")
+            eta_history.record(delay_travel_data, source)
+            return delay_travel_data
+        logger.info("error in store trace inside db")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"error in store trace inside db")
+
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                        detail=f"route {ginc} was modified concurrently, retry later")
+
+
+route_update_queue = RouteUpdateQueue(apply_route_updates)
+
+
+async def recalculate_route(route_db: AsyncIOMotorDatabase, ginc: str) -> TravelData:
+    """
+    Recalculates a route whose deliveries were recorded by /route_update/: the delivered stops are moved to
+    delivered_stops, the ETAs are recalculated and the recalculation is marked as done. The recalculation goes
+    through `route_update_queue`, so it is merged with the confirmations of the route being applied.
+    """
+    return await route_update_queue.recalculate(route_db, ginc)
+
+
+async def recalculation_failed(route_db: AsyncIOMotorDatabase, ginc: str) -> None:
+    """
+    Marks the pending recalculation of a route as failed; the next delivery of the route requests it again.
+    """
+    await EtaDb.set_recalculation_status(route_db, ginc, 'failed')
+
+
+recalculation_worker = RecalculationWorker(recalculate_route, on_failure=recalculation_failed)
+
+
+async def refresh_route(route_db: AsyncIOMotorDatabase, ginc: str) -> TravelData:
+    """
+    Recalculates the remaining legs of a route with the current traffic, as a delivery would. The refresh goes
+    through `route_update_queue`: confirmations of the route waiting in the queue are applied by the same
+    recalculation.
+    """
+    return await route_update_queue.recalculate(route_db, ginc, source=TRAFFIC_SOURCE)
+
+
+traffic_refresher = TrafficRefresher(refresh_route)
+
+
+@eta_api_router.get("/route_status/")
+async def get_route_status(ginc: str,
+                           route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> RecalculationStatus:
+    """
+    Returns the state of the ETA recalculation of a route, without reading the route itself.
 
-    if not old_travel_data or old_travel_data is None:
+    Args:
+        ginc (str): The identifier of the route.
+
+    Returns:
+        RecalculationStatus: The version of the route, the recalculation status (pending, done or failed),
+            when it was requested and when the ETAs were last recalculated.
+
+    Raises:
+        HTTPException: If the route is not found (404).
+    """
+
+    route_status = await EtaDb.get_route_status(route_db, ginc)
+    if route_status is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"route information not found.")
+    return RecalculationStatus(**route_status)
+
+
+@eta_api_router.post("/route_resequence/")
+async def resequence_route(ginc: str,
+                           route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> Response:
+    """
+    Re-sequences the stops still to be delivered of a route, from the current position, and recalculates their ETAs.
 
-    new_travel_data = TomTomRecalculation.update_route(old_travel_data, update)
-    # logger.info(f"inside eta_calculation_api and travel data after update_route are are{new_travel_data}")
-    ordered_travel_data = TomTomRecalculation.order_travel_data(
-        new_travel_data)
-    # logger.info(f"inside eta_calculation_api and travel data after order_travel_data are {new_travel_data}")
-    with open("./eta_to_notification_develop/zip_code.json") as cap_file:
-        cap_delays = json.load(cap_file)
-        logger.info(cap_delays)
+    Steps:
+    1. Read the route and move the delivered stops to delivered_stops.
+    2. Sequence the remaining stops in a worker thread with the travel matrix of the route, or with one built over
+       its waypoints if it has none or it does not contain them (see `RouteOptimizer`).
+    3. Recalculate the ETAs of the new sequence with the matrix and adjust them with the ZIP code delays.
+    4. Save the changed fields and the new order of the stops, only if the route is still at the version
+       it was read at.
+
+    Args:
+        ginc (str): The identifier of the route.
 
+    Returns:
+        Response: The re-sequenced route.
+
+    Raises:
+        HTTPException: If the route is not found (404), if the travel matrix cannot be built (502), if the route
+            changed concurrently (409) or if an error occurs during saving (500).
+    """
+
+    list_travel_data = await EtaDb.get_route_object(route_db, ginc)
+    if not list_travel_data:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"route information not found.")
+    travel_data = list_travel_data[0]
+    already_delivered = {stop.gsin for stop in travel_data.delivered_stops}
+    travel_data = TomTomRecalculation.update_travel_data_delivers(travel_data)
+    moved_gsins = [stop.gsin for stop in travel_data.delivered_stops if stop.gsin not in already_delivered]
+
+    matrix = await EtaDb.get_route_matrix(route_db, ginc)
+    try:
+        if matrix is not None:
+            await asyncio.to_thread(RouteOptimizer.resequence_stops, travel_data, matrix)
+    except KeyError:
+        # the stored matrix does not contain every remaining waypoint
+        matrix = None
+    if matrix is None:
+        try:
+            matrix = await travel_matrices.build(route_points(travel_data))
+        except Exception as ex:
+            logger.error(f"travel matrix of route {ginc} not built: {ex}")
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                                detail=f"travel matrix of the route not available.")
+        await asyncio.to_thread(RouteOptimizer.resequence_stops, travel_data, matrix)
+
+    ordered_travel_data = await TomTomRecalculation.order_travel_data(travel_data, matrix)
     delay_travel_data = PostProcess.update_eta(
-        ordered_travel_data, cap_delays, default_delay=int(os.getenv('DEFAULT_DELAY', 100)))
-    # logger.info(f"travel_data delays after il Postprocess.update_eta are {delay_travel_data}")
+        ordered_travel_data, zip_delays.delays, default_delay=zip_delays.default_delay)
+    delay_travel_data.recalculation_status = 'done'
+    delay_travel_data.recalculated_at = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        save_response = await EtaDb.update_route_partial(route_db, delay_travel_data, moved_gsins, resequenced=True)
+    except RouteVersionConflict:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"route {ginc} was modified concurrently, retry later")
 
-    ###########
-    save_response = await EtaDb.update_route_object(route_db, delay_travel_data)
     if save_response:
-        logger.info("trace updated in db")
-        response = PostProcess.create_response(delay_travel_data)
-        return response
-    else:
-        logger.info("error in store trace inside db")
+        logger.info(f"trace {ginc} re-sequenced with {len(delay_travel_data.stops)} remaining stops")
+        eta_history.record(delay_travel_data, 'resequence')
+        return PostProcess.create_response(delay_travel_data)
+    logger.info("error in store trace inside db")
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail=f"error in store trace inside db")
+
+
+@eta_api_router.post("/route_updates/")
+async def bulk_route_update(updates: List[DeliveryMessage],
+                            route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> BulkDeliveryReport:
+    """
+    Applies many delivery confirmations at once, as flushed by a device that was offline.
+
+    Steps:
+    1. Group the confirmations by route (ginc).
+    2. Apply all the confirmations of each route in a single batch: one read, one recalculation and one write
+       per route (see `apply_route_updates`). At most BATCH_MAX_PARALLEL_ROUTES routes are processed at the same time.
+    3. Report the outcome of every confirmation, in the order they were sent.
+
+    Args:
+        updates (List[DeliveryMessage]): The delivery confirmations.
+
+    Returns:
+        BulkDeliveryReport: The outcome of each confirmation; a confirmation whose gsin is not part of its route
+            is reported with status code 404.
+
+    Raises:
+        HTTPException: If more than BULK_UPDATE_MAX_ITEMS confirmations are sent (413).
+    """
+
+    if len(updates) > BULK_UPDATE_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"at most {BULK_UPDATE_MAX_ITEMS} confirmations can be sent at once")
+
+    routes: Dict[str, List[DeliveryMessage]] = {}
+    for update in updates:
+        routes.setdefault(update.ginc, []).append(update)
+
+    semaphore = asyncio.Semaphore(BATCH_MAX_PARALLEL_ROUTES)
+
+    async def apply(route_updates: List[DeliveryMessage]):
+        async with semaphore:
+            return await route_update_queue.submit_many(route_db, route_updates)
+
+    outcomes = await asyncio.gather(*[apply(route_updates) for route_updates in routes.values()],
+                                    return_exceptions=True)
+    outcome_by_ginc = dict(zip(routes, outcomes))
+
+    results = [delivery_update_result(update, outcome_by_ginc[update.ginc]) for update in updates]
+    delivered = sum(1 for result in results if result.status_code == status.HTTP_200_OK)
+    logger.info(f"bulk update: {delivered} of {len(results)} confirmations applied on {len(routes)} routes")
+    return BulkDeliveryReport(results=results, routes=len(routes), delivered=delivered,
+                              failed=len(results) - delivered)
+
+
+def delivery_update_result(update: DeliveryMessage, outcome) -> DeliveryUpdateResult:
+    """
+    Builds the outcome of a single confirmation of a bulk update from the outcome of its route.
+    """
+    if isinstance(outcome, HTTPException):
+        return DeliveryUpdateResult(ginc=update.ginc, gsin=update.gsin,
+                                    status_code=outcome.status_code, detail=outcome.detail)
+    if isinstance(outcome, BaseException):
+        logger.error(f"bulk update of route {update.ginc} failed: {outcome}")
+        return DeliveryUpdateResult(ginc=update.ginc, gsin=update.gsin,
+                                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(outcome))
+
+    delivered = any(update.gsin in (stop.gsins or [stop.gsin]) for stop in outcome.delivered_stops) or \
+        any(update.gsin in stop.delivered_gsins for stop in outcome.stops)
+    if delivered:
+        return DeliveryUpdateResult(ginc=update.ginc, gsin=update.gsin, status_code=status.HTTP_200_OK,
+                                    detail="delivered")
+    return DeliveryUpdateResult(ginc=update.ginc, gsin=update.gsin, status_code=status.HTTP_404_NOT_FOUND,
+                                detail="shipment not found in the route")
+
+
+@eta_api_router.get("/eta_history/")
+async def get_eta_history(ginc: str,
+                          route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> StreamingResponse:
+    """
+    Streams the ETA history of a route, oldest recalculation first, as newline-delimited JSON.
+
+    Every line is a record with the hour bucket and the time of the recalculation (epoch seconds), its source
+    (upload, delivery or traffic) and the [gsin, eta] pairs of the stops that were still to be delivered.
+
+    Args:
+        ginc (str): The identifier of the route.
+
+    Returns:
+        StreamingResponse: The records, read from the database in batches while they are sent.
+    """
+
+    async def lines():
+        async for record in EtaDb.stream_eta_history(route_db, ginc):
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@eta_api_router.get("/metrics/")
+async def get_metrics() -> dict:
+    """
+    Returns the counters collected by the caches and the rate limiters of the service.
+
+    Returns:
+        dict: The counters of each component.
+    """
+
+    return {
+        'geocoding_cache': geocoding_cache.stats(),
+        'geocoder': geocoder.stats(),
+        'tomtom_client': tomtom_client.stats(),
+        'routing_cache': routing_cache.stats(),
+        'route_cache': route_cache.stats(),
+        'route_update_queue': route_update_queue.stats(),
+        'recalculation_worker': recalculation_worker.stats(),
+        'traffic_refresh': traffic_refresher.stats(),
+        'eta_history': eta_history.stats(),
+        'eta_extrapolation': eta_extrapolator.stats(),
+        'travel_matrix': travel_matrices.stats(),
+        'zip_delays': zip_delays.stats()
+    }
+
+
+@eta_api_router.post("/admin/reload_zip_delays/")
+async def reload_zip_delays() -> dict:
+    """
+    Reloads the ZIP code delay table from zip_code.json, without waiting for the periodic check.
+
+    Returns:
+        dict: The status of the reloaded table.
+
+    Raises:
+        HTTPException: If the file cannot be read or parsed (500); the previous table is kept.
+    """
+
+    reloaded = await asyncio.to_thread(zip_delays.load)
+    if not reloaded:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail=f"error in store trace inside db")
+                            detail="error reloading the zip code delays, the previous table is kept")
+    return zip_delays.stats()
+
+
+@eta_api_router.post("/admin/refresh_traffic/")
+async def refresh_traffic() -> dict:
+    """
+    Refreshes the ETAs of today's active routes with the current traffic, without waiting for the scheduled run.
+    The routes recalculated recently are skipped, as in the scheduled run.
+
+    Returns:
+        dict: The counters of the traffic refresh.
+    """
+
+    await traffic_refresher.refresh()
+    return traffic_refresher.stats()
 
 
+@eta_api_router.post("/admin/migrate_routes/")
+async def migrate_routes(route_db: AsyncIOMotorDatabase = ROUTE_DBDependency) -> dict:
+    """
+    Converts the routes still stored in the original document format into the compact one.
+    The routes are also converted one by one the first time they are updated, so running it is optional.
+
+    Returns:
+        dict: The number of converted routes.
+    """
+
+    migrated = await EtaDb.migrate_routes(route_db)
+    logger.info(f"{migrated} routes converted to the compact format")
+    return {'migrated': migrated}
+
+
+class ArchiveMember():
+    """
+    Exposes a CSV file stored inside a zip archive with the same interface of an `UploadFile`
+    (`filename` and an asynchronous `read(size)`), so that it can be parsed by `PreProcess.digest_csv`.
+    """
+
+    def __init__(self, archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+        self.filename = os.path.basename(info.filename)
+        self._archive = archive
+        self._info = info
+        self._file = None
+
+    async def read(self, size: int = -1) -> bytes:
+        if self._file is None:
+            self._file = self._archive.open(self._info)
+        chunk = self._file.read(size)
+        if not chunk:
+            self._file.close()
+        return chunk
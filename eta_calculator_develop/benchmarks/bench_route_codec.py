@@ -0,0 +1,84 @@
+"""Micro-benchmarks of the route storage codec
+
+Compares, on synthetic routes, the trusted path used by EtaDb (RouteDocument.encode/decode) with full pydantic
+validation and with the original format (model_dump / model_validate), including the BSON step.
+
+Run from eta_calculator_develop:
+    python benchmarks/bench_route_codec.py [number of stops ...]
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+import bson
+from bson import CodecOptions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from controller.db.route_document import RouteDocument  # noqa: E402
+from model.delivery import Address  # noqa: E402
+from model.travel_data import StopSummary, Summary, TravelData  # noqa: E402
+
+
+CODEC_OPTIONS = CodecOptions(tz_aware=True)
+
+
+def make_route(stops: int, delivered: int) -> TravelData:
+    departure = datetime(2024, 5, 2, 8, 0, tzinfo=timezone.utc)
+    addresses = [Address(address=f"Via Roma {i}", city="Pisa", district="PI", house_number=str(i),
+                         zip_code="56121", telephone_number="3933332345678") for i in range(stops + 1)]
+    coordinates = [(43.7 + i * 0.001, 10.4 + i * 0.001) for i in range(stops + 1)]
+    stop_summaries = [
+        StopSummary(gsin=f"G{i:06}", gsins=[f"G{i:06}"], lengthInMeters=1000 + i, travelTimeInSeconds=120 + i,
+                    trafficDelayInSeconds=5, departureAddress=addresses[i], departureLatitude=coordinates[i][0],
+                    departureLongitude=coordinates[i][1], arrivalAddress=addresses[i + 1],
+                    arrivalLatitude=coordinates[i + 1][0], arrivalLongitude=coordinates[i + 1][1],
+                    departureTime=departure + timedelta(minutes=5 * i),
+                    arrivalTime=departure + timedelta(minutes=5 * i + 3))
+        for i in range(stops)]
+    for stop in stop_summaries[:delivered]:
+        stop.delivered = True
+        stop.delivered_at = stop.arrivalTime
+        stop.delivered_gsins = {stop.gsin: stop.arrivalTime}
+    summary = Summary(travelMode="car", startAddress=addresses[0], startLatitude=coordinates[0][0],
+                      startLongitude=coordinates[0][1], endAddress=addresses[-1], endLatitude=coordinates[-1][0],
+                      endLongitude=coordinates[-1][1], departureTime=departure,
+                      arrivalTime=departure + timedelta(minutes=5 * stops))
+    return TravelData(personal_id="2024_05_02", ginc="R1", summary=summary,
+                      stops=stop_summaries[delivered:], delivered_stops=stop_summaries[:delivered])
+
+
+def measure(function, repeat: int = 5, number: int = 50) -> float:
+    '''best time of a call, in milliseconds'''
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1000
+
+
+def run(stops: int) -> None:
+    route = make_route(stops, delivered=stops // 10)
+    original_document = route.model_dump()
+    document = RouteDocument.encode(route)
+    original_bson = bson.encode(original_document)
+    compact_bson = bson.encode(document)
+
+    results = {
+        'encode, model_dump': measure(route.model_dump),
+        'encode, trusted': measure(lambda: RouteDocument.encode(route)),
+        'decode, model_validate (original format)': measure(lambda: TravelData.model_validate(original_document)),
+        'decode, trusted': measure(lambda: RouteDocument.decode(document)),
+        'bson + encode, original format': measure(lambda: bson.encode(route.model_dump())),
+        'bson + encode, trusted': measure(lambda: bson.encode(RouteDocument.encode(route))),
+        'bson + decode, original format':
+            measure(lambda: TravelData.model_validate(bson.decode(original_bson, CODEC_OPTIONS))),
+        'bson + decode, trusted': measure(lambda: RouteDocument.decode(bson.decode(compact_bson, CODEC_OPTIONS))),
+    }
+
+    print(f"\n{stops} stops: document {len(original_bson)} bytes in the original format, "
+          f"{len(compact_bson)} bytes in the compact one")
+    for name, milliseconds in results.items():
+        print(f"  {name:<45}{milliseconds:8.3f} ms")
+
+
+if __name__ == "__main__":
+    for stops in [int(argument) for argument in sys.argv[1:]] or [50, 150, 500]:
+        run(stops)
@@ -0,0 +1,59 @@
+"""Solution quality and runtime of the local route sequencing
+
+Sequences synthetic routes (random stops around a depot, haversine travel times as built by TravelMatrixService with
+TRAVEL_MATRIX_BACKEND=haversine) and compares the total travel time of the input order, of the nearest neighbour
+seed and of the local search (2-opt and Or-opt) with different time budgets; the gain of the local search is
+relative to the seed.
+
+Run from eta_calculator_develop:
+    python benchmarks/bench_route_optimizer.py [number of stops ...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.route_optimizer import RouteOptimizer  # noqa: E402
+from utils.travel_matrix import TravelMatrixService  # noqa: E402
+
+
+DEPOT = (43.7167, 10.4000)
+TIME_BUDGETS = (0.1, 0.5, 2.0)
+
+
+def make_costs(stops: int, seed: int = 7):
+    generator = random.Random(seed)
+    points = [DEPOT] + [(DEPOT[0] + generator.uniform(-0.15, 0.15), DEPOT[1] + generator.uniform(-0.2, 0.2))
+                        for _ in range(stops)]
+    durations, _ = TravelMatrixService(backend='haversine').haversine_matrix(points)
+    size = len(points)
+    # the route ends at the depot: the last node is a copy of node 0
+    indexes = list(range(size)) + [0]
+    return [[durations[origin * size + destination] for destination in indexes] for origin in indexes]
+
+
+def run(stops: int) -> None:
+    costs = make_costs(stops)
+    input_cost = RouteOptimizer.path_cost(list(range(len(costs))), costs)
+
+    started = time.perf_counter()
+    seed_cost = RouteOptimizer.path_cost(RouteOptimizer.nearest_neighbour(costs), costs)
+    seed_seconds = time.perf_counter() - started
+
+    print(f"{stops} stops")
+    print(f"  {'input order':<28} {input_cost / 60:>9.0f} min")
+    print(f"  {'nearest neighbour':<28} {seed_cost / 60:>9.0f} min {'':>8} {seed_seconds * 1000:>9.1f} ms")
+    for time_budget in TIME_BUDGETS:
+        path, stats = RouteOptimizer.sequence(costs, time_budget)
+        assert sorted(path) == list(range(len(costs)))
+        label = f"2-opt + Or-opt, budget {time_budget}s"
+        print(f"  {label:<28} {stats['cost'] / 60:>9.0f} min {100 * (stats['cost'] / seed_cost - 1):>+7.1f}% "
+              f"{stats['elapsed_seconds'] * 1000:>9.1f} ms  {stats['moves']} moves"
+              f"{'' if stats['converged'] else ', budget exhausted'}")
+
+
+if __name__ == '__main__':
+    for stops in [int(argument) for argument in sys.argv[1:]] or [50, 150, 300, 500]:
+        run(stops)
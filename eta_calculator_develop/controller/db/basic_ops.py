@@ -1,8 +1,8 @@
 """Basic Database Operations"""
 import bcrypt
-from typing import Dict
+from typing import Dict, List
 from bson import CodecOptions
-from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorCursor, AsyncIOMotorDatabase
 from pymongo import DESCENDING, ReturnDocument
 
 
@@ -18,6 +18,15 @@ async def persist_entry(db: AsyncIOMotorDatabase, collection_name: str, entry: D
     return await __collection_with_option(db, collection_name).insert_one(entry)
 
 
+async def persist_entries(db: AsyncIOMotorDatabase, collection_name: str, entries: List[Dict]):
+    '''
+    Persist the entries `entries` into collection `collection_name` with a single bulk insert\n
+    :param collection_name: The name of the collection where to persist the entries\n
+    :param entries: the entries to be persisted
+    '''
+    return await __collection_with_option(db, collection_name).insert_many(entries, ordered=False)
+
+
 async def update_entry(db: AsyncIOMotorDatabase, collection_name: str, where, updated_entry) -> None:
     '''
     Persist the changes performed on `entry`\n
@@ -28,6 +37,41 @@ async def update_entry(db: AsyncIOMotorDatabase, collection_name: str, where, up
     await __collection_with_option(db, collection_name).update_one(where, {'$set': updated_entry})
 
 
+async def apply_update(db: AsyncIOMotorDatabase, collection_name: str, where, update, upsert=False):
+    '''
+    Apply `update` (an update document or an aggregation pipeline) to the entry matching `where`, in a single
+    atomic operation\n
+    :param collection_name: The name of the collection the entry belongs to\n
+    :param where: the query to be matched by the element that must be updated
+    :param update: the update operators or the update pipeline
+    :param upsert: insert the entry if none matches `where`
+    '''
+    return await __collection_with_option(db, collection_name).update_one(where, update, upsert=upsert)
+
+
+async def apply_update_and_fetch(db: AsyncIOMotorDatabase, collection_name: str, where, update,
+                                 return_document=ReturnDocument.AFTER):
+    '''
+    Apply `update` (an update document or an aggregation pipeline) to the entry matching `where`, in a single
+    atomic operation, and return the entry\n
+    :param collection_name: The name of the collection the entry belongs to\n
+    :param where: the query to be matched by the element that must be updated
+    :param update: the update operators or the update pipeline
+    :param return_document: choose to return the document before or after the update
+    '''
+    return await __collection_with_option(db, collection_name).find_one_and_update(where, update,
+                                                                                   return_document=return_document)
+
+
+async def ensure_index(db: AsyncIOMotorDatabase, collection_name: str, keys, **kwargs) -> str:
+    '''
+    Create the index `keys` on collection `collection_name`, if it does not exist yet\n
+    :param collection_name: The name of the collection to be indexed\n
+    :param keys: the field name or the list of (field, direction) pairs of the index
+    '''
+    return await db[collection_name].create_index(keys, **kwargs)
+
+
 async def delete_entry(db: AsyncIOMotorDatabase, collection_name: str, query) -> None:
     '''
     Delete rt message
@@ -68,6 +112,21 @@ def retreive_entry_by_query(db: AsyncIOMotorDatabase,
     return __collection_with_option(db, collection_name).find(query, sort=sort, limit=limit)
 
 
+def stream_entries(db: AsyncIOMotorDatabase,
+                   collection_name: str,
+                   query,
+                   projection=None,
+                   sort=[('_id', DESCENDING)],
+                   batch_size=500) -> AsyncIOMotorCursor:
+    '''
+    Iterate over the entries matching the `query` from collection `collection_name`, fetching them in batches
+    of `batch_size`\n
+    :param query: the query used in the retrieval operation
+    :param projection: the fields to be returned
+    '''
+    return __collection_with_option(db, collection_name).find(query, projection, sort=sort, batch_size=batch_size)
+
+
 def __collection_with_option(db: AsyncIOMotorDatabase, collection_name: str) -> AsyncIOMotorCollection:
     codec_option = CodecOptions(tz_aware=True)
     return db[collection_name].with_options(codec_option)
@@ -25,6 +25,13 @@ class ROUTE_DBSettings():
     read_preference = 'primary'
     connection_uri = ""
     integration_test = os.environ.get('INTEGRATION_TEST', False)
+    max_pool_size = int(os.environ.get('DB_MAX_POOL_SIZE', 100))
+    min_pool_size = int(os.environ.get('DB_MIN_POOL_SIZE', 5))
+    max_idle_time_ms = int(os.environ.get('DB_MAX_IDLE_TIME_MS', 60000))
+    connect_timeout_ms = int(os.environ.get('DB_CONNECT_TIMEOUT_MS', 5000))
+    server_selection_timeout_ms = int(os.environ.get('DB_SERVER_SELECTION_TIMEOUT_MS', 5000))
+    socket_timeout_ms = int(os.environ.get('DB_SOCKET_TIMEOUT_MS', 30000))
+    compressors = os.environ.get('DB_COMPRESSORS', 'zlib')
 
     def __init__(self) -> None:
         self.hosts = [f'mongo-{i:02}.{self.mongo_base_url}:{
@@ -36,6 +43,30 @@ class ROUTE_DBSettings():
             self.connection_uri = f"mongodb://{self.username}:{self.password}@{','.join(self.hosts)}/{self.database}?authSource={
                 self.auth_source}&replicaSet={self.replica_set}&readPreference={self.read_preference}&ssl=true"
 
+    def client_options(self) -> dict:
+        """
+        Options of the Motor client: connection pool, timeouts and wire compression
+        """
+        options = {
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'maxIdleTimeMS': self.max_idle_time_ms,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'socketTimeoutMS': self.socket_timeout_ms
+        }
+        if self.compressors:
+            options['compressors'] = self.compressors
+        return options
+
+
+def create_route_client(settings: ROUTE_DBSettings) -> motor.motor_asyncio.AsyncIOMotorClient:
+    """
+    Create the Motor client shared by the whole application
+    """
+
+    return motor.motor_asyncio.AsyncIOMotorClient(settings.connection_uri, **settings.client_options())
+
 
 async def get_db(request: Request):
     """
@@ -1,18 +1,63 @@
 import json
 import os
 from loguru import logger
-from typing import List
-from .basic_ops import update_entry_atomic, persist_entry, retreive_entry_by_query, delete_entry
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from typing import AsyncIterator, List
+from .basic_ops import (update_entry_atomic, persist_entry, persist_entries, retreive_entry_by_query,
+                        stream_entries, delete_entry, apply_update, apply_update_and_fetch, ensure_index)
+from motor.motor_asyncio import AsyncIOMotorCursor, AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError
 from model.travel_data import TravelData
-from datetime import datetime
+from model.travel_matrix import TravelMatrix
+from .route_document import SCHEMA_VERSION, RouteDocument
+from utils.route_cache import route_cache
+from datetime import datetime, timezone
 
 
 COLLECTION_NAME = os.environ.get('DB_COLLECTION', 'route_object')
+HISTORY_COLLECTION_NAME = os.environ.get('DB_HISTORY_COLLECTION', 'eta_history')
+MATRIX_COLLECTION_NAME = os.environ.get('DB_MATRIX_COLLECTION', 'route_matrix')
+DUPLICATE_KEY_ERROR = 11000
+
+
+class RouteVersionConflict(Exception):
+    '''Raised when a route was changed by someone else after it was read.'''
+
+    def __init__(self, ginc: str, version: int) -> None:
+        super().__init__(f"route {ginc} is no longer at version {version}")
+        self.ginc = ginc
+        self.version = version
 
 
 class EtaDb(object):
 
+    @staticmethod
+    def version_filter(route_object: TravelData) -> dict:
+        """
+        query matching the route only if it is still at the version it was read at. The routes stored before the
+        version field was introduced are at version 0
+        """
+        if route_object.version:
+            return {'ginc': route_object.ginc, 'version': route_object.version}
+        return {'ginc': route_object.ginc, 'version': {'$in': [0, None]}}
+
+    @staticmethod
+    async def ensure_indexes(db: AsyncIOMotorDatabase) -> bool:
+        """
+        create the indexes used by the lookups of the routes: ginc (unique), personal_id (with ginc, for the day
+        listings) and stops.gsin,
+        the index of the ETA history by route and time, and the one of the travel matrices by route (unique)
+        """
+        try:
+            await ensure_index(db, COLLECTION_NAME, 'ginc', unique=True)
+            await ensure_index(db, COLLECTION_NAME, [('personal_id', 1), ('ginc', 1)])
+            await ensure_index(db, COLLECTION_NAME, 'stops.gsin')
+            await ensure_index(db, HISTORY_COLLECTION_NAME, [('ginc', 1), ('bucket', 1), ('at', 1)])
+            await ensure_index(db, MATRIX_COLLECTION_NAME, 'ginc', unique=True)
+            return True
+        except Exception as ex:
+            logger.error(f'follow_track_db.ensure_indexes, error:{ex}')
+            return False
+
     @staticmethod
     async def add_new_object(db: AsyncIOMotorDatabase, route_objet) -> bool:
         """
@@ -21,7 +66,9 @@ class EtaDb(object):
         try:
             dict_route_objet = route_objet.mongo()
             result = await persist_entry(db, COLLECTION_NAME, dict_route_objet)
+            route_cache.invalidate(route_objet.ginc)
             if result is not None:
+                route_objet.schema_version = SCHEMA_VERSION
                 return True
             return False
         except Exception as ex:
@@ -31,17 +78,20 @@ class EtaDb(object):
     @staticmethod
     async def get_route_object(db: AsyncIOMotorDatabase, ginc: str) -> List[TravelData]:
         """
-        get Travel Data object based on GINC
+        get Travel Data object based on GINC, from the route cache when possible
         """
         try:
-            result = [TravelData.parse_mongo(match) async for match in retreive_entry_by_query(db,
-                                                                                               COLLECTION_NAME,
-                                                                                               {'ginc': ginc},
-                                                                                               1
-                                                                                               )]
+            cached_route = route_cache.get(ginc)
+            if cached_route is not None:
+                return [cached_route]
+
+            generation = route_cache.generation()
+            result = [match async for match in retreive_entry_by_query(db, COLLECTION_NAME, {'ginc': ginc}, 1)]
 
             # logger.info(result)
-            return result
+            if result:
+                route_cache.set(ginc, result[0], generation)
+            return [TravelData.parse_mongo(document) for document in result]
         except Exception as ex:
             logger.error(f'follow_track_db.get_route_object, error:{ex}')
             return None
@@ -49,21 +99,41 @@ class EtaDb(object):
     @staticmethod
     async def get_route_object_by_date(db: AsyncIOMotorDatabase, date: str) -> List[TravelData]:
         """
-        get Travel Data object based on GINC
+        get every Travel Data object of a day, based on personal_id
         """
         try:
             result = [TravelData.parse_mongo(match) async for match in retreive_entry_by_query(db,
                                                                                                COLLECTION_NAME,
                                                                                                {'personal_id': date},
-                                                                                               1
+                                                                                               0
                                                                                                )]
 
             # logger.info(result)
             return result
         except Exception as ex:
-            logger.error(f'follow_track_db.get_route_object, error:{ex}')
+            logger.error(f'follow_track_db.get_route_object_by_date, error:{ex}')
             return None
 
+    @staticmethod
+    def stream_routes_by_date(db: AsyncIOMotorDatabase, date: str, projection: dict,
+                              batch_size: int) -> AsyncIOMotorCursor:
+        """
+        iterate over the stored documents of the routes of a day, based on personal_id, ordered by ginc.
+        The documents are fetched `batch_size` at a time and only the fields in `projection` are read
+        """
+        return stream_entries(db, COLLECTION_NAME, {'personal_id': date}, projection, sort=[('ginc', 1)],
+                              batch_size=batch_size)
+
+    @staticmethod
+    def stream_active_routes(db: AsyncIOMotorDatabase, date: str) -> AsyncIOMotorCursor:
+        """
+        iterate over the routes of a day, based on personal_id, that still have stops to be delivered, least recently
+        routed by TomTom first (the routes never routed, or stored in the original format, come first).
+        Only the ginc and the state of the ETA recalculation are read
+        """
+        return stream_entries(db, COLLECTION_NAME, {'personal_id': date, 'stops.0': {'$exists': True}},
+                              {'_id': 0, 'ginc': 1, 'recalc': 1}, sort=[('recalc.routed_at', 1), ('ginc', 1)])
+
     @staticmethod
     async def delete_route_object(db: AsyncIOMotorDatabase, ginc: str) -> bool:
         '''
@@ -71,6 +141,8 @@ class EtaDb(object):
         '''
         try:
             result = await delete_entry(db, COLLECTION_NAME, {'ginc': ginc})
+            route_cache.invalidate(ginc)
+            await delete_entry(db, MATRIX_COLLECTION_NAME, {'ginc': ginc})
             if result is not None:
                 return True
             return False
@@ -81,14 +153,268 @@ class EtaDb(object):
     @staticmethod
     async def update_route_object(db: AsyncIOMotorDatabase, new_route_object: TravelData) -> bool:
         """
-        update the route object
+        update the route object, if it is still at the version it was read at. The whole document is replaced,
+        in the current storage format. On success the version of `new_route_object` is incremented
+
+        Raises:
+            RouteVersionConflict: if the stored route has a different version
         """
         try:
             new_route_object_dict = new_route_object.mongo()
-            result = await update_entry_atomic(db, COLLECTION_NAME, {'ginc': new_route_object.ginc}, new_route_object_dict)
+            new_route_object_dict['version'] = (new_route_object.version or 0) + 1
+            result = await update_entry_atomic(db, COLLECTION_NAME, EtaDb.version_filter(new_route_object),
+                                               new_route_object_dict)
+            route_cache.invalidate(new_route_object.ginc)
             if result is not None:
+                new_route_object.version = new_route_object_dict['version']
+                new_route_object.schema_version = SCHEMA_VERSION
                 return True
-            return False
+            raise RouteVersionConflict(new_route_object.ginc, new_route_object.version)
+        except RouteVersionConflict:
+            raise
         except Exception as ex:
             logger.error(f'follow_track_db.update_route_object, error:{ex}')
             return False
+
+    @staticmethod
+    async def update_route_partial(db: AsyncIOMotorDatabase, route_object: TravelData, moved_gsins: List[str],
+                                   resequenced: bool = False) -> bool:
+        """
+        update only what a route update changed, in a single atomic operation: the summary, the times and
+        delivery status of the stops, the stops moved from stops to delivered_stops and the state of the ETA
+        recalculation; with `resequenced`, also the order of the stops and their addresses. The update is applied only
+        if the route is still at the version it was read at; on success the version of `route_object` is incremented.
+        A route read from a document in the original format is replaced as a whole, which converts it
+
+        Raises:
+            RouteVersionConflict: if the stored route has a different version
+        """
+        if route_object.schema_version != SCHEMA_VERSION:
+            return await EtaDb.update_route_object(db, route_object)
+        try:
+            result = await apply_update(db, COLLECTION_NAME, EtaDb.version_filter(route_object),
+                                        EtaDb.route_update_pipeline(route_object, moved_gsins, resequenced))
+            route_cache.invalidate(route_object.ginc)
+            if result.matched_count == 1:
+                route_object.version = (route_object.version or 0) + 1
+                return True
+            raise RouteVersionConflict(route_object.ginc, route_object.version)
+        except RouteVersionConflict:
+            raise
+        except Exception as ex:
+            logger.error(f'follow_track_db.update_route_partial, error:{ex}')
+            return False
+
+    @staticmethod
+    def route_update_pipeline(route_object: TravelData, moved_gsins: List[str],
+                              resequenced: bool = False) -> List[dict]:
+        """
+        build the update pipeline of `update_route_partial`. The stored stops are matched by gsin: the ones in
+        `moved_gsins` are pulled from stops and pushed to delivered_stops; every stop keeps its addresses and receives
+        only the fields that a recalculation or a delivery can change. The start and the end of the summary change
+        with the stops (a recalculation starts the route from the departure of the first stop left): their entries
+        are added to the address table if missing, and the summary references them. With `resequenced`, the stops
+        are also put in the order of `route_object.stops` and reference their new departure and arrival addresses
+        """
+        summary = route_object.summary
+        summary_addresses = [RouteDocument.encode_address(summary.startAddress, summary.startLatitude,
+                                                          summary.startLongitude),
+                             RouteDocument.encode_address(summary.endAddress, summary.endLatitude,
+                                                          summary.endLongitude)]
+        stop_addresses = []
+        if resequenced:
+            stop_addresses = [[stop.gsin,
+                               RouteDocument.encode_address(stop.departureAddress, stop.departureLatitude,
+                                                            stop.departureLongitude),
+                               RouteDocument.encode_address(stop.arrivalAddress, stop.arrivalLatitude,
+                                                            stop.arrivalLongitude)]
+                              for stop in route_object.stops]
+        new_addresses = []
+        for entry in summary_addresses + [entry for _, *entries in stop_addresses for entry in entries]:
+            if entry not in new_addresses:
+                new_addresses.append(entry)
+        moved_stops = [stop for stop in route_object.delivered_stops if stop.gsin in moved_gsins]
+        moved_gsins = [stop.gsin for stop in moved_stops]
+
+        def merge_patches(stops: List, gsins: List[str]) -> dict:
+            patches = [RouteDocument.encode_stop_update(stop) for stop in stops]
+            return {'$let': {
+                'vars': {'index': {'$indexOfArray': [gsins, '$$stop.gsin']}},
+                'in': {'$mergeObjects': ['$$stop', {'$cond': [{'$gte': ['$$index', 0]},
+                                                              {'$arrayElemAt': [{'$literal': patches}, '$$index']},
+                                                              {}]}]}
+            }}
+
+        is_moved = {'$in': ['$$stop.gsin', moved_gsins]}
+        pipeline = [{'$set': {
+            'version': {'$literal': (route_object.version or 0) + 1},
+            'summary': {'$mergeObjects': ['$summary',
+                                          {'$literal': RouteDocument.encode_summary_update(route_object.summary)}]},
+            'delivered_stops': {'$concatArrays': ['$delivered_stops', {'$map': {
+                'input': {'$filter': {'input': '$stops', 'as': 'stop', 'cond': is_moved}},
+                'as': 'stop',
+                'in': merge_patches(moved_stops, moved_gsins)
+            }}]},
+            'stops': {'$map': {
+                'input': {'$filter': {'input': '$stops', 'as': 'stop', 'cond': {'$not': [is_moved]}}},
+                'as': 'stop',
+                'in': merge_patches(route_object.stops, [stop.gsin for stop in route_object.stops])
+            }},
+            'recalc': {'$literal': RouteDocument.encode_recalculation(route_object)},
+            'addresses': {'$concatArrays': ['$addresses', {'$filter': {
+                'input': {'$literal': new_addresses},
+                'as': 'entry',
+                'cond': {'$not': [{'$in': ['$$entry', '$addresses']}]}
+            }}]}
+        }}, {'$set': {
+            'summary.from': {'$indexOfArray': ['$addresses', {'$literal': summary_addresses[0]}]},
+            'summary.to': {'$indexOfArray': ['$addresses', {'$literal': summary_addresses[1]}]}
+        }}]
+        if resequenced:
+            pipeline.append({'$set': {'stops': {'$map': {
+                'input': {'$literal': stop_addresses},
+                'as': 'order',
+                'in': {'$mergeObjects': [
+                    {'$arrayElemAt': [{'$filter': {
+                        'input': '$stops', 'as': 'stop',
+                        'cond': {'$eq': ['$$stop.gsin', {'$arrayElemAt': ['$$order', 0]}]}}}, 0]},
+                    {'from': {'$indexOfArray': ['$addresses', {'$arrayElemAt': ['$$order', 1]}]},
+                     'to': {'$indexOfArray': ['$addresses', {'$arrayElemAt': ['$$order', 2]}]}}
+                ]}
+            }}}})
+        return pipeline
+
+    @staticmethod
+    async def mark_delivered(db: AsyncIOMotorDatabase, ginc: str, gsin: str, delivered_at: datetime) -> TravelData:
+        """
+        record the delivery of `gsin` in a single atomic update, without recalculating the route, and mark its ETA
+        recalculation as pending (see RouteDocument.mark_delivered_pipeline). Only the routes in the current format
+        are updated, and only if the gsin is part of a stop not delivered yet
+
+        Returns:
+            TravelData: the updated route, or None if nothing was updated
+        """
+        stop_query = {'$or': [{'gsins': gsin}, {'gsin': gsin, 'gsins': {'$exists': False}}],
+                      'dlv': {'$ne': True},
+                      'dlv_gsins': {'$not': {'$elemMatch': {'$elemMatch': {'$eq': gsin}}}}}
+        try:
+            result = await apply_update_and_fetch(db, COLLECTION_NAME,
+                                                  {'ginc': ginc, 'schema_version': SCHEMA_VERSION,
+                                                   'stops': {'$elemMatch': stop_query}},
+                                                  RouteDocument.mark_delivered_pipeline(gsin, delivered_at))
+            route_cache.invalidate(ginc)
+            if result is not None:
+                return TravelData.parse_mongo(result)
+            return None
+        except Exception as ex:
+            logger.error(f'follow_track_db.mark_delivered, error:{ex}')
+            return None
+
+    @staticmethod
+    async def set_recalculation_status(db: AsyncIOMotorDatabase, ginc: str, status: str) -> bool:
+        """
+        set the status of a pending ETA recalculation of a route
+        """
+        try:
+            result = await apply_update(db, COLLECTION_NAME, {'ginc': ginc, 'recalc.status': 'pending'},
+                                        {'$set': {'recalc.status': status}})
+            route_cache.invalidate(ginc)
+            return result.matched_count == 1
+        except Exception as ex:
+            logger.error(f'follow_track_db.set_recalculation_status, error:{ex}')
+            return False
+
+    @staticmethod
+    async def get_route_status(db: AsyncIOMotorDatabase, ginc: str) -> dict:
+        """
+        get the version and the state of the ETA recalculation of a route, reading only those fields
+
+        Returns:
+            dict: ginc, version and the recalculation fields of TravelData, or None if the route is not found
+        """
+        try:
+            async for match in stream_entries(db, COLLECTION_NAME, {'ginc': ginc},
+                                              {'_id': 0, 'ginc': 1, 'version': 1, 'recalc': 1}, batch_size=1):
+                return {'ginc': match['ginc'], 'version': match.get('version', 0),
+                        **RouteDocument.decode_recalculation(match)}
+            return None
+        except Exception as ex:
+            logger.error(f'follow_track_db.get_route_status, error:{ex}')
+            return None
+
+    @staticmethod
+    async def migrate_routes(db: AsyncIOMotorDatabase) -> int:
+        """
+        convert every route still stored in the original format. A route changed while it is converted is skipped
+        and will be converted by its next update
+
+        Returns:
+            int: the number of routes converted
+        """
+        migrated = 0
+        async for document in stream_entries(db, COLLECTION_NAME, {'schema_version': {'$ne': SCHEMA_VERSION}}):
+            try:
+                if await EtaDb.update_route_object(db, TravelData.parse_mongo(document)):
+                    migrated += 1
+            except RouteVersionConflict as ex:
+                logger.info(f'follow_track_db.migrate_routes, skipped: {ex}')
+            except Exception as ex:
+                logger.error(f'follow_track_db.migrate_routes, route {document.get("ginc")}, error:{ex}')
+        return migrated
+
+    @staticmethod
+    async def add_route_matrix(db: AsyncIOMotorDatabase, ginc: str, backend: str, matrix: TravelMatrix) -> bool:
+        """
+        store the travel matrix of a route, replacing the previous one
+        """
+        try:
+            await apply_update(db, MATRIX_COLLECTION_NAME, {'ginc': ginc},
+                               {'$set': {'ginc': ginc, 'backend': backend, 'created_at': datetime.now(timezone.utc),
+                                         **matrix.encode()}},
+                               upsert=True)
+            return True
+        except Exception as ex:
+            logger.error(f'follow_track_db.add_route_matrix, error:{ex}')
+            return False
+
+    @staticmethod
+    async def get_route_matrix(db: AsyncIOMotorDatabase, ginc: str) -> TravelMatrix:
+        """
+        get the travel matrix of a route, None if it has none
+        """
+        try:
+            async for match in retreive_entry_by_query(db, MATRIX_COLLECTION_NAME, {'ginc': ginc}, 1):
+                return TravelMatrix.decode(match)
+            return None
+        except Exception as ex:
+            logger.error(f'follow_track_db.get_route_matrix, error:{ex}')
+            return None
+
+    @staticmethod
+    async def add_eta_history(db: AsyncIOMotorDatabase, records: List[dict]) -> bool:
+        """
+        insert a batch of ETA history records. A batch that is inserted again after a failure keeps the _id of its
+        records, so the records that were already written are reported as duplicates and skipped
+        """
+        try:
+            result = await persist_entries(db, HISTORY_COLLECTION_NAME, records)
+            if result is not None:
+                return True
+            return False
+        except BulkWriteError as ex:
+            if all(error.get('code') == DUPLICATE_KEY_ERROR for error in ex.details.get('writeErrors', [])):
+                return True
+            logger.error(f'eta_history_db.add_eta_history, error:{ex}')
+            return False
+        except Exception as ex:
+            logger.error(f'eta_history_db.add_eta_history, error:{ex}')
+            return False
+
+    @staticmethod
+    async def stream_eta_history(db: AsyncIOMotorDatabase, ginc: str) -> AsyncIterator[dict]:
+        """
+        iterate over the ETA history records of a route, oldest first
+        """
+        async for record in stream_entries(db, HISTORY_COLLECTION_NAME, {'ginc': ginc}, {'_id': 0},
+                                           sort=[('bucket', 1), ('at', 1)]):
+            yield record
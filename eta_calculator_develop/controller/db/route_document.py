@@ -0,0 +1,374 @@
+"""Route storage format"""
+from datetime import datetime, timezone
+from operator import attrgetter
+from typing import Dict, List, Optional, Tuple, Type, TypeVar
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+from model.delivery import Address
+from model.travel_data import StopSummary, Summary, TravelData
+
+
+SCHEMA_VERSION = 2
+
+# order of the fields of an entry of the address table
+ADDRESS_FIELDS = ('address', 'city', 'district', 'house_number', 'zip_code', 'telephone_number')
+address_values = attrgetter(*ADDRESS_FIELDS)
+
+# the TravelData fields that can be read one by one (see RouteDocument.projection)
+ROUTE_FIELDS = ('personal_id', 'ginc', 'version', 'summary', 'stops', 'delivered_stops')
+
+Model = TypeVar('Model', bound=BaseModel)
+
+# used by construct, which sets the slots of BaseModel directly
+new_object = object.__new__
+set_slot = object.__setattr__
+FIELDS_SET = {model: set(model.model_fields) for model in (Address, Summary, StopSummary, TravelData)}
+
+
+class RouteDocument():
+    """
+    The `RouteDocument` class converts a `TravelData` into the compact document stored in the database and back.
+
+    The stored document (schema_version 2) keeps every address once:
+    - `addresses` is the address table of the route: each entry is the list of the ADDRESS_FIELDS values followed
+      by the latitude and the longitude.
+    - `summary` and the stops reference the table by index (`from`, `to`) and use short field names.
+    - times are epoch seconds, and the fields with a default value (not delivered, no message, ...) are omitted.
+    - the stops keep `gsin`, used by the indexes and by the partial updates.
+    - `recalc` is the state of the ETA recalculation: status, requested_at, at (the last recalculation) and
+      routed_at (the last recalculation by TomTom).
+
+    Documents without schema_version are stored in the original format, a plain dump of TravelData; they are still
+    readable and are converted the next time they are written.
+
+    Both directions trust the data: `encode` reads the attributes of the models directly, without `model_dump`,
+    and `decode` skips the validation. Validation happens only where data enters the service, in the API.
+    See benchmarks/bench_route_codec.py.
+    """
+
+    @staticmethod
+    def encode(travel_data: TravelData) -> Dict:
+        """
+        Converts a route into the document to be stored.
+        """
+        table = AddressTable()
+        summary = travel_data.summary
+        return {
+            'schema_version': SCHEMA_VERSION,
+            'personal_id': travel_data.personal_id,
+            'ginc': travel_data.ginc,
+            'version': travel_data.version or 0,
+            'summary': {
+                'mode': summary.travelMode,
+                'from': table.index(summary.startAddress, summary.startLatitude, summary.startLongitude),
+                'to': table.index(summary.endAddress, summary.endLatitude, summary.endLongitude),
+                **RouteDocument.encode_summary_update(summary)
+            },
+            'stops': [RouteDocument.encode_stop(stop, table) for stop in travel_data.stops],
+            'delivered_stops': [RouteDocument.encode_stop(stop, table) for stop in travel_data.delivered_stops],
+            'addresses': table.entries,
+            'recalc': RouteDocument.encode_recalculation(travel_data)
+        }
+
+    @staticmethod
+    def encode_recalculation(travel_data: TravelData) -> Dict:
+        """
+        Returns the stored state of the ETA recalculation of a route.
+        """
+        return {
+            'status': travel_data.recalculation_status,
+            'requested_at': to_epoch(travel_data.recalculation_requested_at),
+            'at': to_epoch(travel_data.recalculated_at),
+            'routed_at': to_epoch(travel_data.routed_at)
+        }
+
+    @staticmethod
+    def encode_summary_update(summary: Summary) -> Dict:
+        """
+        Returns the stored fields of the summary that a recalculation can change.
+        """
+        return {
+            'len': summary.lengthInMeters,
+            'time': summary.travelTimeInSeconds,
+            'delay': summary.trafficDelayInSeconds,
+            'tlen': summary.trafficLengthInMeters,
+            'dep': to_epoch(summary.departureTime),
+            'arr': to_epoch(summary.arrivalTime)
+        }
+
+    @staticmethod
+    def encode_address(address: Address, latitude: Optional[float], longitude: Optional[float]) -> List:
+        """
+        Returns the entry of the address table for an address and its position.
+        """
+        return [*address_values(address), latitude, longitude]
+
+    @staticmethod
+    def encode_stop(stop: StopSummary, table: 'AddressTable') -> Dict:
+        """
+        Converts a stop, adding its addresses to the address table of the route.
+        """
+        document = RouteDocument.encode_stop_update(stop)
+        document['gsin'] = stop.gsin
+        document['from'] = table.index(stop.departureAddress, stop.departureLatitude, stop.departureLongitude)
+        document['to'] = table.index(stop.arrivalAddress, stop.arrivalLatitude, stop.arrivalLongitude)
+        for key in ('dep', 'arr', 'dlv_at'):
+            if document[key] is None:
+                del document[key]
+        if not document['dlv']:
+            del document['dlv']
+            if not document['dlv_gsins']:
+                del document['dlv_gsins']
+        if stop.gsins and stop.gsins != [stop.gsin]:
+            document['gsins'] = stop.gsins
+        if stop.telephone_numbers:
+            document['tel'] = stop.telephone_numbers
+        if stop.message_sent:
+            document['msg'] = True
+        if stop.message_report:
+            document['msg_report'] = stop.message_report
+        return document
+
+    @staticmethod
+    def encode_stop_update(stop: StopSummary) -> Dict:
+        """
+        Returns the stored fields of a stop that a recalculation or a delivery can change. Every key is present,
+        so that the result can replace the stored values.
+        """
+        return {
+            'len': stop.lengthInMeters,
+            'time': stop.travelTimeInSeconds,
+            'delay': stop.trafficDelayInSeconds,
+            'tlen': stop.trafficLengthInMeters,
+            'dep': to_epoch(stop.departureTime),
+            'arr': to_epoch(stop.arrivalTime),
+            'dlv_at': to_epoch(stop.delivered_at),
+            'dlv': bool(stop.delivered),
+            'dlv_gsins': [[gsin, to_epoch(delivered_at)] for gsin, delivered_at in (stop.delivered_gsins or {}).items()]
+        }
+
+    @staticmethod
+    def decode(document: Dict) -> TravelData:
+        """
+        Converts a stored document, in either format, into a route.
+
+        The documents in the current format were written by `encode`, so the models are built without validation
+        (see `construct`); the stops of a route share the Address instances of its address table, which must be
+        treated as read-only. The documents in the original format are validated.
+        """
+        if document.get('schema_version') != SCHEMA_VERSION:
+            return TravelData.model_validate({**document, 'schema_version': document.get('schema_version')})
+
+        addresses = decode_addresses(document['addresses'])
+        return construct(TravelData, {
+            'personal_id': document['personal_id'],
+            'ginc': document['ginc'],
+            'summary': RouteDocument.decode_summary(document['summary'], addresses),
+            'stops': RouteDocument.decode_stops(document['stops'], addresses),
+            'delivered_stops': RouteDocument.decode_stops(document['delivered_stops'], addresses),
+            'version': document.get('version', 0),
+            **RouteDocument.decode_recalculation(document),
+            'schema_version': SCHEMA_VERSION,
+            'waypoint_order': None
+        })
+
+    @staticmethod
+    def decode_summary(summary: Dict, addresses: List[Tuple[Address, Optional[float], Optional[float]]]) -> Summary:
+        """
+        Converts the stored summary, given the decoded address table of its route.
+        """
+        start_address, start_latitude, start_longitude = addresses[summary['from']]
+        end_address, end_latitude, end_longitude = addresses[summary['to']]
+        return construct(Summary, {
+            'travelMode': summary.get('mode', ''),
+            'lengthInMeters': summary.get('len', 0),
+            'travelTimeInSeconds': summary.get('time', 0),
+            'trafficDelayInSeconds': summary.get('delay', 0),
+            'trafficLengthInMeters': summary.get('tlen', 0),
+            'startAddress': start_address,
+            'startLatitude': start_latitude,
+            'startLongitude': start_longitude,
+            'endAddress': end_address,
+            'endLatitude': end_latitude,
+            'endLongitude': end_longitude,
+            'departureTime': from_epoch(summary.get('dep')),
+            'arrivalTime': from_epoch(summary.get('arr'))
+        })
+
+    @staticmethod
+    def decode_stops(documents: List[Dict],
+                     addresses: List[Tuple[Address, Optional[float], Optional[float]]]) -> List[StopSummary]:
+        """
+        Converts a list of stored stops, given the decoded address table of their route.
+
+        This is the bulk of the work of `decode`, so the loop avoids the calls it can: the epoch times are converted
+        in place and the stops are built with `construct`.
+        """
+        fromtimestamp = datetime.fromtimestamp
+        utc = timezone.utc
+        stops = []
+        for document in documents:
+            get = document.get
+            gsin = document['gsin']
+            departure_address, departure_latitude, departure_longitude = addresses[document['from']]
+            arrival_address, arrival_latitude, arrival_longitude = addresses[document['to']]
+            departure_time, arrival_time, delivered_at = get('dep'), get('arr'), get('dlv_at')
+            delivered_gsins = get('dlv_gsins')
+            stops.append(construct(StopSummary, {
+                'gsin': gsin,
+                'gsins': get('gsins') or [gsin],
+                'telephone_numbers': get('tel') or {},
+                'lengthInMeters': get('len', 0),
+                'travelTimeInSeconds': get('time', 0),
+                'trafficDelayInSeconds': get('delay', 0),
+                'trafficLengthInMeters': get('tlen', 0),
+                'departureAddress': departure_address,
+                'departureLatitude': departure_latitude,
+                'departureLongitude': departure_longitude,
+                'arrivalAddress': arrival_address,
+                'arrivalLatitude': arrival_latitude,
+                'arrivalLongitude': arrival_longitude,
+                'departureTime': None if departure_time is None else fromtimestamp(departure_time, utc),
+                'arrivalTime': None if arrival_time is None else fromtimestamp(arrival_time, utc),
+                'delivered_at': None if delivered_at is None else fromtimestamp(delivered_at, utc),
+                'delivered': get('dlv', False),
+                'delivered_gsins': {delivered_gsin: fromtimestamp(delivered_gsin_at, utc)
+                                    for delivered_gsin, delivered_gsin_at in delivered_gsins} if delivered_gsins else {},
+                'message_sent': get('msg', False),
+                'message_report': get('msg_report', '')
+            }))
+        return stops
+
+    @staticmethod
+    def decode_recalculation(document: Dict) -> Dict:
+        """
+        Returns the state of the ETA recalculation of a stored route, as TravelData fields. For the routes stored before
+        it was recorded the recalculation is done.
+        """
+        recalculation = document.get('recalc') or {}
+        return {
+            'recalculation_status': recalculation.get('status', 'done'),
+            'recalculation_requested_at': from_epoch(recalculation.get('requested_at')),
+            'recalculated_at': from_epoch(recalculation.get('at')),
+            'routed_at': from_epoch(recalculation.get('routed_at'))
+        }
+
+    @staticmethod
+    def mark_delivered_pipeline(gsin: str, delivered_at: datetime) -> List[Dict]:
+        """
+        Returns the update pipeline recording the delivery of `gsin` in the stored stop that contains it, as
+        `TomTomRecalculation.update_route` does in memory: the gsin is added to the delivered gsins of the stop,
+        and the stop is marked as delivered once all its gsins are. The stop is left in `stops`, the recalculation
+        moves it to `delivered_stops`. The ETA recalculation of the route is marked as pending.
+        """
+        delivered_at = to_epoch(delivered_at)
+        stop_gsins = {'$ifNull': ['$$stop.gsins', ['$$stop.gsin']]}
+        delivered_gsins = {'$map': {'input': {'$ifNull': ['$$stop.dlv_gsins', []]}, 'as': 'delivery',
+                                    'in': {'$arrayElemAt': ['$$delivery', 0]}}}
+        all_delivered = {'$setIsSubset': [stop_gsins, {'$concatArrays': [delivered_gsins, {'$literal': [gsin]}]}]}
+        return [{'$set': {
+            'stops': {'$map': {'input': '$stops', 'as': 'stop', 'in': {'$cond': [
+                {'$and': [{'$in': [{'$literal': gsin}, stop_gsins]},
+                          {'$not': [{'$in': [{'$literal': gsin}, delivered_gsins]}]},
+                          {'$not': [{'$ifNull': ['$$stop.dlv', False]}]}]},
+                {'$mergeObjects': ['$$stop', {
+                    'dlv_gsins': {'$concatArrays': [{'$ifNull': ['$$stop.dlv_gsins', []]},
+                                                    {'$literal': [[gsin, delivered_at]]}]},
+                    'dlv': all_delivered,
+                    'dlv_at': {'$cond': [all_delivered, {'$literal': delivered_at}, '$$stop.dlv_at']}
+                }]},
+                '$$stop'
+            ]}}},
+            'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]},
+            'recalc': {'$mergeObjects': ['$recalc', {'$literal': {
+                'status': 'pending', 'requested_at': to_epoch(datetime.now(timezone.utc))}}]}
+        }}]
+
+    @staticmethod
+    def projection(fields: List[str]) -> Dict[str, int]:
+        """
+        Returns the projection reading only what is needed to rebuild the TravelData fields `fields`,
+        in either format (see ROUTE_FIELDS).
+        """
+        projection = {'_id': 0, 'schema_version': 1}
+        for field in fields:
+            projection[field] = 1
+            if field in ('summary', 'stops', 'delivered_stops'):
+                projection['addresses'] = 1
+        return projection
+
+    @staticmethod
+    def decode_fields(document: Dict, fields: List[str]) -> Dict:
+        """
+        Converts the TravelData fields `fields` of a document read with `projection(fields)`
+        into JSON-compatible values, in the shape of the API.
+        """
+        if document.get('schema_version') != SCHEMA_VERSION:
+            return jsonable_encoder({field: document.get(field) for field in fields})
+
+        addresses = decode_addresses(document.get('addresses', ()))
+        result = {}
+        for field in fields:
+            if field == 'summary':
+                result[field] = RouteDocument.decode_summary(document[field], addresses).model_dump(mode='json')
+            elif field in ('stops', 'delivered_stops'):
+                result[field] = [stop.model_dump(mode='json')
+                                 for stop in RouteDocument.decode_stops(document[field], addresses)]
+            else:
+                result[field] = document.get(field)
+        return result
+
+
+class AddressTable():
+    '''Collects the distinct (address, latitude, longitude) of a route while it is encoded.'''
+
+    def __init__(self) -> None:
+        self.entries: List[list] = []
+        self._indexes: Dict[Tuple, int] = {}
+
+    def index(self, address: Address, latitude: Optional[float], longitude: Optional[float]) -> int:
+        entry = RouteDocument.encode_address(address, latitude, longitude)
+        key = tuple(entry)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self.entries)
+            self.entries.append(entry)
+        return index
+
+
+def construct(model: Type[Model], values: Dict) -> Model:
+    '''
+    Builds a model from trusted values, like `model_construct` but without its per-field checks:
+    `values` must contain every field of the model, in the order they are declared.
+    '''
+    instance = new_object(model)
+    set_slot(instance, '__dict__', values)
+    set_slot(instance, '__pydantic_fields_set__', FIELDS_SET[model].copy())
+    set_slot(instance, '__pydantic_extra__', None)
+    set_slot(instance, '__pydantic_private__', None)
+    return instance
+
+
+def decode_addresses(entries: List[list]) -> List[Tuple[Address, Optional[float], Optional[float]]]:
+    '''Converts the stored address table; the entries are unpacked in the order of ADDRESS_FIELDS.'''
+    return [(construct(Address, {'address': address, 'city': city, 'district': district, 'house_number': house_number,
+                                 'zip_code': zip_code, 'telephone_number': telephone_number}), latitude, longitude)
+            for address, city, district, house_number, zip_code, telephone_number, latitude, longitude in entries]
+
+
+def to_epoch(value: Optional[datetime]):
+    '''Converts a datetime into epoch seconds; naive datetimes are UTC, as they were for the BSON encoder.'''
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    epoch = value.timestamp()
+    return int(epoch) if epoch.is_integer() else epoch
+
+
+def from_epoch(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc)
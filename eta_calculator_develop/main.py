@@ -6,18 +6,55 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from loguru import logger
 
-from api.eta_calculation_api import eta_api_router
+from api.eta_calculation_api import eta_api_router, recalculation_worker, traffic_refresher
+from controller.db.db_setting import ROUTE_DBSettings, create_route_client
+from controller.db.eta_calculator_db import EtaDb
 from settings import Settings
+from utils.eta_history import eta_history
+from utils.http_client import tomtom_client
+from utils.zip_delay import zip_delays
 
 import time
 import asyncio
 
 settings = Settings()
 api_prefix = f'/api/v{settings.api_version_str}'
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''this code is executed before the application starts taking requests
+    and right after it finishes handling requests, it covers the whole application lifespan'''
+    db_settings = ROUTE_DBSettings()
+    route_client = create_route_client(db_settings)
+    app.state.route_db = route_client[db_settings.database]
+    try:
+        await route_client.admin.command('ping')
+        await EtaDb.ensure_indexes(app.state.route_db)
+    except Exception as ex:
+        logger.error(f"the database is not reachable: {ex}")
+    eta_history.start(app.state.route_db)
+    tomtom_client.open()
+    zip_delays.load()
+    zip_delays_watcher = asyncio.create_task(zip_delays.watch())
+    traffic_refresher.start(app.state.route_db)
+    logger.info("the application is ready.")
+    yield
+    zip_delays_watcher.cancel()
+    traffic_refresher.close()
+    await recalculation_worker.close()
+    await tomtom_client.close()
+    await eta_history.close()
+    route_client.close()
+    logger.info("the application shut down.")
+    logger.info("Done. Bye.")
+
+
 app = FastAPI(title=settings.project_name,
               version=settings.api_version_str,
               description="Component for eta calculation",
-              openapi_url=f"{api_prefix}/openapi.json")
+              openapi_url=f"{api_prefix}/openapi.json",
+              lifespan=lifespan)
 
 app.include_router(eta_api_router, prefix=api_prefix)
 
@@ -32,14 +69,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    '''this code is executed before the application starts taking requests
-    and right after it finishes handling requests, it covers the whole application lifespan'''
-    logger.info("the application is ready.")
-    yield
-    logger.info("the application shut down.")
-    logger.info("Done. Bye.")
 
 if __name__ == "__main__":
     uvicorn.run("main:app",
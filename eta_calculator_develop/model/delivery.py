@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List
 from pydantic import BaseModel
 
 
@@ -17,3 +17,11 @@ class Delivery(BaseModel):
     '''This class contains an instance of the Address class and a gsin'''
     gsin: str
     address: Address
+
+
+class DeliveryStop(Delivery):
+    '''This class extends Delivery and groups every gsin delivered to the same physical address into a single stop.
+    gsin is the first gsin of the stop, gsins contains all of them and telephone_numbers keeps the telephone number of
+    the gsins whose recipient differs from the one in address.'''
+    gsins: List[str] = []
+    telephone_numbers: Dict[str, str] = {}
@@ -1,3 +1,4 @@
+from typing import Any, List, Optional
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -8,3 +9,20 @@ class DeliveryMessage(BaseModel):
     ginc: str
     gsin: str
     delivery_time: datetime
+
+
+class DeliveryUpdateResult(BaseModel):
+    '''This class contains the outcome of a single confirmation of a bulk update. status_code and detail are the ones
+    that /route_update/ would have returned for the same confirmation.'''
+    ginc: str
+    gsin: str
+    status_code: int
+    detail: Optional[Any] = None
+
+
+class BulkDeliveryReport(BaseModel):
+    '''This class aggregates the outcome of every confirmation of a bulk update, in the order they were sent.'''
+    results: List[DeliveryUpdateResult]
+    routes: int
+    delivered: int
+    failed: int
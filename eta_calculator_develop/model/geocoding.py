@@ -0,0 +1,18 @@
+from typing import List, Optional, Tuple
+from pydantic import BaseModel
+
+
+class GeocodingFailure(BaseModel):
+    '''This class describes an address that could not be geocoded: its position in the uploaded route, its gsin,
+    the full address sent to the geocoder and the reason of the failure.'''
+    index: int
+    gsin: str
+    address: str
+    reason: str
+
+
+class GeocodingReport(BaseModel):
+    '''This class contains the result of the geocoding stage. The coordinates keep the order of the input addresses
+    and are None for the addresses listed in failures.'''
+    coordinates: List[Optional[Tuple[str, str]]]
+    failures: List[GeocodingFailure] = []
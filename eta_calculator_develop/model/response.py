@@ -19,3 +19,17 @@ class Response(BaseModel):
     ginc: str
     personal_id: str
     delivery: List[Delivery_ETA]
+    recalculation_status: Optional[str] = None
+    recalculated_at: Optional[datetime] = None
+
+
+class RecalculationStatus(BaseModel):
+    '''This class contains the state of the ETA recalculation of a route: pending while the ETAs are being recalculated
+    after a delivery, done or failed. recalculated_at is the time of the last successful recalculation,
+    routed_at the time of the last one made by TomTom.'''
+    ginc: str
+    version: int
+    recalculation_status: str
+    recalculation_requested_at: Optional[datetime] = None
+    recalculated_at: Optional[datetime] = None
+    routed_at: Optional[datetime] = None
@@ -1,6 +1,6 @@
 from datetime import datetime
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
 from model.delivery import Address
 
 
@@ -27,6 +27,8 @@ class StopSummary(BaseModel):
     and delivery status.'''
 
     gsin: Optional[str] = ""
+    gsins: Optional[List[str]] = []
+    telephone_numbers: Optional[Dict[str, str]] = {}
     lengthInMeters: Optional[int] = 0
     travelTimeInSeconds: Optional[int] = 0
     trafficDelayInSeconds: Optional[int] = 0
@@ -41,6 +43,7 @@ class StopSummary(BaseModel):
     arrivalTime: Optional[datetime] = None
     delivered_at: Optional[datetime] = None
     delivered: Optional[bool] = False
+    delivered_gsins: Optional[Dict[str, datetime]] = {}
     message_sent: Optional[bool] = False
     message_report: Optional[str] = ""
 
@@ -52,3 +55,36 @@ class TravelData(BaseModel):
     summary: Summary
     stops: List[StopSummary]
     delivered_stops: List[StopSummary]
+    # incremented by every write of the route, used for the compare-and-swap updates
+    version: Optional[int] = 0
+    # ETA recalculation: pending once a delivery is recorded, until the background worker stores the new ETAs
+    # (done) or gives up (failed)
+    recalculation_status: Optional[str] = "done"
+    recalculation_requested_at: Optional[datetime] = None
+    recalculated_at: Optional[datetime] = None
+    # last time the ETAs were calculated by TomTom; in between they are extrapolated (see utils/eta_extrapolation.py)
+    routed_at: Optional[datetime] = None
+    # storage format of the document the route was read from (see controller/db/route_document.py); never returned
+    schema_version: Optional[int] = Field(default=None, exclude=True)
+    # provided index of the arrival waypoint of each stop, as optimized by TomTom; never stored nor returned
+    waypoint_order: Optional[List[int]] = Field(default=None, exclude=True)
+
+    def mongo(self) -> dict:
+        '''Returns the document stored in the database for this route (see controller/db/route_document.py).'''
+        from controller.db.route_document import RouteDocument
+        return RouteDocument.encode(self)
+
+    def update_summary_endpoints(self) -> None:
+        '''Sets the start of the summary to the departure of the first stop left and its end to the arrival of the
+        last one, addresses and coordinates together.'''
+        first, last = self.stops[0], self.stops[-1]
+        self.summary.startAddress = first.departureAddress
+        self.summary.startLatitude, self.summary.startLongitude = first.departureLatitude, first.departureLongitude
+        self.summary.endAddress = last.arrivalAddress
+        self.summary.endLatitude, self.summary.endLongitude = last.arrivalLatitude, last.arrivalLongitude
+
+    @classmethod
+    def parse_mongo(cls, document: dict) -> 'TravelData':
+        '''Builds the route from a document read from the database, without validating it again.'''
+        from controller.db.route_document import RouteDocument
+        return RouteDocument.decode(document)
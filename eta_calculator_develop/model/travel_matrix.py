@@ -0,0 +1,67 @@
+"""Travel-time matrix of a route"""
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+from bson import Binary
+
+
+# decimal digits of the coordinates identifying a waypoint
+TRAVEL_MATRIX_PRECISION = 6
+
+
+class TravelMatrix():
+    """
+    The travel times and lengths between every pair of waypoints of a route, as two flat row-major arrays
+    of unsigned 32-bit integers: the cell (origin, destination) is at `origin * size + destination`.
+    """
+
+    def __init__(self, points: List[Tuple[float, float]], durations: array, lengths: array) -> None:
+        self.points = points
+        self.size = len(points)
+        self.durations = durations
+        self.lengths = lengths
+        self._indexes = {point_key(latitude, longitude): index for index, (latitude, longitude) in enumerate(points)}
+
+    def index(self, latitude: float, longitude: float) -> Optional[int]:
+        """
+        Returns the index of the waypoint at (latitude, longitude), or None if it is not part of the matrix.
+        """
+        return self._indexes.get(point_key(latitude, longitude))
+
+    def duration(self, origin: int, destination: int) -> int:
+        return self.durations[origin * self.size + destination]
+
+    def length(self, origin: int, destination: int) -> int:
+        return self.lengths[origin * self.size + destination]
+
+    def encode(self) -> Dict:
+        """
+        Returns the stored form of the matrix: the waypoints and the little-endian bytes of the two arrays.
+        """
+        return {
+            'points': [list(point) for point in self.points],
+            'durations': Binary(little_endian(self.durations).tobytes()),
+            'lengths': Binary(little_endian(self.lengths).tobytes())
+        }
+
+    @staticmethod
+    def decode(document: Dict) -> 'TravelMatrix':
+        """
+        Builds the matrix from its stored form.
+        """
+        durations, lengths = array('I'), array('I')
+        durations.frombytes(document['durations'])
+        lengths.frombytes(document['lengths'])
+        return TravelMatrix([tuple(point) for point in document['points']],
+                            little_endian(durations), little_endian(lengths))
+
+
+def point_key(latitude: float, longitude: float) -> Tuple[float, float]:
+    return round(float(latitude), TRAVEL_MATRIX_PRECISION), round(float(longitude), TRAVEL_MATRIX_PRECISION)
+
+
+def little_endian(values: array) -> array:
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
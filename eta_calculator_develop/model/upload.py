@@ -0,0 +1,27 @@
+from typing import Any, List, Optional
+from pydantic import BaseModel
+
+
+class CsvRowError(BaseModel):
+    '''This class describes a row of an uploaded CSV file that could not be converted into a Delivery,
+    with its line number (the header is line 1) and the reason of the failure.'''
+    line: int
+    reason: str
+
+
+class RouteUploadResult(BaseModel):
+    '''This class contains the outcome of a single route of a batch upload. status_code and detail are the ones
+    that /upload_route_file/ would have returned for the same file.'''
+    file_name: str
+    ginc: Optional[str] = None
+    status_code: int
+    detail: Optional[Any] = None
+    stops: Optional[int] = 0
+
+
+class BatchUploadReport(BaseModel):
+    '''This class aggregates the outcome of every route of a batch upload.'''
+    routes: List[RouteUploadResult]
+    created: int
+    failed: int
+    elapsed_seconds: float
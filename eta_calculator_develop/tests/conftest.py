@@ -0,0 +1,107 @@
+"""The modules are imported as in the application, from eta_calculator_develop"""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock import aggregate
+from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.delivery import Address  # noqa: E402
+from model.travel_data import StopSummary, Summary, TravelData  # noqa: E402
+
+
+DEPARTURE = datetime(2024, 5, 2, 8, 0, tzinfo=timezone.utc)
+
+
+def address(number: int) -> Address:
+    return Address(address=f"Via Roma {number}", city="Pisa", district="PI", house_number=str(number),
+                   zip_code="56121", telephone_number="3933332345678")
+
+
+def route(ginc: str = 'R1', stops: int = 3) -> TravelData:
+    '''a route of `stops` stops of one gsin each (G0, G1, ...), 5 minutes apart, from Via Roma 0'''
+    addresses = [address(i) for i in range(stops + 1)]
+    coordinates = [(43.7 + i * 0.001, 10.4 + i * 0.001) for i in range(stops + 1)]
+    stop_summaries = [
+        StopSummary(gsin=f"G{i}", gsins=[f"G{i}"], lengthInMeters=1000, travelTimeInSeconds=300,
+                    departureAddress=addresses[i], departureLatitude=coordinates[i][0],
+                    departureLongitude=coordinates[i][1], arrivalAddress=addresses[i + 1],
+                    arrivalLatitude=coordinates[i + 1][0], arrivalLongitude=coordinates[i + 1][1],
+                    departureTime=DEPARTURE + timedelta(minutes=5 * i),
+                    arrivalTime=DEPARTURE + timedelta(minutes=5 * (i + 1)))
+        for i in range(stops)]
+    summary = Summary(travelMode="car", startAddress=addresses[0], startLatitude=coordinates[0][0],
+                      startLongitude=coordinates[0][1], endAddress=addresses[-1], endLatitude=coordinates[-1][0],
+                      endLongitude=coordinates[-1][1], departureTime=DEPARTURE,
+                      arrivalTime=DEPARTURE + timedelta(minutes=5 * stops))
+    return TravelData(personal_id="2024_05_02", ginc=ginc, summary=summary, stops=stop_summaries, delivered_stops=[])
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()['eta']
+
+
+# expression operators used by the update pipelines of controller/db that mongomock does not implement yet, or,
+# for $not, evaluates as a literal when its argument is given as a one-element list. mongomock also returns the
+# arrays of expressions (['$$stop.gsin']) as they are, instead of evaluating their elements
+def merge_objects(parser, value):
+    result = {}
+    for expression in value if isinstance(value, list) else [value]:
+        if isinstance(expression, dict) and not any(key.startswith('$') for key in expression):
+            # fields whose value is missing are left out, as MongoDB does
+            parsed = {key: parser._parse_or_nothing(field) for key, field in expression.items()}
+            parsed = {key: field for key, field in parsed.items() if field is not aggregate.NOTHING}
+        else:
+            parsed = parser._parse_or_nothing(expression)
+        if isinstance(parsed, dict):
+            result.update(parsed)
+    return result
+
+
+def index_of_array(parser, value):
+    array, searched = parser.parse(value[0]), parser.parse(value[1])
+    if array is None:
+        return None
+    return next((index for index, item in enumerate(array) if item == searched), -1)
+
+
+def set_is_subset(parser, value):
+    subset, superset = parser.parse(value[0]), parser.parse(value[1])
+    return all(item in superset for item in subset)
+
+
+def not_(parser, value):
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    return not parser._parse_to_bool(value)
+
+
+EXPRESSION_OPERATORS = {'$mergeObjects': merge_objects, '$indexOfArray': index_of_array,
+                        '$setIsSubset': set_is_subset, '$not': not_}
+mongomock_parse = aggregate._Parser.parse
+
+
+def parse(parser, expression):
+    if isinstance(expression, list):
+        return [parser.parse(item) for item in expression]
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, value = next(iter(expression.items()))
+        if operator in EXPRESSION_OPERATORS:
+            return EXPRESSION_OPERATORS[operator](parser, value)
+    return mongomock_parse(parser, expression)
+
+
+aggregate._Parser.parse = parse
+
+
+# controller/db/basic_ops.py reads and writes through `with_options`, which mongomock_motor leaves synchronous
+def with_options(collection, *args, **kwargs):
+    return AsyncMongoMockCollection(collection.database,
+                                    collection._AsyncMongoMockCollection__collection.with_options(*args, **kwargs))
+
+
+AsyncMongoMockCollection.with_options = with_options
@@ -0,0 +1,136 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from conftest import DEPARTURE, address, route
+from controller.db.eta_calculator_db import COLLECTION_NAME, EtaDb, RouteVersionConflict
+from model.travel_data import TravelData
+
+
+async def stored_route(db, ginc: str) -> TravelData:
+    return TravelData.parse_mongo(await db[COLLECTION_NAME].find_one({'ginc': ginc}))
+
+
+def test_partial_update_moves_the_summary_start_to_the_first_stop_left(db):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        travel_data = await stored_route(db, 'R1')
+
+        # as TomTomRecalculation.update_route does once the first stop is delivered
+        delivered = travel_data.stops.pop(0)
+        delivered.delivered = True
+        delivered.delivered_at = delivered.arrivalTime
+        travel_data.delivered_stops.append(delivered)
+        travel_data.summary.startAddress = travel_data.stops[0].departureAddress
+        travel_data.summary.startLatitude = travel_data.stops[0].departureLatitude
+        travel_data.summary.startLongitude = travel_data.stops[0].departureLongitude
+        travel_data.summary.departureTime = travel_data.stops[0].departureTime
+        assert await EtaDb.update_route_partial(db, travel_data, [delivered.gsin])
+
+        stored = await stored_route(db, 'R1')
+        assert stored.summary.startAddress == address(1)
+        assert (stored.summary.startLatitude, stored.summary.startLongitude) == (43.701, 10.401)
+        assert stored.summary.endAddress == address(3)
+        assert [stop.gsin for stop in stored.stops] == ['G1', 'G2']
+        assert [stop.gsin for stop in stored.delivered_stops] == ['G0']
+        assert stored.delivered_stops[0].delivered
+        assert stored.version == travel_data.version == 1
+        document = await db[COLLECTION_NAME].find_one({'ginc': 'R1'})
+        assert len(document['addresses']) == 4
+
+    asyncio.run(run())
+
+
+def test_partial_update_adds_a_new_summary_start_to_the_address_table(db):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        travel_data = await stored_route(db, 'R1')
+
+        travel_data.summary.startAddress = address(9)
+        travel_data.summary.startLatitude, travel_data.summary.startLongitude = 43.8, 10.5
+        assert await EtaDb.update_route_partial(db, travel_data, [])
+        assert await EtaDb.update_route_partial(db, travel_data, [])
+
+        stored = await stored_route(db, 'R1')
+        assert stored.summary.startAddress == address(9)
+        assert (stored.summary.startLatitude, stored.summary.startLongitude) == (43.8, 10.5)
+        assert stored.summary.endAddress == address(3)
+        assert stored.stops[0].departureAddress == address(0)
+        document = await db[COLLECTION_NAME].find_one({'ginc': 'R1'})
+        assert len(document['addresses']) == 5
+
+    asyncio.run(run())
+
+
+def test_partial_update_of_a_stale_version_is_a_conflict(db):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        first = await stored_route(db, 'R1')
+        second = await stored_route(db, 'R1')
+
+        first.stops[0].trafficDelayInSeconds = 60
+        assert await EtaDb.update_route_partial(db, first, [])
+        second.stops[0].trafficDelayInSeconds = 120
+        with pytest.raises(RouteVersionConflict):
+            await EtaDb.update_route_partial(db, second, [])
+
+        stored = await stored_route(db, 'R1')
+        assert stored.version == 1
+        assert stored.stops[0].trafficDelayInSeconds == 60
+
+    asyncio.run(run())
+
+
+def test_mark_delivered_records_the_delivery_and_requests_a_recalculation(db):
+    async def run():
+        travel_data = route('R1')
+        travel_data.stops[1].gsins = ['G1', 'G9']
+        assert await EtaDb.add_new_object(db, travel_data)
+        delivered_at = DEPARTURE + timedelta(minutes=4)
+
+        marked = await EtaDb.mark_delivered(db, 'R1', 'G0', delivered_at)
+        assert marked.stops[0].delivered
+        assert marked.stops[0].delivered_at == delivered_at
+        assert marked.stops[0].delivered_gsins == {'G0': delivered_at}
+        assert marked.version == 1
+        assert marked.recalculation_status == 'pending'
+        # the stop stays in stops until the recalculation moves it
+        assert [stop.gsin for stop in marked.stops] == ['G0', 'G1', 'G2']
+
+        # a stop of several gsins is delivered once all of them are
+        marked = await EtaDb.mark_delivered(db, 'R1', 'G9', delivered_at)
+        assert not marked.stops[1].delivered
+        assert marked.stops[1].delivered_gsins == {'G9': delivered_at}
+        marked = await EtaDb.mark_delivered(db, 'R1', 'G1', delivered_at)
+        assert marked.stops[1].delivered
+        assert marked.version == 3
+
+        assert await EtaDb.mark_delivered(db, 'R1', 'G0', delivered_at) is None
+        assert await EtaDb.mark_delivered(db, 'R1', 'G7', delivered_at) is None
+        assert (await stored_route(db, 'R1')).version == 3
+
+    asyncio.run(run())
+
+
+def test_partial_update_after_mark_delivered_moves_the_delivered_stop(db):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        delivered_at = DEPARTURE + timedelta(minutes=4)
+        travel_data = await EtaDb.mark_delivered(db, 'R1', 'G0', delivered_at)
+
+        travel_data.delivered_stops.append(travel_data.stops.pop(0))
+        travel_data.stops[0].trafficDelayInSeconds = 30
+        travel_data.recalculation_status = 'done'
+        assert await EtaDb.update_route_partial(db, travel_data, ['G0'])
+
+        stored = await stored_route(db, 'R1')
+        assert [stop.gsin for stop in stored.stops] == ['G1', 'G2']
+        assert [stop.gsin for stop in stored.delivered_stops] == ['G0']
+        assert stored.delivered_stops[0].delivered_at == delivered_at
+        assert stored.delivered_stops[0].delivered_gsins == {'G0': delivered_at}
+        assert stored.stops[0].trafficDelayInSeconds == 30
+        assert stored.recalculation_status == 'done'
+        assert stored.version == 2
+
+    asyncio.run(run())
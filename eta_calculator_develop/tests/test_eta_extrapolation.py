@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import route
+from model.travel_data import TravelData
+from utils.eta_extrapolation import EtaExtrapolator
+
+
+def delivered_route(delay_seconds: float = 60, routed_minutes_ago: float = 5) -> TravelData:
+    '''a route whose first stop (G0) has just been delivered `delay_seconds` after its ETA'''
+    travel_data = route('R1')
+    delivered = travel_data.stops.pop(0)
+    delivered.delivered = True
+    delivered.delivered_at = delivered.arrivalTime + timedelta(seconds=delay_seconds)
+    travel_data.delivered_stops.append(delivered)
+    travel_data.routed_at = datetime.now(timezone.utc) - timedelta(minutes=routed_minutes_ago)
+    return travel_data
+
+
+PLANNED_GSINS = ['G0', 'G1', 'G2']
+
+
+def test_the_etas_are_shifted_by_the_deviation():
+    extrapolator = EtaExtrapolator(enabled=True, max_deviation_seconds=300, max_age_seconds=1800)
+    travel_data = delivered_route(delay_seconds=60)
+    arrivals = [stop.arrivalTime for stop in travel_data.stops]
+
+    assert extrapolator.extrapolate(travel_data, PLANNED_GSINS, ['G0'])
+    assert [stop.arrivalTime for stop in travel_data.stops] == [arrival + timedelta(seconds=60)
+                                                               for arrival in arrivals]
+    assert travel_data.summary.startAddress == travel_data.stops[0].departureAddress
+    assert (travel_data.summary.startLatitude, travel_data.summary.startLongitude) == (
+        travel_data.stops[0].departureLatitude, travel_data.stops[0].departureLongitude)
+    assert travel_data.summary.arrivalTime == travel_data.stops[-1].arrivalTime
+    assert travel_data.summary.travelTimeInSeconds == 600
+    assert extrapolator.stats() == {'enabled': True, 'avoided': 1, 'recalculations': {}}
+
+
+@pytest.mark.parametrize('reason, travel_data, delivered_gsins', [
+    ('not_routed', delivered_route().model_copy(update={'routed_at': None}), ['G0']),
+    ('age', delivered_route(routed_minutes_ago=31), ['G0']),
+    ('order', delivered_route(), ['G1']),
+    ('no_eta', delivered_route(), ['G0']),
+    ('deviation', delivered_route(delay_seconds=-301), ['G0']),
+])
+def test_the_route_is_recalculated_when(reason, travel_data, delivered_gsins):
+    extrapolator = EtaExtrapolator(enabled=True, max_deviation_seconds=300, max_age_seconds=1800)
+    if reason == 'no_eta':
+        travel_data.delivered_stops[0].arrivalTime = None
+    arrivals = [stop.arrivalTime for stop in travel_data.stops]
+
+    assert not extrapolator.extrapolate(travel_data, PLANNED_GSINS, delivered_gsins)
+    assert [stop.arrivalTime for stop in travel_data.stops] == arrivals
+    assert extrapolator.stats() == {'enabled': True, 'avoided': 0, 'recalculations': {reason: 1}}
+
+
+def test_nothing_is_extrapolated_without_deliveries():
+    extrapolator = EtaExtrapolator(enabled=True)
+    travel_data = delivered_route()
+
+    assert not extrapolator.extrapolate(travel_data, PLANNED_GSINS[1:], [])
+    assert extrapolator.stats() == {'enabled': True, 'avoided': 0, 'recalculations': {}}
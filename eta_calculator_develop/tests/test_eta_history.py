@@ -0,0 +1,73 @@
+import asyncio
+
+import utils.eta_history as eta_history_module
+from conftest import route
+from controller.db.eta_calculator_db import HISTORY_COLLECTION_NAME
+from utils.eta_history import EtaHistoryWriter
+
+
+def test_a_failed_flush_keeps_the_records_for_the_next_one(db, monkeypatch):
+    async def run():
+        writer = EtaHistoryWriter(enabled=True, batch_size=2)
+        writer.start(db)
+        add_eta_history = eta_history_module.EtaDb.add_eta_history
+
+        async def failing(db, records):
+            return False
+
+        monkeypatch.setattr(eta_history_module.EtaDb, 'add_eta_history', failing)
+        for _ in range(3):
+            writer.record(route('R1'), 'delivery')
+        assert await writer.flush() == 0
+        assert writer.stats()['failed_flushes'] == 1
+        assert writer.stats()['buffered'] == 3
+
+        monkeypatch.setattr(eta_history_module.EtaDb, 'add_eta_history', add_eta_history)
+        await writer.close()
+        assert writer.stats()['written'] == 3
+        assert writer.stats()['buffered'] == 0
+        assert await db[HISTORY_COLLECTION_NAME].count_documents({'ginc': 'R1'}) == 3
+
+    asyncio.run(run())
+
+
+def test_close_stops_the_background_writer_before_the_last_flush(db):
+    async def run():
+        writer = EtaHistoryWriter(enabled=True, flush_interval=60)
+        writer.start(db)
+        task = writer._task
+        writer.record(route('R1'), 'upload')
+
+        await writer.close()
+        assert task.cancelled()
+        assert writer.stats()['written'] == 1
+        record = await db[HISTORY_COLLECTION_NAME].find_one({'ginc': 'R1'}, {'_id': 0})
+        assert record['source'] == 'upload'
+        assert [gsin for gsin, _ in record['etas']] == ['G0', 'G1', 'G2']
+
+    asyncio.run(run())
+
+
+def test_a_full_buffer_drops_the_oldest_records(db, monkeypatch):
+    async def run():
+        writer = EtaHistoryWriter(enabled=True, batch_size=2, max_buffer=3)
+        writer.start(db)
+
+        async def failing(db, records):
+            # recalculations keep recording while the insert is in flight
+            writer.record(route('R5'), 'delivery')
+            writer.record(route('R6'), 'delivery')
+            return False
+
+        monkeypatch.setattr(eta_history_module.EtaDb, 'add_eta_history', failing)
+        for ginc in ('R1', 'R2', 'R3', 'R4'):
+            writer.record(route(ginc), 'delivery')
+        assert [record['ginc'] for record in writer._buffer] == ['R2', 'R3', 'R4']
+        assert writer.stats()['dropped'] == 1
+
+        # the failed batch goes back in front of the buffer, and is the oldest to be dropped
+        assert await writer.flush() == 0
+        assert [record['ginc'] for record in writer._buffer] == ['R4', 'R5', 'R6']
+        assert writer.stats()['dropped'] == 3
+
+    asyncio.run(run())
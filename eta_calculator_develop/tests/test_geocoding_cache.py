@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from utils.geocoding_cache import GeocodingCache
+from utils.geocoding_service import AsyncGeocoder
+
+
+class Location:
+    latitude = 43.7
+    longitude = 10.4
+
+
+class Geolocator:
+    def __init__(self) -> None:
+        self.calls = []
+
+    def geocode(self, address, **kwargs):
+        self.calls.append(address)
+        time.sleep(0.01)
+        return Location()
+
+
+def test_normalized_addresses_share_an_entry(tmp_path):
+    cache = GeocodingCache(str(tmp_path / 'cache.sqlite3'))
+
+    async def scenario():
+        assert await cache.get('Via Roma 1, Pisa') is None
+        await cache.set('Via Roma 1, Pisa', ('43.7', '10.4'))
+        return await cache.get('  via ROMA 1 pisa ')
+
+    assert asyncio.run(scenario()) == ('43.7', '10.4')
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'expired': 0, 'memory_entries': 1}
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    asyncio.run(GeocodingCache(path).set('Via Roma 1', ('43.7', '10.4')))
+
+    assert asyncio.run(GeocodingCache(path).get('Via Roma 1')) == ('43.7', '10.4')
+
+
+def test_expired_entries_are_removed(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    asyncio.run(GeocodingCache(path).set('Via Roma 1', ('43.7', '10.4')))
+    cache = GeocodingCache(path, ttl_seconds=-1)
+
+    assert asyncio.run(cache.get('Via Roma 1')) is None
+    assert cache.expired == 1
+    assert asyncio.run(GeocodingCache(path).get('Via Roma 1')) is None
+
+
+def test_memory_only_cache():
+    cache = GeocodingCache('')
+
+    async def scenario():
+        await cache.set('Via Roma 1', ('43.7', '10.4'))
+        return await cache.get('Via Roma 1')
+
+    assert asyncio.run(scenario()) == ('43.7', '10.4')
+
+
+def test_concurrent_requests_of_an_address_geocode_it_once(tmp_path):
+    cache = GeocodingCache(str(tmp_path / 'cache.sqlite3'))
+    geocoder = AsyncGeocoder(rate_per_second=1000, burst=10, cache=cache)
+    geocoder._geolocator = geolocator = Geolocator()
+
+    async def scenario():
+        first = await asyncio.gather(*[geocoder.geocode('Via Roma 1') for _ in range(5)])
+        return first, await geocoder.geocode('Via Roma 1')
+
+    first, again = asyncio.run(scenario())
+    assert first == [('43.7', '10.4')] * 5
+    assert again == ('43.7', '10.4')
+    assert geolocator.calls == ['Via Roma 1']
+
+
+def test_a_withdrawn_prefetch_still_serves_the_requests_that_joined_it():
+    geocoder = AsyncGeocoder(rate_per_second=1000, burst=10, cache=GeocodingCache(''))
+    geocoder._geolocator = geolocator = Geolocator()
+
+    async def scenario():
+        geocoder.prefetch('Via Roma 1')
+        geocoder.prefetch('Via Roma 2')
+        joined = asyncio.ensure_future(geocoder.geocode('Via Roma 1'))
+        await asyncio.sleep(0)
+        geocoder.cancel_prefetch(['Via Roma 1', 'Via Roma 2'])
+        return await joined
+
+    assert asyncio.run(scenario()) == ('43.7', '10.4')
+    assert geolocator.calls.count('Via Roma 1') == 1
@@ -0,0 +1,122 @@
+import asyncio
+import io
+
+import pytest
+
+import utils.preprocess_service as preprocess_service
+from utils.geocoding_cache import GeocodingCache
+from utils.geocoding_service import AsyncGeocoder
+from utils.preprocess_service import CsvLimitError, CsvValidationError, PreProcess
+
+HEADER = 'id,indirizzo,città,provincia,numero civico,cap,telefono\n'
+
+
+class RouteFile:
+    def __init__(self, content: bytes, filename: str = '2024_12_20_id001.csv') -> None:
+        self._content = io.BytesIO(content)
+        self.filename = filename
+
+    async def read(self, size: int) -> bytes:
+        return self._content.read(size)
+
+
+def stream(content: bytes, **limits):
+    async def collect():
+        errors = []
+        deliveries = [delivery async for delivery in PreProcess.stream_csv(RouteFile(content), errors, **limits)]
+        return deliveries, errors
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture(params=[1, 5, 64 * 1024])
+def chunk_size(request, monkeypatch):
+    monkeypatch.setattr(preprocess_service, 'CSV_CHUNK_SIZE', request.param)
+    return request.param
+
+
+def test_quoted_fields_can_span_lines(chunk_size):
+    content = (HEADER
+               + 'g0,"Via Roma 1\nscala B",Pisa,PI,1,56121,39\n'
+               + 'g1,"Via ""Il Ponte"", 2",Pisa,PI,2,56121,39\r\n'
+               + '\n'
+               + 'g2,Via Verdi,Pisa,PI,3,56121,39').encode()
+
+    deliveries, errors = stream(content)
+
+    assert errors == []
+    assert [delivery.gsin for delivery in deliveries] == ['g0', 'g1', 'g2']
+    assert deliveries[0].address.address == 'Via Roma 1\nscala B'
+    assert deliveries[1].address.address == 'Via "Il Ponte", 2'
+
+
+def test_invalid_rows_are_reported_with_their_line(chunk_size):
+    content = (HEADER
+               + 'g0,"Via Roma 1\nscala B",Pisa,PI,1,56121,39\n'
+               + 'g1,Via Verdi,Pisa\n'
+               + ',Via Dante,Pisa,PI,4,56121,39\n').encode()
+
+    deliveries, errors = stream(content)
+
+    assert [delivery.gsin for delivery in deliveries] == ['g0']
+    assert [(error.line, error.reason) for error in errors] == [
+        (4, 'expected 7 columns, found 3'), (5, "the column 'id' is empty")]
+
+
+def test_text_that_is_not_utf8_is_an_error(chunk_size):
+    content = (('﻿' + HEADER + 'g0,Via Città,Pisa,PI,1,56121,39\n').encode()
+               + b'g1,Via \xe0 Roma,Pisa,PI,2,56121,39\n')
+
+    deliveries, errors = stream(content)
+
+    assert [delivery.address.address for delivery in deliveries] == ['Via Città']
+    assert [error.line for error in errors] == [3]
+    assert 'not valid UTF-8' in errors[0].reason
+
+
+def test_limits():
+    rows = (HEADER + 'g0,Via Roma,Pisa,PI,1,56121,39\n' * 3).encode()
+
+    with pytest.raises(CsvLimitError):
+        stream(rows, max_rows=2)
+    with pytest.raises(CsvLimitError):
+        stream(rows, max_bytes=len(rows) - 1)
+    assert len(stream(rows, max_rows=3, max_bytes=len(rows))[0]) == 3
+
+
+def test_digest_csv_groups_the_deliveries_by_address(monkeypatch):
+    monkeypatch.setattr(preprocess_service.geocoder, 'prefetch', lambda address: None)
+    content = (HEADER
+               + 'depot,Via Roma,Pisa,PI,1,56121,39\n'
+               + 'g1,Via Verdi,Pisa,PI,3,56121,39\n'
+               + 'g2,Via Verdi,Pisa,PI,3,56121,39\n').encode()
+
+    stops, date, trace_id = asyncio.run(PreProcess.digest_csv(RouteFile(content)))
+
+    assert (date, trace_id) == ('2024_12_20', 'id001')
+    assert [stop.gsins for stop in stops] == [['depot'], ['g1', 'g2']]
+
+    with pytest.raises(CsvValidationError):
+        asyncio.run(PreProcess.digest_csv(RouteFile((HEADER + 'g1,Via Verdi\n').encode())))
+
+
+def test_digest_csv_cancels_the_prefetches_of_a_rejected_file(monkeypatch):
+    geocoder = AsyncGeocoder(cache=GeocodingCache(''))
+    monkeypatch.setattr(preprocess_service, 'geocoder', geocoder)
+
+    async def resolve(address):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(geocoder, '_resolve', resolve)
+    content = (HEADER
+               + 'g0,Via Roma,Pisa,PI,1,56121,39\n'
+               + 'g1,Via Verdi\n').encode()
+
+    async def run():
+        with pytest.raises(CsvValidationError):
+            await PreProcess.digest_csv(RouteFile(content))
+        prefetches = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.wait(prefetches, timeout=1)
+        return [prefetch.cancelled() for prefetch in prefetches], geocoder.stats()['inflight']
+
+    assert asyncio.run(run()) == ([True], 0)
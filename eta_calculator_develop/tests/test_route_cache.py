@@ -0,0 +1,62 @@
+import asyncio
+
+from conftest import route
+from controller.db.eta_calculator_db import EtaDb
+from controller.db.route_document import RouteDocument
+from utils.route_cache import RouteCache
+
+
+def test_every_hit_returns_a_route_of_its_own():
+    cache = RouteCache(max_size=2, ttl_seconds=60)
+    cache.set('R1', RouteDocument.encode(route('R1')), cache.generation())
+
+    first = cache.get('R1')
+    first.stops.pop(0)
+    first.summary.startAddress.address = 'Via Verdi 1'
+
+    second = cache.get('R1')
+    assert [stop.gsin for stop in second.stops] == ['G0', 'G1', 'G2']
+    assert second.summary.startAddress.address == 'Via Roma 0'
+    assert cache.stats()['hits'] == 2
+
+
+def test_a_document_read_before_an_invalidation_is_not_stored():
+    cache = RouteCache(max_size=2, ttl_seconds=60)
+    generation = cache.generation()
+    cache.invalidate('R1')
+
+    cache.set('R1', RouteDocument.encode(route('R1')), generation)
+    cache.set('R2', RouteDocument.encode(route('R2')), generation)
+
+    assert cache.get('R1') is None
+    assert cache.get('R2') is not None
+    assert cache.stats()['stale_fills'] == 1
+
+    cache.set('R1', RouteDocument.encode(route('R1')), cache.generation())
+    assert cache.get('R1') is not None
+
+
+def test_the_invalidations_of_forgotten_routes_still_discard_stale_fills():
+    cache = RouteCache(max_size=1, ttl_seconds=60)
+    generation = cache.generation()
+    cache.invalidate('R1')
+    cache.invalidate('R2')
+
+    cache.set('R1', RouteDocument.encode(route('R1')), generation)
+    assert cache.get('R1') is None
+
+
+def test_get_route_object_reads_the_route_again_after_a_write(db):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        travel_data = (await EtaDb.get_route_object(db, 'R1'))[0]
+        travel_data.stops[0].trafficDelayInSeconds = 60
+        cached = (await EtaDb.get_route_object(db, 'R1'))[0]
+        assert cached.stops[0].trafficDelayInSeconds == 0
+
+        assert await EtaDb.update_route_partial(db, travel_data, [])
+        return (await EtaDb.get_route_object(db, 'R1'))[0]
+
+    stored = asyncio.run(run())
+    assert stored.stops[0].trafficDelayInSeconds == 60
+    assert stored.version == 1
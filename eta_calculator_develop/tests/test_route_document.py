@@ -0,0 +1,74 @@
+from datetime import timedelta
+
+import bson
+from bson import CodecOptions
+
+from conftest import DEPARTURE, route
+from controller.db.route_document import SCHEMA_VERSION, RouteDocument
+from model.travel_data import TravelData
+
+
+def delivered_route() -> TravelData:
+    travel_data = route('R1', stops=4)
+    first = travel_data.stops.pop(0)
+    first.delivered = True
+    first.delivered_at = first.arrivalTime
+    first.delivered_gsins = {first.gsin: first.arrivalTime}
+    first.message_sent = True
+    first.message_report = 'sent'
+    travel_data.delivered_stops.append(first)
+    travel_data.stops[0].gsins = ['G1', 'G5']
+    travel_data.stops[0].telephone_numbers = {'G1': '3931111111', 'G5': '3932222222'}
+    travel_data.stops[0].delivered_gsins = {'G5': DEPARTURE + timedelta(minutes=7)}
+    travel_data.stops[1].arrivalTime = None
+    travel_data.version = 4
+    travel_data.recalculation_status = 'pending'
+    travel_data.recalculation_requested_at = DEPARTURE + timedelta(minutes=7, microseconds=500000)
+    travel_data.routed_at = DEPARTURE
+    return travel_data
+
+
+def test_encode_then_decode_returns_the_same_route():
+    travel_data = delivered_route()
+    document = RouteDocument.encode(travel_data)
+
+    assert document['schema_version'] == SCHEMA_VERSION
+    # every address is stored once
+    assert len(document['addresses']) == 5
+    decoded = RouteDocument.decode(document)
+    assert decoded.model_dump() == travel_data.model_dump()
+
+
+def test_round_trip_through_bson():
+    travel_data = delivered_route()
+    encoded = bson.encode(RouteDocument.encode(travel_data))
+
+    decoded = RouteDocument.decode(bson.decode(encoded, CodecOptions(tz_aware=True)))
+    assert decoded.model_dump() == travel_data.model_dump()
+
+
+def test_default_values_are_not_stored():
+    document = RouteDocument.encode(route('R1'))
+
+    stop = document['stops'][0]
+    for key in ('dlv', 'dlv_gsins', 'dlv_at', 'gsins', 'tel', 'msg', 'msg_report'):
+        assert key not in stop
+
+
+def test_documents_in_the_original_format_are_still_readable():
+    travel_data = delivered_route()
+    document = travel_data.model_dump()
+
+    decoded = RouteDocument.decode(document)
+    assert decoded.schema_version is None
+    assert decoded.model_dump() == travel_data.model_dump()
+
+
+def test_decode_fields_matches_the_api_shape():
+    travel_data = delivered_route()
+    fields = ['ginc', 'summary', 'stops']
+    projection = RouteDocument.projection(fields)
+    document = RouteDocument.encode(travel_data)
+
+    projected = {key: value for key, value in document.items() if key in projection}
+    assert RouteDocument.decode_fields(projected, fields) == travel_data.model_dump(mode='json', include=set(fields))
@@ -0,0 +1,102 @@
+import asyncio
+import random
+from datetime import timedelta
+
+import pytest
+
+import api.eta_calculation_api as eta_calculation_api
+from conftest import DEPARTURE, address, route
+from controller.db.eta_calculator_db import COLLECTION_NAME, EtaDb
+from model.travel_data import TravelData
+from utils.route_optimizer import RouteOptimizer
+from utils.travel_matrix import TravelMatrixService
+
+
+def asymmetric_costs(size: int, seed: int) -> list:
+    generator = random.Random(seed)
+    return [[0 if origin == destination else generator.randint(1, 100) for destination in range(size)]
+            for origin in range(size)]
+
+
+def assert_valid_path(path: list, size: int) -> None:
+    assert path[0] == 0
+    assert path[-1] == size - 1
+    assert sorted(path) == list(range(size))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sequence_keeps_the_endpoints_and_does_not_worsen_the_seed(seed):
+    costs = asymmetric_costs(9, seed)
+
+    path, stats = RouteOptimizer.sequence(costs, time_budget=5)
+
+    assert_valid_path(path, len(costs))
+    assert stats['cost'] == RouteOptimizer.path_cost(path, costs)
+    assert stats['cost'] <= stats['seed_cost'] == RouteOptimizer.path_cost(RouteOptimizer.nearest_neighbour(costs),
+                                                                            costs)
+    assert stats['converged']
+
+
+@pytest.mark.parametrize('move', [RouteOptimizer.two_opt, RouteOptimizer.or_opt])
+@pytest.mark.parametrize('seed', range(5))
+def test_each_local_search_pass_keeps_a_valid_path_and_lowers_its_cost(move, seed):
+    costs = asymmetric_costs(9, seed)
+    path = list(range(len(costs)))
+    cost = RouteOptimizer.path_cost(path, costs)
+
+    while move(path, costs, RouteOptimizer.neighbours(costs), deadline=float('inf')):
+        assert_valid_path(path, len(costs))
+        assert RouteOptimizer.path_cost(path, costs) < cost
+        cost = RouteOptimizer.path_cost(path, costs)
+
+
+def test_the_asymmetric_cost_of_a_reversed_section_is_counted():
+    # going 1 -> 2 is cheap, 2 -> 1 is expensive: reversing the middle of 0, 1, 2, 3 must not look like a gain
+    costs = [[0, 1, 50, 50],
+             [50, 0, 1, 50],
+             [50, 100, 0, 1],
+             [50, 50, 50, 0]]
+    path = [0, 1, 2, 3]
+
+    assert RouteOptimizer.two_opt(path, costs, RouteOptimizer.neighbours(costs), deadline=float('inf')) == 0
+    assert path == [0, 1, 2, 3]
+
+
+def scrambled_route(ginc: str) -> TravelData:
+    '''a route along a line whose stops are visited out of order: 0 -> 3 -> 1 -> 4 -> 2 -> 5'''
+    travel_data = route(ginc, stops=5)
+    start = travel_data.stops[0]
+    stops = [travel_data.stops[index] for index in (2, 0, 3, 1, 4)]
+    for previous, stop in zip([None] + stops, stops):
+        if previous is None:
+            stop.departureAddress = start.departureAddress
+            stop.departureLatitude, stop.departureLongitude = start.departureLatitude, start.departureLongitude
+        else:
+            stop.departureAddress = previous.arrivalAddress
+            stop.departureLatitude, stop.departureLongitude = previous.arrivalLatitude, previous.arrivalLongitude
+    travel_data.stops = stops
+    return travel_data
+
+
+def test_resequence_route_stores_the_new_order_of_the_stops(db, monkeypatch):
+    monkeypatch.setattr(eta_calculation_api, 'travel_matrices', TravelMatrixService(backend='haversine'))
+
+    async def run():
+        assert await EtaDb.add_new_object(db, scrambled_route('R1'))
+        # delivered out of order: the remaining stops still leave from Via Roma 0
+        await EtaDb.mark_delivered(db, 'R1', 'G0', DEPARTURE + timedelta(minutes=4))
+
+        await eta_calculation_api.resequence_route('R1', db)
+
+        stored = TravelData.parse_mongo(await db[COLLECTION_NAME].find_one({'ginc': 'R1'}))
+        assert [stop.gsin for stop in stored.delivered_stops] == ['G0']
+        assert [stop.gsin for stop in stored.stops] == ['G1', 'G2', 'G3', 'G4']
+        assert stored.stops[0].departureAddress == address(0)
+        for previous, stop in zip(stored.stops, stored.stops[1:]):
+            assert stop.departureAddress == previous.arrivalAddress
+            assert stop.departureTime >= previous.arrivalTime
+        assert stored.summary.startAddress == stored.stops[0].departureAddress
+        assert stored.recalculation_status == 'done'
+        assert stored.version == 2
+
+    asyncio.run(run())
@@ -0,0 +1,192 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import api.eta_calculation_api as eta_calculation_api
+from conftest import DEPARTURE, route
+from controller.db.eta_calculator_db import EtaDb
+from model.device_message import DeliveryMessage
+from utils.route_update_queue import RouteUpdateQueue
+
+
+def delivery(ginc: str, gsin: str) -> DeliveryMessage:
+    return DeliveryMessage(ginc=ginc, gsin=gsin, delivery_time=DEPARTURE)
+
+
+def test_confirmations_arriving_during_a_batch_are_merged_into_the_next_one():
+    async def run():
+        batches = []
+        release = asyncio.Event()
+
+        async def process(db, ginc, updates):
+            gsins = [update.gsin for update in updates]
+            batches.append((ginc, gsins))
+            if len(batches) == 1:
+                await release.wait()
+            return gsins
+
+        queue = RouteUpdateQueue(process)
+        first = asyncio.create_task(queue.submit(None, delivery('R1', 'G0')))
+        await asyncio.sleep(0)
+        others = [asyncio.create_task(queue.submit(None, delivery('R1', gsin))) for gsin in ('G1', 'G2')]
+        other_route = asyncio.create_task(queue.submit(None, delivery('R2', 'G0')))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await first == ['G0']
+        assert await asyncio.gather(*others) == [['G1', 'G2'], ['G1', 'G2']]
+        assert await other_route == ['G0']
+        assert batches == [('R1', ['G0']), ('R2', ['G0']), ('R1', ['G1', 'G2'])]
+        assert queue.stats() == {'submitted': 4, 'batches': 3, 'active_routes': 0}
+
+    asyncio.run(run())
+
+
+def test_a_recalculation_joins_the_confirmations_waiting_for_the_route():
+    async def run():
+        batches = []
+        release = asyncio.Event()
+
+        async def process(db, ginc, updates):
+            gsins = [update.gsin for update in updates]
+            batches.append(gsins)
+            if len(batches) == 1:
+                await release.wait()
+            return gsins
+
+        queue = RouteUpdateQueue(process)
+        recalculation = asyncio.create_task(queue.recalculate(None, 'R1'))
+        await asyncio.sleep(0)
+        confirmation = asyncio.create_task(queue.submit(None, delivery('R1', 'G1')))
+        next_recalculation = asyncio.create_task(queue.recalculate(None, 'R1'))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await recalculation == []
+        assert await confirmation == await next_recalculation == ['G1']
+        assert batches == [[], ['G1']]
+        assert queue.stats() == {'submitted': 1, 'batches': 2, 'active_routes': 0}
+
+    asyncio.run(run())
+
+
+def test_the_source_of_a_recalculation_is_passed_on_for_its_batch():
+    async def run():
+        batches = []
+
+        async def process(db, ginc, updates, source='delivery'):
+            batches.append(([update.gsin for update in updates], source))
+            await asyncio.sleep(0)
+
+        queue = RouteUpdateQueue(process)
+        await asyncio.gather(queue.recalculate(None, 'R1', source='traffic'),
+                             queue.recalculate(None, 'R1', source='traffic'))
+        await queue.recalculate(None, 'R1')
+
+        assert batches == [([], 'traffic'), ([], 'delivery')]
+
+    asyncio.run(run())
+
+
+def test_a_batch_including_a_delivery_is_a_delivery_batch():
+    async def run():
+        batches = []
+        release = asyncio.Event()
+
+        async def process(db, ginc, updates, source='delivery'):
+            batches.append(([update.gsin for update in updates], source))
+            if len(batches) == 1:
+                await release.wait()
+
+        queue = RouteUpdateQueue(process)
+        first = asyncio.create_task(queue.recalculate(None, 'R1', source='traffic'))
+        await asyncio.sleep(0)
+        # queued behind the first batch: a traffic refresh, then a confirmation and a background recalculation
+        waiting = [asyncio.create_task(queue.recalculate(None, 'R1', source='traffic')),
+                   asyncio.create_task(queue.submit(None, delivery('R1', 'G0')))]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiting)
+        await asyncio.gather(queue.recalculate(None, 'R1', source='traffic'), queue.recalculate(None, 'R1'))
+
+        assert batches == [([], 'traffic'), (['G0'], 'delivery'), ([], 'delivery')]
+
+    asyncio.run(run())
+
+
+def test_the_error_of_a_batch_is_raised_to_all_its_callers():
+    async def run():
+        async def process(db, ginc, updates):
+            await asyncio.sleep(0)
+            raise ValueError(ginc)
+
+        queue = RouteUpdateQueue(process)
+        results = await asyncio.gather(queue.submit_many(None, [delivery('R1', 'G0'), delivery('R1', 'G1')]),
+                                       queue.submit(None, delivery('R1', 'G2')), return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError, ValueError]
+        assert queue.stats()['active_routes'] == 0
+
+    asyncio.run(run())
+
+
+class FakeRecalculation():
+    '''replaces the TomTom recalculation: the route starts from the departure of its first stop left'''
+
+    def __init__(self) -> None:
+        self.calls = []
+        # called once, during the next recalculation, to simulate a concurrent write of the route
+        self.concurrent_write = None
+
+    async def order_travel_data(self, travel_data, matrix=None):
+        self.calls.append([stop.gsin for stop in travel_data.stops])
+        if self.concurrent_write is not None:
+            concurrent_write, self.concurrent_write = self.concurrent_write, None
+            await concurrent_write()
+        first = travel_data.stops[0]
+        travel_data.summary.startAddress = first.departureAddress
+        travel_data.summary.startLatitude = first.departureLatitude
+        travel_data.summary.startLongitude = first.departureLongitude
+        return travel_data
+
+
+@pytest.fixture
+def recalculation(monkeypatch):
+    fake = FakeRecalculation()
+    monkeypatch.setattr(eta_calculation_api.TomTomRecalculation, 'order_travel_data', fake.order_travel_data)
+    return fake
+
+
+def test_recalculation_moves_the_stops_marked_delivered(db, recalculation):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        await EtaDb.mark_delivered(db, 'R1', 'G0', DEPARTURE + timedelta(minutes=4))
+
+        await eta_calculation_api.recalculate_route(db, 'R1')
+
+        stored = (await EtaDb.get_route_object(db, 'R1'))[0]
+        assert recalculation.calls == [['G1', 'G2']]
+        assert [stop.gsin for stop in stored.stops] == ['G1', 'G2']
+        assert [stop.gsin for stop in stored.delivered_stops] == ['G0']
+        assert stored.summary.startAddress == stored.stops[0].departureAddress
+        assert stored.recalculation_status == 'done'
+        assert stored.version == 2
+
+    asyncio.run(run())
+
+
+def test_a_concurrent_write_restarts_the_update_from_the_new_version(db, recalculation):
+    async def run():
+        assert await EtaDb.add_new_object(db, route('R1'))
+        recalculation.concurrent_write = lambda: EtaDb.mark_delivered(db, 'R1', 'G1', DEPARTURE)
+
+        updated = await eta_calculation_api.apply_route_updates(db, 'R1', [delivery('R1', 'G0')])
+
+        # the first attempt was computed on version 0 and discarded
+        assert recalculation.calls == [['G1', 'G2'], ['G2']]
+        stored = (await EtaDb.get_route_object(db, 'R1'))[0]
+        assert [stop.gsin for stop in stored.stops] == ['G2']
+        assert [stop.gsin for stop in stored.delivered_stops] == ['G0', 'G1']
+        assert stored.version == updated.version == 2
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import api.eta_calculation_api as eta_calculation_api
+from conftest import route
+from controller.db.eta_calculator_db import EtaDb
+from utils.http_client import tomtom_client
+from utils.traffic_refresh import TrafficRefresher
+
+
+def today_route(ginc: str, routed_minutes_ago=None):
+    travel_data = route(ginc)
+    travel_data.personal_id = datetime.now().strftime("%Y_%m_%d")
+    if routed_minutes_ago is not None:
+        travel_data.routed_at = datetime.now(timezone.utc) - timedelta(minutes=routed_minutes_ago)
+    return travel_data
+
+
+def refresher(db, **options) -> TrafficRefresher:
+    traffic_refresher = TrafficRefresher(eta_calculation_api.refresh_route, enabled=False, min_age_seconds=600,
+                                         batch_interval_seconds=0, batch_jitter_seconds=0, **options)
+    traffic_refresher._db = db
+    return traffic_refresher
+
+
+def test_the_least_recently_routed_routes_are_refreshed_first(db):
+    async def run():
+        for ginc, routed_minutes_ago in (('R1', 20), ('R2', None), ('R3', 60), ('R4', 1)):
+            assert await EtaDb.add_new_object(db, today_route(ginc, routed_minutes_ago))
+        date = datetime.now().strftime("%Y_%m_%d")
+
+        assert await refresher(db, max_routes=2).routes_to_refresh(date) == ['R2', 'R3']
+
+        traffic_refresher = refresher(db, max_routes=10)
+        assert await traffic_refresher.routes_to_refresh(date) == ['R2', 'R3', 'R1']
+        assert traffic_refresher.stats()['skipped'] == 1
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def tomtom(monkeypatch):
+    '''answers every TomTom request with 200, and replaces the recalculation with one making a single request'''
+    monkeypatch.setattr(tomtom_client, '_client', httpx.AsyncClient(
+        base_url='https://tomtom.test', transport=httpx.MockTransport(lambda request: httpx.Response(200))))
+
+    async def order_travel_data(travel_data, matrix=None):
+        await tomtom_client.get('/routing')
+        travel_data.routed_at = datetime.now(timezone.utc)
+        return travel_data
+
+    monkeypatch.setattr(eta_calculation_api.TomTomRecalculation, 'order_travel_data', order_travel_data)
+
+
+def test_only_the_tomtom_requests_of_the_refresh_are_counted(db, tomtom):
+    async def run():
+        for ginc in ('R1', 'R2'):
+            assert await EtaDb.add_new_object(db, today_route(ginc))
+        traffic_refresher = refresher(db)
+
+        async def other_requests():
+            for _ in range(3):
+                await tomtom_client.get('/upload')
+                await asyncio.sleep(0)
+
+        requests_before = tomtom_client.stats()['requests']
+        refreshed, _ = await asyncio.gather(traffic_refresher.refresh(), other_requests())
+
+        assert refreshed == 2
+        assert tomtom_client.stats()['requests'] - requests_before == 5
+        stats = traffic_refresher.stats()
+        assert stats['tomtom_requests'] == stats['last_run_tomtom_requests'] == 2
+
+    asyncio.run(run())
@@ -0,0 +1,37 @@
+from array import array
+
+from conftest import address, route
+from model.travel_matrix import TravelMatrix
+from utils.tomtom_recalculation import TomTomRecalculation
+from utils.travel_matrix import route_points
+
+
+def test_route_points_are_the_distinct_waypoints_in_route_order():
+    travel_data = route('R1')
+
+    assert route_points(travel_data) == [(43.7 + i * 0.001, 10.4 + i * 0.001) for i in range(4)]
+
+
+def test_route_points_include_the_departure_left_by_a_delivery_out_of_order():
+    travel_data = route('R1')
+    # G1 delivered first: the stops left start with G0, still departing from Via Roma 0
+    travel_data.delivered_stops.append(travel_data.stops.pop(1))
+
+    points = route_points(travel_data)
+    assert (travel_data.stops[0].departureLatitude, travel_data.stops[0].departureLongitude) in points
+    assert len(points) == 4
+
+
+def test_the_matrix_recalculation_moves_the_start_of_the_summary_with_its_coordinates():
+    travel_data = route('R1')
+    points = route_points(travel_data)
+    size = len(points)
+    matrix = TravelMatrix(points, array('I', [60] * size * size), array('I', [500] * size * size))
+    travel_data.delivered_stops.append(travel_data.stops.pop(0))
+
+    assert TomTomRecalculation.matrix_travel_data(travel_data, matrix) is travel_data
+    summary = travel_data.summary
+    assert summary.startAddress == address(1)
+    assert (summary.startLatitude, summary.startLongitude) == points[1]
+    assert (summary.endAddress, summary.endLatitude, summary.endLongitude) == (address(3), *points[3])
+    assert summary.travelTimeInSeconds == 120
@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+from utils.zip_delay import ZipDelayTable
+
+
+@pytest.mark.parametrize('content', ['{"56121": null}', '{"56121": [60]}', '["56121"]', '{"56121": "a"}', '{'])
+def test_an_invalid_file_keeps_the_previous_table(tmp_path, content):
+    path = tmp_path / 'zip_code.json'
+    path.write_text(json.dumps({'56121': 60, '56122': '30'}))
+    table = ZipDelayTable(str(path), default_delay=100)
+    assert table.load()
+
+    path.write_text(content)
+    assert not table.load()
+    assert table.delays == {'56121': 60, '56122': 30}
+    assert table.stats()['reloads'] == 1
+
+
+def test_a_missing_file_gives_an_empty_table(tmp_path):
+    table = ZipDelayTable(str(tmp_path / 'zip_code.json'), default_delay=100)
+
+    assert table.delays == {}
+    assert not table.reload_if_changed()
@@ -0,0 +1,127 @@
+"""Local ETA extrapolation"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from loguru import logger
+
+from model.travel_data import StopSummary, TravelData
+
+
+ETA_EXTRAPOLATION_ENABLED = os.environ.get('ETA_EXTRAPOLATION_ENABLED', 'true').lower() == 'true'
+ETA_EXTRAPOLATION_MAX_DEVIATION_SECONDS = int(os.environ.get('ETA_EXTRAPOLATION_MAX_DEVIATION_SECONDS', 300))
+ETA_EXTRAPOLATION_MAX_AGE_SECONDS = int(os.environ.get('ETA_EXTRAPOLATION_MAX_AGE_SECONDS', 1800))
+
+
+class EtaExtrapolator():
+    """
+    The `EtaExtrapolator` class updates the ETAs of a route after a delivery without calling TomTom, as long as the
+    courier is close to the last route calculated by TomTom.
+
+    The stored times of the remaining stops already include the travel time and traffic delay of every leg and the
+    ZIP code delays; a delivery confirmed `deviation` seconds after (or before) the ETA of its stop shifts all of them
+    by the same amount, together with the arrival time of the summary. The summary distance and times become the sums
+    of the remaining legs.
+
+    Key Responsibilities:
+    1. **Drift Detection**: Measure the deviation between the delivery time and the ETA of the last delivered stop.
+    2. **Thresholds**: Ask for a TomTom recalculation when the deviation exceeds `max_deviation_seconds`, when the
+       route was calculated by TomTom more than `max_age_seconds` ago, or when the stops were not delivered in the
+       planned order.
+    3. **Local Update**: Otherwise shift the remaining ETAs in place.
+    4. **Counters**: Count local updates (TomTom calls avoided) and recalculations by reason.
+    """
+
+    def __init__(self,
+                 enabled: bool = ETA_EXTRAPOLATION_ENABLED,
+                 max_deviation_seconds: int = ETA_EXTRAPOLATION_MAX_DEVIATION_SECONDS,
+                 max_age_seconds: int = ETA_EXTRAPOLATION_MAX_AGE_SECONDS) -> None:
+        self.enabled = enabled
+        self.max_deviation_seconds = max_deviation_seconds
+        self.max_age_seconds = max_age_seconds
+        self.avoided = 0
+        self.recalculations: Dict[str, int] = {}
+
+    def extrapolate(self, travel_data: TravelData, planned_gsins: List[str], delivered_gsins: List[str]) -> bool:
+        """
+        Shifts the ETAs of the remaining stops by the deviation observed on the stops just delivered, if the route
+        does not need a TomTom recalculation.
+
+        Args:
+            travel_data (TravelData): The route, with the stops just delivered already moved to delivered_stops.
+            planned_gsins (List[str]): The gsin of each stop still to be delivered before the update, in route order.
+            delivered_gsins (List[str]): The gsin of the stops just delivered.
+
+        Returns:
+            bool: True if the ETAs were updated locally, False if the route must be recalculated by TomTom.
+            Without stops just delivered there is no deviation to apply, and the route is recalculated.
+        """
+        if not self.enabled or not travel_data.stops or not delivered_gsins:
+            return False
+
+        reason = None
+        deviation = None
+        if travel_data.routed_at is None:
+            reason = 'not_routed'
+        elif datetime.now(timezone.utc) - utc(travel_data.routed_at) > timedelta(seconds=self.max_age_seconds):
+            reason = 'age'
+        elif set(delivered_gsins) != set(planned_gsins[:len(delivered_gsins)]):
+            reason = 'order'
+        else:
+            deviation = self.deviation(travel_data.delivered_stops, planned_gsins[len(delivered_gsins) - 1])
+            if deviation is None:
+                reason = 'no_eta'
+            elif abs(deviation) > self.max_deviation_seconds:
+                reason = 'deviation'
+
+        if reason is not None:
+            self.recalculations[reason] = self.recalculations.get(reason, 0) + 1
+            return False
+
+        if deviation:
+            shift = timedelta(seconds=deviation)
+            for stop in travel_data.stops:
+                if stop.departureTime is not None:
+                    stop.departureTime += shift
+                if stop.arrivalTime is not None:
+                    stop.arrivalTime += shift
+        summary = travel_data.summary
+        summary.lengthInMeters = sum(stop.lengthInMeters or 0 for stop in travel_data.stops)
+        summary.travelTimeInSeconds = sum(stop.travelTimeInSeconds or 0 for stop in travel_data.stops)
+        summary.trafficDelayInSeconds = sum(stop.trafficDelayInSeconds or 0 for stop in travel_data.stops)
+        summary.trafficLengthInMeters = sum(stop.trafficLengthInMeters or 0 for stop in travel_data.stops)
+        summary.arrivalTime = travel_data.stops[-1].arrivalTime
+        travel_data.update_summary_endpoints()
+
+        self.avoided += 1
+        logger.info(f"ETAs of route {travel_data.ginc} shifted locally by {deviation or 0:.0f}s, "
+                    f"{self.avoided} TomTom calls avoided so far")
+        return True
+
+    @staticmethod
+    def deviation(delivered_stops: List[StopSummary], gsin: str) -> Optional[float]:
+        """
+        Returns how many seconds after its ETA the stop `gsin` was delivered (negative if before), or None if the
+        stop has no ETA or delivery time.
+        """
+        stop = next((stop for stop in reversed(delivered_stops) if stop.gsin == gsin), None)
+        if stop is None or stop.arrivalTime is None or stop.delivered_at is None:
+            return None
+        return (utc(stop.delivered_at) - utc(stop.arrivalTime)).total_seconds()
+
+    def stats(self) -> Dict:
+        """
+        Returns the counters of the extrapolation.
+        """
+        return {
+            'enabled': self.enabled,
+            'avoided': self.avoided,
+            'recalculations': dict(self.recalculations)
+        }
+
+
+def utc(value: datetime) -> datetime:
+    '''Naive datetimes are UTC, as they are when stored.'''
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+eta_extrapolator = EtaExtrapolator()
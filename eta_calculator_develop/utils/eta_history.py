@@ -0,0 +1,165 @@
+"""ETA history writer"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from controller.db.eta_calculator_db import EtaDb
+from model.travel_data import TravelData
+
+
+ETA_HISTORY_ENABLED = os.environ.get('ETA_HISTORY_ENABLED', 'true').lower() == 'true'
+ETA_HISTORY_BUCKET_SECONDS = int(os.environ.get('ETA_HISTORY_BUCKET_SECONDS', 3600))
+ETA_HISTORY_BATCH_SIZE = int(os.environ.get('ETA_HISTORY_BATCH_SIZE', 200))
+ETA_HISTORY_FLUSH_INTERVAL = float(os.environ.get('ETA_HISTORY_FLUSH_INTERVAL', 2))
+ETA_HISTORY_MAX_BUFFER = int(os.environ.get('ETA_HISTORY_MAX_BUFFER', 10000))
+
+
+class EtaHistoryWriter():
+    """
+    The `EtaHistoryWriter` class keeps the ETAs computed by every recalculation in a separate, append-only
+    collection, without slowing down the request that computed them.
+
+    Key Responsibilities:
+    1. **Compact Records**: Each recalculation becomes one record with the route, the hour bucket, the time of the
+       recalculation, its source and the (gsin, eta) pairs of the stops still to be delivered, as epoch seconds.
+    2. **Off the Request Path**: `record` only appends to an in-memory buffer; a background task writes the buffer
+       with bulk inserts every `flush_interval` seconds, or as soon as `batch_size` records are waiting.
+    3. **Bounded Memory**: If the database cannot keep up, the oldest records beyond `max_buffer` are dropped
+       and counted.
+    4. **Counters**: Count recorded, written, dropped records and failed flushes.
+    """
+
+    def __init__(self,
+                 enabled: bool = ETA_HISTORY_ENABLED,
+                 bucket_seconds: int = ETA_HISTORY_BUCKET_SECONDS,
+                 batch_size: int = ETA_HISTORY_BATCH_SIZE,
+                 flush_interval: float = ETA_HISTORY_FLUSH_INTERVAL,
+                 max_buffer: int = ETA_HISTORY_MAX_BUFFER) -> None:
+        self.enabled = enabled
+        self.bucket_seconds = max(bucket_seconds, 1)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self.max_buffer = max(max_buffer, 1)
+        self._buffer: Deque[dict] = deque()
+        # whether records were dropped since the last successful flush, so that the overflow is logged once
+        self._overflowing = False
+        self._db: Optional[AsyncIOMotorDatabase] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        Starts the background writer on the database `db`.
+        """
+        self._db = db
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Stops the background writer and writes the records still in the buffer.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def record(self, travel_data: TravelData, source: str) -> None:
+        """
+        Appends the current ETAs of a route to the history.
+
+        Args:
+            travel_data (TravelData): The route, right after a recalculation.
+            source (str): What triggered the recalculation (upload, delivery, ...).
+        """
+        if not self.enabled:
+            return
+        now = int(time.time())
+        etas = [[gsin, int(stop.arrivalTime.timestamp())]
+                for stop in travel_data.stops if stop.arrivalTime is not None
+                for gsin in (stop.gsins or [stop.gsin])]
+        self._buffer.append({
+            'ginc': travel_data.ginc,
+            'bucket': now - now % self.bucket_seconds,
+            'at': now,
+            'source': source,
+            'etas': etas
+        })
+        self.recorded += 1
+        self._drop_oldest()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """
+        Writes the buffered records with bulk inserts.
+
+        Returns:
+            int: The number of records written.
+        """
+        written = 0
+        while self._buffer and self._db is not None:
+            records: List[dict] = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not await EtaDb.add_eta_history(self._db, records):
+                self.failed_flushes += 1
+                self._buffer.extendleft(reversed(records))
+                self._drop_oldest()
+                logger.error(f"eta history: {len(records)} records not written, {len(self._buffer)} still "
+                             f"buffered, failed flushes: {self.failed_flushes}")
+                break
+            written += len(records)
+            self._overflowing = False
+        self.written += written
+        return written
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the writer.
+        """
+        return {
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes,
+            'buffered': len(self._buffer)
+        }
+
+    def _drop_oldest(self) -> None:
+        dropped = len(self._buffer) - self.max_buffer
+        if dropped <= 0:
+            return
+        for _ in range(dropped):
+            self._buffer.popleft()
+        self.dropped += dropped
+        if not self._overflowing:
+            self._overflowing = True
+            logger.error(f"eta history: buffer full ({self.max_buffer} records), dropping the oldest records, "
+                         f"dropped so far: {self.dropped}")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as ex:
+                self.failed_flushes += 1
+                logger.error(f"eta history: flush failed, error:{ex}")
+
+
+eta_history = EtaHistoryWriter()
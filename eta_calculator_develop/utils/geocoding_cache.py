@@ -0,0 +1,187 @@
+"""Geocoding Cache"""
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from loguru import logger
+
+
+GEOCODING_CACHE_PATH = os.environ.get('GEOCODING_CACHE_PATH', './geocoding_cache.sqlite3')
+GEOCODING_CACHE_TTL = int(os.environ.get('GEOCODING_CACHE_TTL', 60 * 60 * 24 * 30))
+GEOCODING_CACHE_SIZE = int(os.environ.get('GEOCODING_CACHE_SIZE', 10000))
+
+
+class GeocodingCache():
+    """
+    The `GeocodingCache` class keeps the coordinates of the addresses already geocoded, so that recipients and depots
+    that repeat day after day are not sent to ArcGIS again.
+
+    Key Responsibilities:
+    1. **Normalization**: Reduce an address string to a stable key (case, accents, punctuation and spacing are ignored).
+    2. **In-process LRU**: Serve the most recently used addresses from memory.
+    3. **Persistence**: Store every geocoded address in a local SQLite file that survives restarts. The file is read
+       and written in a worker thread (`asyncio.to_thread`), never on the event loop.
+    4. **Expiry and Counters**: Discard entries older than the configured TTL and count hits, misses and expirations.
+    """
+
+    def __init__(self, path: str = GEOCODING_CACHE_PATH, ttl_seconds: int = GEOCODING_CACHE_TTL,
+                 max_size: int = GEOCODING_CACHE_SIZE) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._memory: OrderedDict[str, Tuple[Tuple[str, str], float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._persistent = bool(path)
+
+    @staticmethod
+    def normalize_key(address: str) -> str:
+        """
+        Normalizes an address string so that trivially different spellings share the same cache entry.
+
+        Args:
+            address (str): The full address as sent to the geocoder.
+
+        Returns:
+            str: The normalized key.
+        """
+        address = unicodedata.normalize('NFKD', address)
+        address = ''.join(char for char in address if not unicodedata.combining(char))
+        address = re.sub(r'[^\w]+', ' ', address.lower())
+        return ' '.join(address.split())
+
+    async def get(self, address: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns the cached coordinates of an address, looking first in memory and then in the SQLite file.
+
+        Args:
+            address (str): The full address as sent to the geocoder.
+
+        Returns:
+            Optional[Tuple[str, str]]: The (latitude, longitude) pair, or None if the address is unknown or expired.
+        """
+        key = self.normalize_key(address)
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._read, key)
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        coordinates, created_at = entry
+        if time.time() - created_at > self.ttl_seconds:
+            self.expired += 1
+            self.misses += 1
+            with self._lock:
+                self._memory.pop(key, None)
+            await asyncio.to_thread(self._delete, key)
+            return None
+
+        self.hits += 1
+        return coordinates
+
+    async def set(self, address: str, coordinates: Tuple[str, str]) -> None:
+        """
+        Stores the coordinates of an address both in memory and in the SQLite file.
+
+        Args:
+            address (str): The full address as sent to the geocoder.
+            coordinates (Tuple[str, str]): The (latitude, longitude) pair returned by the geocoder.
+        """
+        key = self.normalize_key(address)
+        entry = ((str(coordinates[0]), str(coordinates[1])), time.time())
+
+        with self._lock:
+            self._remember(key, entry)
+        await asyncio.to_thread(self._write, key, entry)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the hit/miss counters of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'memory_entries': len(self._memory)
+        }
+
+    def _remember(self, key: str, entry: Tuple[Tuple[str, str], float]) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _write(self, key: str, entry: Tuple[Tuple[str, str], float]) -> None:
+        with self._lock:
+            connection = self._open()
+            if connection is None:
+                return
+            try:
+                connection.execute(
+                    'INSERT OR REPLACE INTO geocoding_cache (address, latitude, longitude, created_at) VALUES (?, ?, ?, ?)',
+                    (key, entry[0][0], entry[0][1], entry[1]))
+                connection.commit()
+            except sqlite3.Error as ex:
+                logger.error(f'GeocodingCache._write, error:{ex}')
+
+    def _delete(self, key: str) -> None:
+        with self._lock:
+            connection = self._open()
+            if connection is None:
+                return
+            try:
+                connection.execute('DELETE FROM geocoding_cache WHERE address = ?', (key,))
+                connection.commit()
+            except sqlite3.Error as ex:
+                logger.error(f'GeocodingCache._delete, error:{ex}')
+
+    def _read(self, key: str) -> Optional[Tuple[Tuple[str, str], float]]:
+        with self._lock:
+            connection = self._open()
+            if connection is None:
+                return None
+            try:
+                row = connection.execute(
+                    'SELECT latitude, longitude, created_at FROM geocoding_cache WHERE address = ?', (key,)).fetchone()
+            except sqlite3.Error as ex:
+                logger.error(f'GeocodingCache._read, error:{ex}')
+                return None
+        if row is None:
+            return None
+        return (row[0], row[1]), row[2]
+
+    def _open(self) -> Optional[sqlite3.Connection]:
+        if self._connection is not None or not self._persistent:
+            return self._connection
+        try:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS geocoding_cache '
+                '(address TEXT PRIMARY KEY, latitude TEXT, longitude TEXT, created_at REAL)')
+            self._connection.commit()
+        except sqlite3.Error as ex:
+            logger.error(f'GeocodingCache: unable to open {self.path}, using memory only. error:{ex}')
+            self._connection = None
+            self._persistent = False
+        return self._connection
+
+
+geocoding_cache = GeocodingCache()
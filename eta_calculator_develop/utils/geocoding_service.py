@@ -0,0 +1,203 @@
+"""Asynchronous geocoding engine"""
+import asyncio
+import os
+import random
+from typing import Dict, List, Tuple
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable
+from geopy.geocoders import ArcGIS
+from loguru import logger
+
+from model.geocoding import GeocodingFailure, GeocodingReport
+from utils.geocoding_cache import GeocodingCache, geocoding_cache
+from utils.rate_limit import TokenBucket
+
+
+GEOCODER_RATE_PER_SECOND = float(os.environ.get('GEOCODER_RATE_PER_SECOND', 1))
+GEOCODER_BURST = int(os.environ.get('GEOCODER_BURST', 1))
+GEOCODER_CONCURRENCY = int(os.environ.get('GEOCODER_CONCURRENCY', 4))
+GEOCODER_MAX_RETRIES = int(os.environ.get('GEOCODER_MAX_RETRIES', 3))
+GEOCODER_BACKOFF_SECONDS = float(os.environ.get('GEOCODER_BACKOFF_SECONDS', 1))
+GEOCODER_TIMEOUT = float(os.environ.get('GEOCODER_TIMEOUT', 10))
+
+TRANSIENT_ERRORS = (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited, OSError)
+
+
+class GeocodingError(Exception):
+    '''Raised when at least one address of a route could not be geocoded. It carries the full report.'''
+
+    def __init__(self, report: GeocodingReport) -> None:
+        super().__init__(f"{len(report.failures)} addresses could not be geocoded")
+        self.report = report
+
+
+class AsyncGeocoder():
+    """
+    The `AsyncGeocoder` class geocodes the addresses of a route concurrently without blocking the event loop,
+    while respecting the quota of the geocoding provider.
+
+    Key Responsibilities:
+    1. **Cache**: Addresses found in the geocoding cache never reach the provider; the cache is looked up by the
+       task shared by the concurrent requests of the same address.
+    2. **Rate Limit**: Every call to the provider consumes a token of a shared token bucket.
+    3. **Bounded Concurrency**: At most `concurrency` calls are in flight at the same time; concurrent requests
+       for the same address share a single call.
+    4. **Retry**: Transient errors are retried per address with exponential backoff and jitter.
+    5. **Partial-failure Reporting**: Every address that cannot be geocoded is reported, instead of stopping at the first one.
+    """
+
+    def __init__(self,
+                 rate_per_second: float = GEOCODER_RATE_PER_SECOND,
+                 burst: int = GEOCODER_BURST,
+                 concurrency: int = GEOCODER_CONCURRENCY,
+                 max_retries: int = GEOCODER_MAX_RETRIES,
+                 backoff_seconds: float = GEOCODER_BACKOFF_SECONDS,
+                 cache: GeocodingCache = geocoding_cache) -> None:
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # prefetches of each address that no `geocode` has joined yet
+        self._prefetched: Dict[str, int] = {}
+        self._geolocator = None
+
+    async def geocode(self, address: str) -> Tuple[str, str]:
+        """
+        Returns the coordinates of a single address.
+
+        Args:
+            address (str): The full address to be geocoded.
+
+        Returns:
+            Tuple[str, str]: The (latitude, longitude) pair.
+
+        Raises:
+            LookupError: If the provider does not know the address.
+            Exception: The last error raised by the provider once the retries are exhausted.
+        """
+        self._prefetched.pop(GeocodingCache.normalize_key(address), None)
+        return await asyncio.shield(self._start(address))
+
+    def prefetch(self, address: str) -> None:
+        """
+        Starts geocoding an address in background, so that a later `geocode` of the same address finds it
+        in flight or already cached.
+
+        Args:
+            address (str): The full address to be geocoded.
+        """
+        key = GeocodingCache.normalize_key(address)
+        self._prefetched[key] = self._prefetched.get(key, 0) + 1
+        self._start(address)
+
+    def cancel_prefetch(self, addresses: List[str]) -> None:
+        """
+        Withdraws the prefetches of addresses that will not be geocoded, e.g. those of a rejected file.
+
+        The geocoding of an address is cancelled only when no `geocode` has joined it and no other prefetch of the
+        same address is left.
+
+        Args:
+            addresses (List[str]): The full addresses passed to `prefetch`.
+        """
+        for address in addresses:
+            key = GeocodingCache.normalize_key(address)
+            count = self._prefetched.get(key)
+            if count is None:
+                continue
+            if count > 1:
+                self._prefetched[key] = count - 1
+                continue
+            del self._prefetched[key]
+            task = self._inflight.get(key)
+            if task is not None:
+                task.cancel()
+
+    async def geocode_all(self, addresses: List[Tuple[str, str]]) -> GeocodingReport:
+        """
+        Geocodes every address of a route concurrently.
+
+        Args:
+            addresses (List[Tuple[str, str]]): The (gsin, full address) pairs, in route order.
+
+        Returns:
+            GeocodingReport: The coordinates in route order and the list of the addresses that could not be geocoded.
+        """
+        results = await asyncio.gather(*[self.geocode(address) for _, address in addresses],
+                                       return_exceptions=True)
+
+        coordinates = []
+        failures = []
+        for index, ((gsin, address), result) in enumerate(zip(addresses, results)):
+            if isinstance(result, BaseException):
+                failures.append(GeocodingFailure(index=index, gsin=gsin, address=address,
+                                                 reason=str(result) or type(result).__name__))
+                coordinates.append(None)
+            else:
+                coordinates.append(result)
+
+        if failures:
+            logger.info(f"{len(failures)} of {len(addresses)} addresses could not be geocoded")
+        return GeocodingReport(coordinates=coordinates, failures=failures)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the counters of the geocoder.
+        """
+        return {**self.bucket.stats(), 'inflight': len(self._inflight)}
+
+    def _start(self, address: str) -> asyncio.Future:
+        key = GeocodingCache.normalize_key(address)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve(address))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return task
+
+    def _finish(self, key: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        self._prefetched.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _resolve(self, address: str) -> Tuple[str, str]:
+        cached_coordinates = await self.cache.get(address)
+        if cached_coordinates:
+            return cached_coordinates
+        return await self._geocode_with_retry(address)
+
+    async def _geocode_with_retry(self, address: str) -> Tuple[str, str]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    await self.bucket.acquire()
+                    location = await asyncio.to_thread(self._get_geolocator().geocode, address,
+                                                       exactly_one=True, timeout=GEOCODER_TIMEOUT)
+            except TRANSIENT_ERRORS as ex:
+                if attempt == self.max_retries:
+                    logger.error(f"Error geocoding address {address}: {ex}")
+                    raise
+                delay = self.backoff_seconds * 2 ** attempt + random.uniform(0, self.backoff_seconds)
+                if isinstance(ex, GeocoderRateLimited) and ex.retry_after:
+                    delay = max(delay, ex.retry_after)
+                logger.info(f"geocoding of {address} failed ({ex}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            if not location:
+                logger.info(f"A non-existent address was added: {address}")
+                raise LookupError("address not found")
+
+            coordinates = (f"{location.latitude}", f"{location.longitude}")
+            await self.cache.set(address, coordinates)
+            return coordinates
+
+    def _get_geolocator(self) -> ArcGIS:
+        if self._geolocator is None:
+            self._geolocator = ArcGIS(user_agent=os.environ.get("USER_AGENT", "eta_calculato"))
+        return self._geolocator
+
+
+geocoder = AsyncGeocoder()
@@ -0,0 +1,166 @@
+"""Shared HTTP client for the TomTom APIs"""
+import asyncio
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+import httpx
+from loguru import logger
+
+from utils.rate_limit import TokenBucket
+
+
+TOMTOM_BASE_URL = os.environ.get('TOMTOM_BASE_URL', 'https://api.tomtom.com')
+TOMTOM_CONNECT_TIMEOUT = float(os.environ.get('TOMTOM_CONNECT_TIMEOUT', 5))
+TOMTOM_READ_TIMEOUT = float(os.environ.get('TOMTOM_READ_TIMEOUT', 30))
+TOMTOM_MAX_CONNECTIONS = int(os.environ.get('TOMTOM_MAX_CONNECTIONS', 20))
+TOMTOM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('TOMTOM_MAX_KEEPALIVE_CONNECTIONS', 10))
+TOMTOM_MAX_RETRIES = int(os.environ.get('TOMTOM_MAX_RETRIES', 3))
+TOMTOM_BACKOFF_SECONDS = float(os.environ.get('TOMTOM_BACKOFF_SECONDS', 0.5))
+TOMTOM_RATE_PER_SECOND = float(os.environ.get('TOMTOM_RATE_PER_SECOND', 5))
+TOMTOM_BURST = int(os.environ.get('TOMTOM_BURST', 5))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000)
+
+# what the requests sent from the current context are made for (e.g. 'traffic'), counted in requests_by_source
+request_source: ContextVar[str] = ContextVar('tomtom_request_source', default='other')
+
+
+class TomTomClient():
+    """
+    The `TomTomClient` class owns the single `httpx.AsyncClient` used for every call to TomTom,
+    both by the upload path and by the recalculation path.
+
+    Key Responsibilities:
+    1. **Connection Pooling**: Keep-alive connections are reused across requests; the client is opened and closed
+       by the application lifespan.
+    2. **Timeouts**: Connect and read timeouts are configurable.
+    3. **Quota**: Every attempt consumes a token of the shared TomTom token bucket.
+    4. **Retry**: 429 and 5xx responses and transport errors are retried with exponential backoff and jitter,
+       honouring the Retry-After header.
+    5. **Metrics**: Count requests, retries and status codes and keep a latency histogram. The requests are also
+       counted by the `request_source` of the context they are sent from.
+    """
+
+    def __init__(self,
+                 base_url: str = TOMTOM_BASE_URL,
+                 connect_timeout: float = TOMTOM_CONNECT_TIMEOUT,
+                 read_timeout: float = TOMTOM_READ_TIMEOUT,
+                 max_connections: int = TOMTOM_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = TOMTOM_MAX_KEEPALIVE_CONNECTIONS,
+                 max_retries: int = TOMTOM_MAX_RETRIES,
+                 backoff_seconds: float = TOMTOM_BACKOFF_SECONDS,
+                 budget: Optional[TokenBucket] = None) -> None:
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.budget = budget or TokenBucket(TOMTOM_RATE_PER_SECOND, TOMTOM_BURST)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._metrics = {
+            'requests': 0,
+            'requests_by_source': {},
+            'retries': 0,
+            'failures': 0,
+            'status_codes': {},
+            'latency_total_ms': 0.0,
+            'latency_max_ms': 0.0,
+            'latency_histogram_ms': {str(bucket): 0 for bucket in LATENCY_BUCKETS_MS + ('inf',)}
+        }
+
+    def open(self) -> None:
+        """
+        Creates the underlying connection pool, if not already created.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+
+    async def close(self) -> None:
+        """
+        Closes the connection pool.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get(self, path: str, params: Optional[Dict[str, str]] = None) -> httpx.Response:
+        """
+        Sends a GET request to TomTom, retrying transient failures.
+
+        Args:
+            path (str): The path of the request, relative to the TomTom base URL, including the query string.
+            params (Optional[Dict[str, str]]): Additional query parameters, such as the API key.
+
+        Returns:
+            httpx.Response: The successful response.
+
+        Raises:
+            httpx.HTTPStatusError: If TomTom answers with an error status once the retries are exhausted.
+            httpx.TransportError: If TomTom cannot be reached once the retries are exhausted.
+        """
+        return await self.request('GET', path, params=params)
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Sends a request to TomTom, retrying transient failures. See `get` for the details.
+        """
+        self.open()
+
+        for attempt in range(self.max_retries + 1):
+            await self.budget.acquire()
+            started = time.monotonic()
+            try:
+                response = await self._client.request(method, path, **kwargs)
+            except httpx.TransportError as ex:
+                self._record(started, type(ex).__name__)
+                if attempt == self.max_retries:
+                    self._metrics['failures'] += 1
+                    raise
+                await self._backoff(attempt, None, ex)
+                continue
+
+            self._record(started, str(response.status_code))
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                await self._backoff(attempt, response.headers.get('Retry-After'), response.status_code)
+                continue
+            if response.is_error:
+                self._metrics['failures'] += 1
+            response.raise_for_status()
+            return response
+
+    def stats(self) -> Dict:
+        """
+        Returns the metrics of the client.
+        """
+        requests = self._metrics['requests']
+        return {
+            **self._metrics,
+            'latency_avg_ms': round(self._metrics['latency_total_ms'] / requests, 1) if requests else 0.0,
+            'budget': self.budget.stats()
+        }
+
+    def _record(self, started: float, outcome: str) -> None:
+        latency_ms = (time.monotonic() - started) * 1000
+        self._metrics['requests'] += 1
+        source = request_source.get()
+        self._metrics['requests_by_source'][source] = self._metrics['requests_by_source'].get(source, 0) + 1
+        self._metrics['status_codes'][outcome] = self._metrics['status_codes'].get(outcome, 0) + 1
+        self._metrics['latency_total_ms'] += latency_ms
+        self._metrics['latency_max_ms'] = max(self._metrics['latency_max_ms'], latency_ms)
+        bucket = next((str(bucket) for bucket in LATENCY_BUCKETS_MS if latency_ms <= bucket), 'inf')
+        self._metrics['latency_histogram_ms'][bucket] += 1
+
+    async def _backoff(self, attempt: int, retry_after: Optional[str], reason) -> None:
+        self._metrics['retries'] += 1
+        delay = self.backoff_seconds * 2 ** attempt + random.uniform(0, self.backoff_seconds)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        logger.info(f"TomTom request failed ({reason}), retry in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+tomtom_client = TomTomClient()
@@ -1,11 +1,13 @@
-from geopy import distance
-from model.travel_data import TravelData
+from model.delivery import Address
+from model.travel_data import StopSummary, TravelData
 from model.response import Response, Delivery_ETA
 from loguru import logger
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from io import StringIO
+from itertools import accumulate
 import csv
+import math
 
 
 class PostProcess():
@@ -24,10 +26,11 @@ class PostProcess():
     @staticmethod
     def associate_address(raw_travel_data: TravelData, ordered_travel_data: TravelData) -> TravelData:
         """
-        This method associates the delivery addresses to the stops in the ordered travel data based on geographic proximity.
+        This method associates the delivery addresses to the stops in the ordered travel data.
 
-        It compares the departure and arrival locations of each stop in `raw_travel_data` with the corresponding stops in `ordered_travel_data`,
-        calculating the distance between them. The closest match is used to assign the correct address to each stop.
+        When TomTom returned the optimized waypoint order (`ordered_travel_data.waypoint_order`), every ordered stop is
+        matched exactly with the raw stop arriving at the same waypoint. Otherwise each raw stop is matched with the
+        ordered stops whose departure and arrival locations are closest to its own, using the haversine distance.
 
         Args:
             raw_travel_data (TravelData): The original unprocessed travel data.
@@ -37,43 +40,72 @@ class PostProcess():
             TravelData: The updated `ordered_travel_data` with the correct addresses associated to each stop.
         """
 
-        for stop in raw_travel_data.stops:
-            departure_latitude = stop.departureLatitude
-            departure_longitude = stop.departureLongitude
-            arrival_latitude = stop.arrivalLatitude
-            arrival_longitude = stop.arrivalLongitude
+        raw_stops = raw_travel_data.stops
+        ordered_stops = ordered_travel_data.stops
+        waypoint_order = ordered_travel_data.waypoint_order
+
+        if waypoint_order is not None and sorted(waypoint_order) == list(range(1, len(raw_stops) + 1)) \
+                and len(waypoint_order) == len(ordered_stops):
+            departure_points = [0] + waypoint_order[:-1]
+            for ordered_stop, departure_point, arrival_point in zip(ordered_stops, departure_points, waypoint_order):
+                raw_departure_stop = raw_stops[departure_point]
+                raw_arrival_stop = raw_stops[arrival_point - 1]
+                PostProcess._copy_addresses(raw_departure_stop, ordered_stop, raw_arrival_stop, ordered_stop)
+        else:
+            ordered_departures = PostProcess._radians(
+                [(stop.departureLatitude, stop.departureLongitude) for stop in ordered_stops])
+            ordered_arrivals = PostProcess._radians(
+                [(stop.arrivalLatitude, stop.arrivalLongitude) for stop in ordered_stops])
+
+            for stop in raw_stops:
+                departure_min_index = PostProcess._nearest(
+                    stop.departureLatitude, stop.departureLongitude, ordered_departures)
+                arrival_min_index = PostProcess._nearest(
+                    stop.arrivalLatitude, stop.arrivalLongitude, ordered_arrivals)
+                PostProcess._copy_addresses(stop, ordered_stops[departure_min_index],
+                                            stop, ordered_stops[arrival_min_index])
+
+        ordered_travel_data.summary.startAddress = ordered_stops[0].departureAddress
+        ordered_travel_data.summary.endAddress = ordered_stops[-1].arrivalAddress
 
-            dep_dist_list = []
-            arr_dist_list = []
-
-            for i in range(len(ordered_travel_data.stops)):
-
-                ordered_departure_latitude = ordered_travel_data.stops[i].departureLatitude
-                ordered_departure_longitude = ordered_travel_data.stops[i].departureLongitude
-                ordered_arrival_latitude = ordered_travel_data.stops[i].arrivalLatitude
-                ordered_arrival_longitude = ordered_travel_data.stops[i].arrivalLongitude
+        return ordered_travel_data
 
-                dep_dist = distance.distance((departure_latitude, departure_longitude), (
-                    ordered_departure_latitude, ordered_departure_longitude)).m
-                # logger.info(f"departure distance:{dep_dist}")
-                dep_dist_list.append(dep_dist)
+    @staticmethod
+    def _copy_addresses(raw_departure_stop: StopSummary, ordered_departure_stop: StopSummary,
+                        raw_arrival_stop: StopSummary, ordered_arrival_stop: StopSummary) -> None:
+        ordered_departure_stop.departureAddress = raw_departure_stop.departureAddress
+        ordered_arrival_stop.arrivalAddress = raw_arrival_stop.arrivalAddress
+        ordered_arrival_stop.gsin = raw_arrival_stop.gsin
+        ordered_arrival_stop.gsins = raw_arrival_stop.gsins
+        ordered_arrival_stop.telephone_numbers = raw_arrival_stop.telephone_numbers
 
-                arr_dist = distance.distance(
-                    (arrival_latitude, arrival_longitude), (ordered_arrival_latitude, ordered_arrival_longitude)).m
-                # logger.info(f"arrival distance:{arr_dist}")
-                arr_dist_list.append(arr_dist)
+    @staticmethod
+    def _radians(points: List[Tuple[float, float]]) -> List[Tuple[float, float, float]]:
+        """
+        Converts (latitude, longitude) pairs into (latitude, longitude, cos(latitude)) in radians,
+        the terms of the haversine formula that depend on a single point.
+        """
+        result = []
+        for latitude, longitude in points:
+            latitude, longitude = math.radians(float(latitude)), math.radians(float(longitude))
+            result.append((latitude, longitude, math.cos(latitude)))
+        return result
 
-            departure_min_index = dep_dist_list.index(min(dep_dist_list))
-            arrival_min_index = arr_dist_list.index(min(arr_dist_list))
+    @staticmethod
+    def _nearest(latitude: float, longitude: float, points: List[Tuple[float, float, float]]) -> int:
+        """
+        Returns the index of the point closest to (latitude, longitude) according to the haversine distance.
+        Ties are resolved in favour of the first point, as `list.index(min(...))` does.
+        """
+        latitude, longitude = math.radians(float(latitude)), math.radians(float(longitude))
+        cos_latitude = math.cos(latitude)
 
-            ordered_travel_data.stops[departure_min_index].departureAddress = stop.departureAddress
-            ordered_travel_data.stops[arrival_min_index].arrivalAddress = stop.arrivalAddress
-            ordered_travel_data.stops[arrival_min_index].gsin = stop.gsin
-            ordered_travel_data.summary.startAddress = ordered_travel_data.stops[
-                0].departureAddress
-            ordered_travel_data.summary.endAddress = ordered_travel_data.stops[-1].arrivalAddress
+        # the haversine distance grows monotonically with this term, no need for asin and sqrt
+        def haversine_term(point: Tuple[float, float, float]) -> float:
+            return (math.sin((point[0] - latitude) / 2) ** 2
+                    + cos_latitude * point[2] * math.sin((point[1] - longitude) / 2) ** 2)
 
-        return ordered_travel_data
+        return min(range(len(points)), key=lambda index: haversine_term(points[index]))
 
     @staticmethod
     def add_delay_to_time(time_obj: datetime, delay_in_seconds: int) -> datetime:
@@ -99,8 +131,10 @@ class PostProcess():
         """
         Updates the ETAs for each stop in the travel data, considering delays based on zip code.
 
-        The method checks the delay for each stop based on its zip code and adds it to both the departure and arrival times.
-        If no specific delay is found for a zip code, a default delay is applied.
+        The delay of each stop is looked up from the zip code of its departure address (the address of the previous
+        delivery) and shifts that stop and every following one. The shifts are accumulated in a single pass, so each
+        stop receives the sum of the delays of all the stops up to itself. If no specific delay is found for a zip code,
+        a default delay is applied.
 
         Args:
             travel_data (TravelData): The travel data containing the stops with their respective times.
@@ -116,35 +150,47 @@ class PostProcess():
                 "No stops available in travel_data. Skipping ETA update.")
             return travel_data
 
-        for i in range(len(travel_data.stops)-1):
-            zip_code = travel_data.stops[i+1].departureAddress.zip_code
-            delay = zip_code_delay.get(zip_code, default_delay)
-
-            for y in range(i+1, len(travel_data.stops)):
-                dep_time = travel_data.stops[y].departureTime
-                arr_time = travel_data.stops[y].arrivalTime
-                travel_data.stops[y].departureTime = PostProcess.add_delay_to_time(
-                    dep_time, delay)
-                travel_data.stops[y].arrivalTime = PostProcess.add_delay_to_time(
-                    arr_time, delay)
+        offsets = accumulate(PostProcess.stop_delays(travel_data, zip_code_delay, default_delay))
+        for stop, offset in zip(travel_data.stops, offsets):
+            if offset:
+                stop.departureTime = PostProcess.add_delay_to_time(stop.departureTime, offset)
+                stop.arrivalTime = PostProcess.add_delay_to_time(stop.arrivalTime, offset)
         travel_data.summary.arrivalTime = travel_data.stops[-1].arrivalTime
 
         return travel_data
 
+    @staticmethod
+    def stop_delays(travel_data: TravelData, zip_code_delay: Dict[str, int], default_delay: int) -> List[int]:
+        """
+        Returns the delay (in seconds) introduced by each stop: zero for the first one, the delay of the zip code
+        of the departure address for the others.
+
+        Args:
+            travel_data (TravelData): The travel data containing the stops.
+            zip_code_delay (Dict[str, int]): A dictionary mapping zip codes to delay values (in seconds).
+            default_delay (int): The default delay (in seconds) to be applied if no zip code-specific delay is found.
+
+        Returns:
+            List[int]: One delay for each stop.
+        """
+        return [0] + [zip_code_delay.get(stop.departureAddress.zip_code, default_delay)
+                      for stop in travel_data.stops[1:]]
+
     @staticmethod
     def process_stops(travel_data: TravelData) -> list[Delivery_ETA]:
         """
         Processes the stops in the travel data to create a list of `Delivery_ETA` objects.
 
-        This method constructs a `Delivery_ETA` object for each stop, containing the delivery information
-        (such as GSIN, address, ETA, and delivery status). The resulting list can be used for reporting or
+        This method constructs a `Delivery_ETA` object for each gsin of each stop, containing the delivery information
+        (such as GSIN, address, ETA, and delivery status). The gsins grouped in the same stop share its ETA but keep
+        their own telephone number and delivery status. The resulting list can be used for reporting or
         generating responses for external systems.
 
         Args:
             travel_data (TravelData): The travel data containing the stops to be processed.
 
         Returns:
-            List[Delivery_ETA]: A list of `Delivery_ETA` objects representing the ETA details for each stop.
+            List[Delivery_ETA]: A list of `Delivery_ETA` objects representing the ETA details for each gsin.
         """
         result = []
         all_stops = []
@@ -154,43 +200,65 @@ class PostProcess():
             all_stops.extend(travel_data.stops)
 
         for stop in all_stops:
-            try:
-                delivery_eta = Delivery_ETA(**{
-                    'gsin': stop.gsin,
-                    'address': stop.arrivalAddress,
-                    'eta': stop.arrivalTime,
-                    'delivered': stop.delivered,
-                    'delivered_at': stop.delivered_at
-                })
-                result.append(delivery_eta)
-            except AttributeError as e:
-                logger.error(
-                    f"Error during Delivery_ETA creation for {stop}: {e}")
+            for gsin in PostProcess.stop_gsins(stop):
+                try:
+                    delivered_at = stop.delivered_gsins.get(gsin, stop.delivered_at)
+                    delivery_eta = Delivery_ETA(**{
+                        'gsin': gsin,
+                        'address': PostProcess.gsin_address(stop, gsin),
+                        'eta': stop.arrivalTime,
+                        'delivered': stop.delivered or gsin in stop.delivered_gsins,
+                        'delivered_at': delivered_at
+                    })
+                    result.append(delivery_eta)
+                except AttributeError as e:
+                    logger.error(
+                        f"Error during Delivery_ETA creation for {stop}: {e}")
         return result
 
-    # @staticmethod
-    # def create_response(travel_data: TravelData) -> Response:
-    #     """
-    #     Creates a structured `Response` object containing the travel data and delivery ETA information.
+    @staticmethod
+    def stop_gsins(stop: StopSummary) -> List[str]:
+        """
+        Returns every gsin delivered at a stop, falling back to the single gsin of the stops stored before
+        the deliveries were grouped by address.
+        """
+        return stop.gsins or [stop.gsin]
+
+    @staticmethod
+    def gsin_address(stop: StopSummary, gsin: str) -> Address:
+        """
+        Returns the arrival address of a stop with the telephone number of the recipient of `gsin`.
+        """
+        telephone_number = stop.telephone_numbers.get(gsin)
+        if telephone_number is None:
+            return stop.arrivalAddress
+        return stop.arrivalAddress.model_copy(update={'telephone_number': telephone_number})
+
+    @staticmethod
+    def create_response(travel_data: TravelData) -> Response:
+        """
+        Creates a structured `Response` object containing the travel data and delivery ETA information.
 
-    #     This method aggregates the processed delivery ETAs into a response format that can be sent to clients
-    #     or used by other services. The response includes the travel summary, personal ID, GINC, and a list of
-    #     `Delivery_ETA` objects.
+        This method aggregates the processed delivery ETAs into a response format that can be sent to clients
+        or used by other services. The response includes the travel summary, personal ID, GINC, and a list of
+        `Delivery_ETA` objects.
 
-    #     Args:
-    #         travel_data (TravelData): The travel data containing delivery stop details.
+        Args:
+            travel_data (TravelData): The travel data containing delivery stop details.
 
-    #     Returns:
-    #         Response: A structured response object containing the travel and delivery ETA data.
-    #     """
-    #     delivery = PostProcess.process_stops(travel_data)
+        Returns:
+            Response: A structured response object containing the travel and delivery ETA data.
+        """
+        delivery = PostProcess.process_stops(travel_data)
 
-    #     response = Response(**{
-    #         'ginc': travel_data.ginc,
-    #         'personal_id': travel_data.personal_id,
-    #         'delivery': delivery
-    #     })
-    #     return response
+        response = Response(**{
+            'ginc': travel_data.ginc,
+            'personal_id': travel_data.personal_id,
+            'delivery': delivery,
+            'recalculation_status': travel_data.recalculation_status,
+            'recalculated_at': travel_data.recalculated_at
+        })
+        return response
 
     @staticmethod
     def generate_csv(travel_data: TravelData) -> StringIO:
@@ -227,18 +295,19 @@ class PostProcess():
             ])
 
             for single_delivery in travel_data.stops:
-
-                arrival_address = single_delivery.arrivalAddress
-                csv_writer.writerow([
-                    single_delivery.gsin,
-                    arrival_address.address,
-                    arrival_address.city,
-                    arrival_address.district,
-                    arrival_address.house_number,
-                    arrival_address.zip_code,
-                    arrival_address.telephone_number,
-                    single_delivery.arrivalTime.isoformat(),
-                ])
+                for gsin in PostProcess.stop_gsins(single_delivery):
+
+                    arrival_address = PostProcess.gsin_address(single_delivery, gsin)
+                    csv_writer.writerow([
+                        gsin,
+                        arrival_address.address,
+                        arrival_address.city,
+                        arrival_address.district,
+                        arrival_address.house_number,
+                        arrival_address.zip_code,
+                        arrival_address.telephone_number,
+                        single_delivery.arrivalTime.isoformat(),
+                    ])
 
         csv_file.seek(0)
         return csv_file
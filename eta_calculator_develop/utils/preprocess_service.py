@@ -1,13 +1,34 @@
-from typing import List, Tuple
-import os
+from typing import AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
 from model.travel_data import StopSummary, Summary, TravelData
-from model.delivery import Delivery
-from geopy.geocoders import ArcGIS
-from model.delivery import Delivery, Address
-from geopy.extra.rate_limiter import RateLimiter
+from model.delivery import Delivery, DeliveryStop, Address
+from model.geocoding import GeocodingReport
+from model.upload import CsvRowError
+from utils.geocoding_cache import GeocodingCache
+from utils.geocoding_service import GeocodingError, geocoder
 from loguru import logger
+import codecs
 import csv
-import io
+import os
+from collections import deque
+
+
+CSV_COLUMNS = ('id', 'indirizzo', 'città', 'provincia', 'numero civico', 'cap', 'telefono')
+CSV_MAX_ROWS = int(os.environ.get('CSV_MAX_ROWS', 1000))
+CSV_MAX_BYTES = int(os.environ.get('CSV_MAX_BYTES', 5 * 1024 * 1024))
+CSV_CHUNK_SIZE = int(os.environ.get('CSV_CHUNK_SIZE', 64 * 1024))
+CSV_LOG_ROWS = os.environ.get('CSV_LOG_ROWS', 'false').lower() == 'true'
+
+
+class CsvValidationError(Exception):
+    '''Raised when one or more rows of an uploaded CSV file are not valid. It carries the invalid rows.'''
+
+    def __init__(self, errors: List[CsvRowError]) -> None:
+        super().__init__(f"{len(errors)} rows of the file are not valid")
+        self.errors = errors
+
+
+class CsvLimitError(Exception):
+    '''Raised when an uploaded CSV file exceeds the configured size or number of rows.'''
 
 
 class PreProcess():
@@ -24,12 +45,13 @@ class PreProcess():
     1. **Coordinate Conversion**: Convert a list of delivery addresses into geographic coordinates (latitude, longitude).
     2. **Travel Data Population**: Populate a `TravelData` object with route summaries and stop details derived from delivery addresses.
     3. **CSV Parsing**: Parse CSV files containing delivery information, converting rows into structured `Delivery` objects with associated metadata.
+    4. **Deduplication**: Collapse the deliveries sharing the same address into a single `DeliveryStop`, geocoded and routed once.
     """
 
     @staticmethod
-    def populate_travel_data(delivery_list: List[Delivery]) -> Tuple[List[str], TravelData]:
+    async def populate_travel_data(delivery_list: List[DeliveryStop]) -> Tuple[List[str], TravelData]:
         """
-        Converts a list of `Delivery` objects into `TravelData`, including route summary and stops.
+        Converts a list of `DeliveryStop` objects into `TravelData`, including route summary and stops.
 
         This method:
         1. Converts the addresses from the `Delivery` objects into geographic coordinates.
@@ -37,7 +59,7 @@ class PreProcess():
         3. Creates `StopSummary` objects for each leg of the journey (from one delivery to the next).
 
         Args:
-            delivery_list (List[Delivery]): A list of `Delivery` objects containing delivery details.
+            delivery_list (List[DeliveryStop]): A list of `DeliveryStop` objects, one for each physical stop.
 
         Returns:
             Tuple[List[str], TravelData]: A tuple consisting of:
@@ -45,11 +67,15 @@ class PreProcess():
                 - A `TravelData` object with summary and stops information.
 
         Raises:
+            GeocodingError: If one or more addresses cannot be geocoded; the error carries the full report.
             ValueError: If the `delivery_list` does not contain at least two addresses for start and end.
         """
 
-        coordinates = PreProcess.address_to_coordinates_converter(
+        report = await PreProcess.address_to_coordinates_converter(
             delivery_list)
+        if report.failures:
+            raise GeocodingError(report)
+        coordinates = report.coordinates
 
         if len(coordinates) < 2:
             raise ValueError(
@@ -68,6 +94,8 @@ class PreProcess():
 
             address_stop = StopSummary(
                 gsin=delivery_list[i+1].gsin,
+                gsins=delivery_list[i+1].gsins,
+                telephone_numbers=delivery_list[i+1].telephone_numbers,
                 departureLatitude=coordinates[i][0],
                 departureLongitude=coordinates[i][1],
                 arrivalLatitude=coordinates[i + 1][0],
@@ -88,106 +116,299 @@ class PreProcess():
         return coordinates, travel_data
 
     @staticmethod
-    def address_to_coordinates_converter(delivery_list: List[Delivery]) -> List[str]:
+    async def address_to_coordinates_converter(delivery_list: List[Delivery]) -> GeocodingReport:
         """
         Converts delivery addresses into geographic coordinates (latitude, longitude) using geocoding.
 
         This method:
-        1. Uses the `ArcGIS` geocoder to look up the coordinates for each delivery address.
-        2. Returns the list of coordinates as tuples of latitude and longitude.
+        1. Sends every address to the shared asynchronous geocoder, which serves known addresses from the geocoding
+           cache and geocodes the others concurrently within the provider quota.
+        2. Collects the coordinates, in the order of the delivery list, together with every address that failed.
 
         Args:
             delivery_list (List[Delivery]): A list of `Delivery` objects containing address details.
 
         Returns:
-            List[str]: A list of coordinates (latitude, longitude) for each address in the delivery list.
+            GeocodingReport: The coordinates (latitude, longitude) for each address in the delivery list
+            and the list of the addresses that could not be geocoded.
+        """
 
-        Raises:
-            ValueError: If any address cannot be geocoded.
-        """
-
-        request = os.environ.get("USER_AGENT", "eta_calculato")
-        geolocator = ArcGIS(user_agent=request)
-        geocode = RateLimiter(geolocator.geocode,
-                              min_delay_seconds=1, max_retries=10)
-
-        coordinates = []
-
-        for delivery in delivery_list:
-            add = delivery.address
-            full_address = f"{add.address}, {add.house_number}, {add.city}, {add.district}, {add.zip_code}"  # nopep8
-            try:
-                location = geocode(full_address, exactly_one=True)
-                if location:
-                    coordinates.append((f"{location.latitude}", f"{location.longitude}"))  # nopep8
-                    logger.info(coordinates)
-
-                else:
-                    logger.info(
-                        f"A non-existent address was added: {full_address}")
-                    return ""
-            except Exception as e:
-                logger.error(f"Error geocoding address {full_address}: {e}")
-                return ""
-        # logger.info(coordinates)
-        return coordinates
+        report = await geocoder.geocode_all(
+            [(delivery.gsin, PreProcess.format_address(delivery.address)) for delivery in delivery_list])
+        logger.info(f"geocoding cache stats: {geocoder.cache.stats()}")
+        return report
 
     @staticmethod
-    async def digest_csv(route_file) -> Tuple[List[Delivery], str, str]:
+    def format_address(add: Address) -> str:
         """
-        Parses a CSV file containing delivery data and returns a list of `Delivery` objects, along with
+        Builds the full address string sent to the geocoder.
+
+        Args:
+            add (Address): The address of a delivery.
+
+        Returns:
+            str: The address, house number, city, district and zip code separated by commas.
+        """
+        return f"{add.address}, {add.house_number}, {add.city}, {add.district}, {add.zip_code}"
+
+    @staticmethod
+    async def digest_csv(route_file) -> Tuple[List[DeliveryStop], str, str]:
+        """
+        Parses a CSV file containing delivery data and returns a list of `DeliveryStop` objects, along with
         additional metadata such as date and trace ID.
 
         This method:
-        1. Reads the CSV file containing delivery information.
-        2. Creates a list of `Delivery` objects from the parsed CSV content.
-        3. Extracts the date and trace ID from the file name.
+        1. Streams the CSV file containing delivery information, validating each row as it arrives.
+        2. Collapses the deliveries sharing the same address into a single `DeliveryStop`.
+        3. Starts geocoding each new address while the rest of the file is still being parsed, and cancels it if the
+           file is rejected.
+        4. Extracts the date and trace ID from the file name.
 
         Args:
             route_file: The CSV file containing delivery data.
 
         Returns:
-            Tuple[List[Delivery], str, str]: A tuple consisting of:
-                - A list of `Delivery` objects created from the CSV file.
+            Tuple[List[DeliveryStop], str, str]: A tuple consisting of:
+                - A list of `DeliveryStop` objects created from the CSV file, one for each physical stop.
                 - The date extracted from the file name.
                 - The trace ID extracted from the file name.
+
+        Raises:
+            CsvValidationError: If one or more rows are not valid; the error lists every invalid row.
+            CsvLimitError: If the file exceeds the configured size or number of rows.
         """
 
-        delivery_list = []
-        result = []
         file_name = route_file.filename
         date = file_name[0:10]
         trace_id = file_name[11:-4]
 
-        with route_file.file as f:
-            csv_content = csv.DictReader(
-                io.TextIOWrapper(f, encoding='utf_8'), ('id', 'indirizzo', 'città', 'provincia', 'numero civico', 'cap', 'telefono'))
+        errors = []
+        grouper = DeliveryGrouper()
+
+        prefetched = []
+
+        try:
+            async for delivery in PreProcess.stream_csv(route_file, errors):
+                stop = grouper.add(delivery)
+                if stop is not None:
+                    address = PreProcess.format_address(stop.address)
+                    geocoder.prefetch(address)
+                    prefetched.append(address)
+
+            if errors:
+                raise CsvValidationError(errors)
+        except (CsvValidationError, CsvLimitError):
+            # the file is rejected: its addresses are not geocoded
+            geocoder.cancel_prefetch(prefetched)
+            raise
+
+        logger.info(f"{grouper.deliveries} deliveries grouped into {len(grouper.stops)} stops")
+        return grouper.stops, date, trace_id
+
+    @staticmethod
+    async def stream_csv(route_file, errors: List[CsvRowError],
+                         max_rows: int = CSV_MAX_ROWS, max_bytes: int = CSV_MAX_BYTES) -> AsyncIterator[Delivery]:
+        """
+        Reads a CSV file chunk by chunk and yields a validated `Delivery` for each row, without loading the whole file.
+
+        The first row is the header and is skipped, as are blank lines. A quoted field can span several lines: the
+        lines are fed to a single `csv.reader`, which is advanced only up to the last complete row read so far.
+        Invalid rows are not yielded: they are appended to `errors` together with their line number, as are the rows
+        containing text that is not valid UTF-8.
 
-            for row in csv_content:
-                result.append(row)
+        Args:
+            route_file: The CSV file containing delivery data, exposing an asynchronous `read(size)`.
+            errors (List[CsvRowError]): The list collecting the invalid rows.
+            max_rows (int): The maximum number of deliveries accepted.
+            max_bytes (int): The maximum size of the file in bytes.
+
+        Yields:
+            Delivery: The delivery described by each valid row.
+
+        Raises:
+            CsvLimitError: If the file exceeds `max_bytes` or contains more than `max_rows` deliveries.
+        """
+
+        lines: Deque[str] = deque()
+        reader = csv.reader(PreProcess._pop_lines(lines))
+        pending = b""
+        size = 0
+        line_count = 0
+        complete_line_count = 0
+        quoted = False
+        invalid_lines: Dict[int, str] = {}
+        rows = 0
+
+        while True:
+            chunk = await route_file.read(CSV_CHUNK_SIZE)
+            final = not chunk
+            size += len(chunk)
+            if size > max_bytes:
+                raise CsvLimitError(f"the file exceeds the limit of {max_bytes} bytes")
+
+            # a newline byte is never part of a multi-byte UTF-8 character: the lines are split before decoding
+            pieces = (pending + chunk).split(b"\n")
+            pending = pieces.pop()
+            terminators = ["\n"] * len(pieces)
+            if final and pending:
+                pieces.append(pending)
+                terminators.append("")
+
+            for piece, terminator in zip(pieces, terminators):
+                line_count += 1
+                if line_count == 1 and piece.startswith(codecs.BOM_UTF8):
+                    piece = piece[len(codecs.BOM_UTF8):]
+                try:
+                    line = piece.decode('utf_8')
+                except UnicodeDecodeError as ex:
+                    invalid_lines[line_count] = f"the line is not valid UTF-8 text: {ex.reason} at byte {ex.start + 1}"
+                    line = piece.decode('utf_8', errors='replace')
+                lines.append(line + terminator)
+                quoted = PreProcess._quote_open(line, quoted)
+                if not quoted:
+                    complete_line_count = line_count
+            if final:
+                complete_line_count = line_count
+
+            while reader.line_num < complete_line_count:
+                first_line = reader.line_num + 1
+                try:
+                    values = next(reader, None)
+                except csv.Error as ex:
+                    errors.append(CsvRowError(line=first_line, reason=f"malformed row: {ex}"))
+                    continue
+                if values is None:
+                    # a quoted field left open at the end of the file
+                    break
+                if first_line == 1 or not any(value.strip() for value in values):
+                    continue
+
+                invalid_line = next((line_number for line_number in range(first_line, reader.line_num + 1)
+                                     if line_number in invalid_lines), None)
+                if invalid_line is not None:
+                    errors.append(CsvRowError(line=invalid_line, reason=invalid_lines[invalid_line]))
+                    continue
+                try:
+                    delivery = PreProcess.parse_csv_row(values)
+                except ValueError as ex:
+                    errors.append(CsvRowError(line=first_line, reason=str(ex)))
+                    continue
+
+                rows += 1
+                if rows > max_rows:
+                    raise CsvLimitError(f"the file exceeds the limit of {max_rows} rows")
+                if CSV_LOG_ROWS:
+                    logger.info(f"line {first_line}: {delivery}")
+                yield delivery
+
+            if final:
+                break
 
-        result = result[1:]
+    @staticmethod
+    def parse_csv_row(values: List[str]) -> Delivery:
+        """
+        Converts the values of a single CSV row into a `Delivery`.
+
+        Args:
+            values (List[str]): The columns id, indirizzo, città, provincia, numero civico, cap, telefono.
+
+        Returns:
+            Delivery: The delivery described by the row.
+
+        Raises:
+            ValueError: If the row does not have the expected columns or a mandatory column is empty.
+        """
 
-        for item in result:
-            logger.info(item)
-            gsin = item['id']
-            del item['id']
+        if len(values) != len(CSV_COLUMNS):
+            raise ValueError(f"expected {len(CSV_COLUMNS)} columns, found {len(values)}")
 
-            address = Address(**{
-                'address': item['indirizzo'],
-                'city': item['città'],
-                'district': item['provincia'],
-                'house_number': item['numero civico'],
-                'zip_code': item['cap'],
-                'telephone_number': item['telefono']
-            })
+        item = dict(zip(CSV_COLUMNS, (value.strip() for value in values)))
+        for column in ('id', 'indirizzo', 'città'):
+            if not item[column]:
+                raise ValueError(f"the column '{column}' is empty")
 
-            item = Delivery(**{
-                'gsin': gsin,
-                'address': address
+        address = Address(**{
+            'address': item['indirizzo'],
+            'city': item['città'],
+            'district': item['provincia'],
+            'house_number': item['numero civico'],
+            'zip_code': item['cap'],
+            'telephone_number': item['telefono']
+        })
 
-            })
-            delivery_list.append(item)
+        return Delivery(**{
+            'gsin': item['id'],
+            'address': address
+        })
 
-        logger.info(input)
-        return delivery_list, date, trace_id
+    @staticmethod
+    def _pop_lines(lines: Deque[str]) -> Iterator[str]:
+        # the reader is advanced only while the queue holds a complete row: the queue runs out only at the end of
+        # a file that leaves a quoted field open
+        while lines:
+            yield lines.popleft()
+
+    @staticmethod
+    def _quote_open(line: str, quoted: bool) -> bool:
+        """
+        Returns whether a quoted field is still open at the end of `line`, as `csv.reader` reads it: a quote opens
+        a quoted field only at the start of a field, and a doubled quote inside it is an escaped quote.
+        """
+        if '"' not in line:
+            return quoted
+        state = 'quoted' if quoted else 'start'
+        for char in line:
+            if state == 'quoted':
+                if char == '"':
+                    state = 'quote'
+            elif state == 'quote':
+                state = 'quoted' if char == '"' else 'start' if char == ',' else 'field'
+            elif char == ',':
+                state = 'start'
+            elif state == 'start' and char == '"':
+                state = 'quoted'
+            else:
+                state = 'field'
+        return state == 'quoted'
+
+
+class DeliveryGrouper():
+    """
+    The `DeliveryGrouper` class groups deliveries by normalized address one delivery at a time, so that the grouping
+    can run while the CSV file is still being read.
+
+    The first delivery is the start/ending point and is never merged: deliveries with the same address
+    as the start/ending point are kept as separate stops, so that the return to the start is preserved.
+    The stops keep the order of the first occurrence of each address.
+    """
+
+    def __init__(self) -> None:
+        self.stops: List[DeliveryStop] = []
+        self.deliveries = 0
+        self._stops_by_address: Dict[str, DeliveryStop] = {}
+        self._start_key = None
+
+    def add(self, delivery: Delivery) -> Optional[DeliveryStop]:
+        """
+        Adds a delivery to the stop with the same address, or creates a new stop.
+
+        Returns:
+            Optional[DeliveryStop]: The new stop, or None if the delivery joined an existing stop.
+        """
+        self.deliveries += 1
+        key = GeocodingCache.normalize_key(PreProcess.format_address(delivery.address))
+        stop = self._stops_by_address.get(key)
+
+        if stop is None:
+            stop = DeliveryStop(gsin=delivery.gsin, address=delivery.address, gsins=[delivery.gsin])
+            self.stops.append(stop)
+            if self._start_key is None:
+                self._start_key = key
+            elif key != self._start_key:
+                self._stops_by_address[key] = stop
+            return stop
+
+        stop.gsins.append(delivery.gsin)
+        if delivery.address.telephone_number != stop.address.telephone_number:
+            stop.telephone_numbers[delivery.gsin] = delivery.address.telephone_number
+        return None
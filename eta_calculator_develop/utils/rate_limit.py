@@ -0,0 +1,63 @@
+"""Rate Limiting utilities"""
+import asyncio
+import time
+from typing import Dict
+
+
+class TokenBucket():
+    """
+    The `TokenBucket` class throttles the calls towards an external provider (geocoder, TomTom) so that they never exceed
+    the quota granted by the provider, whatever the number of concurrent requests.
+
+    Key Responsibilities:
+    1. **Refill**: Tokens are refilled continuously at `rate` tokens per second, up to `capacity`.
+    2. **Acquire**: Callers wait asynchronously, in arrival order, until a token is available.
+    3. **Counters**: Keep track of how many tokens were granted and how long callers waited.
+
+    A `rate` lower than or equal to zero disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.granted = 0
+        self.waited_seconds = 0.0
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 1) -> None:
+        """
+        Waits until `tokens` tokens are available and consumes them.
+
+        Args:
+            tokens (int): The number of tokens to consume.
+        """
+        if self.rate <= 0:
+            self.granted += tokens
+            return
+
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    break
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+        self.granted += tokens
+        self.waited_seconds += time.monotonic() - started
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the counters of the bucket.
+        """
+        return {
+            'rate_per_second': self.rate,
+            'capacity': self.capacity,
+            'granted': self.granted,
+            'waited_seconds': round(self.waited_seconds, 3)
+        }
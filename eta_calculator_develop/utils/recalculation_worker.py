@@ -0,0 +1,122 @@
+"""Background ETA recalculation worker"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+from loguru import logger
+
+
+RECALC_DEBOUNCE_SECONDS = float(os.environ.get('RECALC_DEBOUNCE_SECONDS', 2))
+RECALC_MIN_INTERVAL_SECONDS = float(os.environ.get('RECALC_MIN_INTERVAL_SECONDS', 30))
+
+
+class RecalculationWorker():
+    """
+    The `RecalculationWorker` class recalculates the ETAs of the routes in the background, after their deliveries
+    have been recorded, so that confirming a delivery never waits for TomTom.
+
+    Key Responsibilities:
+    1. **Debouncing**: A recalculation starts `debounce_seconds` after it is requested; the requests of the same
+       route arriving in the meantime, or while it runs, are merged into it or into a single following one.
+    2. **Rate Limiting**: Two recalculations of the same route start at least `min_interval_seconds` apart,
+       which bounds the TomTom calls of each route.
+    3. **Failure Handling**: A failed recalculation is logged and reported to `on_failure`; it is not retried
+       until the route is requested again.
+    4. **Counters**: Count requested, merged, executed and failed recalculations.
+    """
+
+    def __init__(self,
+                 process: Callable[..., Awaitable],
+                 on_failure: Optional[Callable[..., Awaitable]] = None,
+                 debounce_seconds: float = RECALC_DEBOUNCE_SECONDS,
+                 min_interval_seconds: float = RECALC_MIN_INTERVAL_SECONDS) -> None:
+        """
+        Args:
+            process (Callable): The coroutine function recalculating a route, called as `process(db, ginc)`.
+            on_failure (Optional[Callable]): The coroutine function called as `on_failure(db, ginc)`
+                when `process` raises.
+            debounce_seconds (float): The time requests are collected before a recalculation starts.
+            min_interval_seconds (float): The minimum time between the starts of two recalculations of a route.
+        """
+        self.process = process
+        self.on_failure = on_failure
+        self.debounce_seconds = debounce_seconds
+        self.min_interval_seconds = min_interval_seconds
+        self.requested = 0
+        self.merged = 0
+        self.runs = 0
+        self.failures = 0
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._dirty: Set[str] = set()
+        self._last_runs: Dict[str, float] = {}
+
+    def request(self, db, ginc: str) -> None:
+        """
+        Requests the recalculation of a route, without waiting for it.
+
+        Args:
+            db: The database the route is stored in.
+            ginc (str): The identifier of the route.
+        """
+        self.requested += 1
+        if ginc in self._workers:
+            self._dirty.add(ginc)
+            self.merged += 1
+            return
+        self._forget_old_runs()
+        self._workers[ginc] = asyncio.create_task(self._run(db, ginc))
+
+    async def close(self) -> None:
+        """
+        Cancels the scheduled and running recalculations. Their routes stay pending.
+        """
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._workers.clear()
+        self._dirty.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the worker.
+        """
+        return {
+            'requested': self.requested,
+            'merged': self.merged,
+            'runs': self.runs,
+            'failures': self.failures,
+            'active_routes': len(self._workers)
+        }
+
+    def _delay(self, ginc: str) -> float:
+        last_run = self._last_runs.get(ginc)
+        if last_run is None:
+            return self.debounce_seconds
+        return max(self.debounce_seconds, self.min_interval_seconds - (time.monotonic() - last_run))
+
+    def _forget_old_runs(self) -> None:
+        now = time.monotonic()
+        self._last_runs = {ginc: last_run for ginc, last_run in self._last_runs.items()
+                           if now - last_run < self.min_interval_seconds}
+
+    async def _run(self, db, ginc: str) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self._delay(ginc))
+                # the requests received up to now are covered by this recalculation
+                self._dirty.discard(ginc)
+                self._last_runs[ginc] = time.monotonic()
+                self.runs += 1
+                try:
+                    await self.process(db, ginc)
+                except Exception as ex:
+                    self.failures += 1
+                    logger.error(f"recalculation of route {ginc} failed: {getattr(ex, 'detail', ex)}")
+                    if self.on_failure is not None:
+                        await self.on_failure(db, ginc)
+                if ginc not in self._dirty:
+                    break
+        finally:
+            self._workers.pop(ginc, None)
+            self._dirty.discard(ginc)
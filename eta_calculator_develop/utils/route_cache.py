@@ -0,0 +1,121 @@
+"""Route Cache"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from model.travel_data import TravelData
+
+
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', 1024))
+ROUTE_CACHE_TTL = float(os.environ.get('ROUTE_CACHE_TTL', 5))
+
+
+class RouteCache():
+    """
+    The `RouteCache` class keeps the last route documents read from the database in memory, so that the polling of
+    the tracking front-end and the route updates do not query the same document again and again.
+
+    Key Responsibilities:
+    1. **Read-through**: `EtaDb.get_route_object` looks up the cache before querying the database.
+    2. **Eviction**: Keep at most `max_size` routes, evicting the least recently used.
+    3. **Expiry**: Discard routes older than `ttl_seconds`. The cache is per process, so the TTL bounds how long
+       a worker can serve a route that another worker changed.
+    4. **Invalidation**: Every write of a route through `EtaDb` drops its entry. A read that started before the
+       write cannot store the document it fetched afterwards (see `generation`).
+    5. **Counters**: Count hits, misses, expirations, evictions, invalidations and discarded stale fills.
+
+    The stored document is never modified: every hit decodes a new route from it, which callers can modify freely.
+    """
+
+    def __init__(self, max_size: int = ROUTE_CACHE_SIZE, ttl_seconds: float = ROUTE_CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        # the generation of the last invalidation of each ginc, for the last `max_size` gincs invalidated
+        self._generation = 0
+        self._invalidated: OrderedDict[str, int] = OrderedDict()
+        self._forgotten_generation = 0
+
+    def get(self, ginc: str) -> Optional[TravelData]:
+        """
+        Returns the route decoded from the cached document `ginc`, or None if it is missing or expired.
+        """
+        entry = self._entries.get(ginc)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        document, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._entries[ginc]
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(ginc)
+        self.hits += 1
+        return TravelData.parse_mongo(document)
+
+    def generation(self) -> int:
+        """
+        Returns the current generation of the cache, to be taken before reading a document that is then `set`.
+        """
+        return self._generation
+
+    def set(self, ginc: str, document: Dict, generation: int) -> None:
+        """
+        Stores a route document just read from the database, unless the route was invalidated after `generation`:
+        the document may then predate the write that invalidated it.
+
+        Args:
+            ginc (str): The ginc of the route.
+            document (Dict): The document read from the database. It must not be modified afterwards.
+            generation (int): The value of `generation()` taken before the document was read.
+        """
+        if self.max_size <= 0 or self.ttl_seconds <= 0:
+            return
+        if self._invalidated.get(ginc, self._forgotten_generation) > generation:
+            self.stale_fills += 1
+            return
+        self._entries[ginc] = (document, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(ginc)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, ginc: str) -> None:
+        """
+        Drops the cached route `ginc`, if any, and starts a new generation for it.
+        """
+        self._generation += 1
+        self._invalidated[ginc] = self._generation
+        self._invalidated.move_to_end(ginc)
+        while len(self._invalidated) > max(self.max_size, 1):
+            # a ginc forgotten here is treated as invalidated at the latest generation forgotten
+            _, self._forgotten_generation = self._invalidated.popitem(last=False)
+        if self._entries.pop(ginc, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'stale_fills': self.stale_fills,
+            'entries': len(self._entries)
+        }
+
+
+route_cache = RouteCache()
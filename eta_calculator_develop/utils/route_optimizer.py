@@ -0,0 +1,290 @@
+"""Local route sequencing"""
+import asyncio
+import heapq
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from loguru import logger
+
+from model.travel_data import TravelData
+from model.travel_matrix import TravelMatrix, point_key
+from utils.travel_matrix import travel_matrices
+
+
+ROUTE_OPTIMIZER_TIME_BUDGET_SECONDS = float(os.environ.get('ROUTE_OPTIMIZER_TIME_BUDGET_SECONDS', 2))
+ROUTE_OPTIMIZER_MIN_WAYPOINTS = int(os.environ.get('ROUTE_OPTIMIZER_MIN_WAYPOINTS', 100))
+ROUTE_OPTIMIZER_NEIGHBOURS = int(os.environ.get('ROUTE_OPTIMIZER_NEIGHBOURS', 16))
+ROUTE_OPTIMIZER_MAX_SEGMENT = 3
+
+
+class RouteOptimizer:
+    """
+    The `RouteOptimizer` class sequences the stops of a route in process, over a travel-time matrix, as a
+    complement to `computeBestOrder` of TomTom: for the routes with more than ROUTE_OPTIMIZER_MIN_WAYPOINTS
+    waypoints, and to re-sequence the stops still to be delivered.
+
+    The path starts and ends at fixed points (the start/ending point of the route, or the current position and the
+    start/ending point); only the stops in between are moved. The costs can be asymmetric.
+
+    Key Responsibilities:
+    1. **Seed**: Build a first path with the nearest neighbour heuristic.
+    2. **Local Search**: Improve it with 2-opt (reversal of a section of the path) and Or-opt (move of a section of
+       up to ROUTE_OPTIMIZER_MAX_SEGMENT stops), until no move improves the path or the time budget is over.
+       Only the moves creating an edge towards one of the ROUTE_OPTIMIZER_NEIGHBOURS closest nodes are tried.
+    3. **Matrix Lookup**: Map the waypoints of a route to the cells of its `TravelMatrix`.
+    4. **Route Sequencing**: Order the waypoints of an uploaded route before TomTom computes its legs, and
+       re-sequence the stops still to be delivered of a stored route.
+    See benchmarks/bench_route_optimizer.py.
+    """
+
+    @staticmethod
+    def sequence(costs: Sequence[Sequence[int]],
+                 time_budget: float = ROUTE_OPTIMIZER_TIME_BUDGET_SECONDS) -> Tuple[List[int], Dict]:
+        """
+        Finds a short path from node 0 to the last node visiting every other node once.
+
+        Args:
+            costs (Sequence[Sequence[int]]): The cost (travel time) from each node to each other node.
+            time_budget (float): The seconds the search can run for.
+
+        Returns:
+            Tuple[List[int], Dict]: The path, starting with 0 and ending with the last node, and the statistics
+                of the search (cost of the seed and of the result, moves applied, elapsed seconds, whether the
+                search converged before the end of the budget).
+        """
+        started = time.monotonic()
+        deadline = started + time_budget
+        path = RouteOptimizer.nearest_neighbour(costs)
+        seed_cost = RouteOptimizer.path_cost(path, costs)
+        neighbours = RouteOptimizer.neighbours(costs)
+
+        moves = 0
+        converged = False
+        while time.monotonic() < deadline:
+            improved = RouteOptimizer.two_opt(path, costs, neighbours, deadline)
+            improved += RouteOptimizer.or_opt(path, costs, neighbours, deadline)
+            moves += improved
+            if not improved:
+                converged = True
+                break
+
+        return path, {
+            'seed_cost': seed_cost,
+            'cost': RouteOptimizer.path_cost(path, costs),
+            'moves': moves,
+            'converged': converged,
+            'elapsed_seconds': round(time.monotonic() - started, 3)
+        }
+
+    @staticmethod
+    def nearest_neighbour(costs: Sequence[Sequence[int]]) -> List[int]:
+        """
+        Returns the path that always moves to the closest node not visited yet, ending at the last node.
+        """
+        end = len(costs) - 1
+        unvisited = set(range(1, end))
+        path = [0]
+        while unvisited:
+            row = costs[path[-1]]
+            closest = min(unvisited, key=row.__getitem__)
+            unvisited.remove(closest)
+            path.append(closest)
+        if end > 0:
+            path.append(end)
+        return path
+
+    @staticmethod
+    def neighbours(costs: Sequence[Sequence[int]]) -> List[List[int]]:
+        """
+        Returns, for each node, the ROUTE_OPTIMIZER_NEIGHBOURS closest other nodes: the local search only tries
+        the moves creating an edge towards one of them.
+        """
+        nodes = range(len(costs))
+        return [heapq.nsmallest(ROUTE_OPTIMIZER_NEIGHBOURS, (other for other in nodes if other != node),
+                                key=costs[node].__getitem__)
+                for node in nodes]
+
+    @staticmethod
+    def two_opt(path: List[int], costs: Sequence[Sequence[int]], neighbours: List[List[int]],
+                deadline: float) -> int:
+        """
+        Applies the improving 2-opt moves found in a pass over `path`, in place.
+
+        Reversing path[i..j] replaces the edges (i-1, i) and (j, j+1) with (i-1, j) and (i, j+1), and runs the
+        section backwards: with asymmetric costs the cost of the section changes too, and is read from prefix sums
+        of the forward and backward costs of the path. Only the j whose node is a neighbour of path[i-1] are tried.
+
+        Returns:
+            int: The number of moves applied.
+        """
+        size = len(path)
+        applied = 0
+        forward, backward, positions = RouteOptimizer._prefix_costs(path, costs)
+        for i in range(1, size - 2):
+            if time.monotonic() >= deadline:
+                break
+            before = path[i - 1]
+            cost_before = costs[before]
+            for candidate in neighbours[before]:
+                j = positions[candidate]
+                if j <= i or j >= size - 1:
+                    continue
+                first, last, after = path[i], path[j], path[j + 1]
+                delta = (cost_before[last] + costs[first][after] + backward[j] - backward[i]
+                         - cost_before[first] - costs[last][after] - forward[j] + forward[i])
+                if delta < 0:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    applied += 1
+                    forward, backward, positions = RouteOptimizer._prefix_costs(path, costs)
+        return applied
+
+    @staticmethod
+    def or_opt(path: List[int], costs: Sequence[Sequence[int]], neighbours: List[List[int]],
+               deadline: float) -> int:
+        """
+        Applies the improving Or-opt moves found in a pass over `path`, in place: a section of 1 to
+        ROUTE_OPTIMIZER_MAX_SEGMENT nodes is moved, in the same direction, between two other consecutive nodes,
+        right after or right before a neighbour of its first node.
+
+        Returns:
+            int: The number of moves applied.
+        """
+        applied = 0
+        positions = {node: position for position, node in enumerate(path)}
+        for length in range(1, ROUTE_OPTIMIZER_MAX_SEGMENT + 1):
+            i = 1
+            while i + length < len(path):
+                if time.monotonic() >= deadline:
+                    return applied
+                first, last = path[i], path[i + length - 1]
+                before, after = path[i - 1], path[i + length]
+                gain = costs[before][first] + costs[last][after] - costs[before][after]
+                best_delta, best_k = 0, None
+                for candidate in neighbours[first]:
+                    position = positions[candidate]
+                    for k in (position, position - 1):
+                        if k < 0 or k >= len(path) - 1 or i - 1 <= k <= i + length - 1:
+                            continue
+                        origin, destination = path[k], path[k + 1]
+                        delta = costs[origin][first] + costs[last][destination] - costs[origin][destination] - gain
+                        if delta < best_delta:
+                            best_delta, best_k = delta, k
+                if best_k is None:
+                    i += 1
+                    continue
+                section = path[i:i + length]
+                del path[i:i + length]
+                insert_at = best_k + 1 if best_k < i else best_k - length + 1
+                path[insert_at:insert_at] = section
+                positions = {node: position for position, node in enumerate(path)}
+                applied += 1
+        return applied
+
+    @staticmethod
+    def path_cost(path: Sequence[int], costs: Sequence[Sequence[int]]) -> int:
+        return sum(costs[origin][destination] for origin, destination in zip(path, path[1:]))
+
+    @staticmethod
+    def matrix_costs(matrix: TravelMatrix, points: Sequence[Tuple[float, float]]) -> List[List[int]]:
+        """
+        Returns the travel times between `points` read from `matrix`, as a dense table.
+
+        Raises:
+            KeyError: If a point is not part of the matrix.
+        """
+        indexes = []
+        for latitude, longitude in points:
+            index = matrix.index(latitude, longitude)
+            if index is None:
+                raise KeyError(f"({latitude}, {longitude}) is not part of the travel matrix")
+            indexes.append(index)
+        size, durations = matrix.size, matrix.durations
+        return [[durations[origin * size + destination] for destination in indexes] for origin in indexes]
+
+    @staticmethod
+    def sequence_points(matrix: TravelMatrix, points: Sequence[Tuple[float, float]],
+                        time_budget: float = ROUTE_OPTIMIZER_TIME_BUDGET_SECONDS) -> List[int]:
+        """
+        Sequences `points` from the first one to the last one, which stay fixed.
+
+        Returns:
+            List[int]: The indexes of `points` in visiting order.
+        """
+        path, stats = RouteOptimizer.sequence(RouteOptimizer.matrix_costs(matrix, points), time_budget)
+        logger.info(f"route of {len(points)} waypoints sequenced locally: cost {stats['seed_cost']} -> "
+                    f"{stats['cost']} with {stats['moves']} moves in {stats['elapsed_seconds']}s"
+                    f"{'' if stats['converged'] else ', time budget exhausted'}")
+        return path
+
+    @staticmethod
+    async def upload_waypoint_order(coordinates: List[Tuple[str, str]]) -> Optional[List[int]]:
+        """
+        Sequences the waypoints of a route being uploaded, if it has more than ROUTE_OPTIMIZER_MIN_WAYPOINTS.
+
+        Steps:
+        1. Build the travel matrix of the distinct waypoints (see `TravelMatrixService.build`).
+        2. Sequence them between the first and the last waypoint, the start/ending point, in a worker thread.
+
+        Args:
+            coordinates (List[Tuple[str, str]]): The (latitude, longitude) of the waypoints, as strings.
+
+        Returns:
+            Optional[List[int]]: The index, in `coordinates`, of the arrival waypoint of each leg, or None if the
+                route is left to `computeBestOrder` or the matrix could not be built.
+        """
+        if len(coordinates) <= ROUTE_OPTIMIZER_MIN_WAYPOINTS:
+            return None
+        points = [(float(latitude), float(longitude)) for latitude, longitude in coordinates]
+        distinct_points = list({point_key(*point): point for point in points}.values())
+        try:
+            matrix = await travel_matrices.build(distinct_points)
+        except Exception as ex:
+            logger.error(f"travel matrix of {len(points)} waypoints not built, sequenced by TomTom: {ex}")
+            return None
+        return (await asyncio.to_thread(RouteOptimizer.sequence_points, matrix, points))[1:]
+
+    @staticmethod
+    def resequence_stops(travel_data: TravelData, matrix: TravelMatrix,
+                         time_budget: float = ROUTE_OPTIMIZER_TIME_BUDGET_SECONDS) -> None:
+        """
+        Re-sequences, in place, the stops still to be delivered of a route.
+
+        The current position (the departure of the first remaining stop) and the arrival of the last remaining
+        stop, the start/ending point, stay fixed. Every stop then departs from the arrival of the stop before it.
+
+        Args:
+            travel_data (TravelData): The route, with only undelivered stops in `stops`.
+            matrix (TravelMatrix): The travel matrix of the route.
+            time_budget (float): The seconds the search can run for.
+
+        Raises:
+            KeyError: If a waypoint is not part of the matrix.
+        """
+        stops = travel_data.stops
+        if len(stops) < 3:
+            return
+        points = [(stops[0].departureLatitude, stops[0].departureLongitude)]
+        points += [(stop.arrivalLatitude, stop.arrivalLongitude) for stop in stops]
+        path = RouteOptimizer.sequence_points(matrix, points, time_budget)
+
+        # the stop arriving at points[index] is stops[index - 1]
+        ordered_stops = [stops[index - 1] for index in path[1:]]
+        departure_address = stops[0].departureAddress
+        for previous, stop in zip([None] + ordered_stops, ordered_stops):
+            if previous is None:
+                stop.departureAddress = departure_address
+                stop.departureLatitude, stop.departureLongitude = points[0]
+            else:
+                stop.departureAddress = previous.arrivalAddress
+                stop.departureLatitude = previous.arrivalLatitude
+                stop.departureLongitude = previous.arrivalLongitude
+        travel_data.stops = ordered_stops
+
+    @staticmethod
+    def _prefix_costs(path: Sequence[int],
+                      costs: Sequence[Sequence[int]]) -> Tuple[List[int], List[int], Dict[int, int]]:
+        forward, backward = [0], [0]
+        for origin, destination in zip(path, path[1:]):
+            forward.append(forward[-1] + costs[origin][destination])
+            backward.append(backward[-1] + costs[destination][origin])
+        return forward, backward, {node: position for position, node in enumerate(path)}
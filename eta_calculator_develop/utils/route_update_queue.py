@@ -0,0 +1,123 @@
+"""Per-route update queue"""
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from model.device_message import DeliveryMessage
+
+
+class RouteUpdateQueue():
+    """
+    The `RouteUpdateQueue` class serializes the delivery confirmations of each route inside a worker.
+
+    Key Responsibilities:
+    1. **Serialization**: At most one recalculation per ginc runs at a time, so two confirmations of the same route
+       never read the same version of the document.
+    2. **Merging**: The confirmations that arrive while a recalculation is running are queued and handed together
+       to the next one, so a burst of confirmations costs a single TomTom call.
+    3. **Recalculations**: A recalculation requested without new confirmations (see `recalculate`) is queued as
+       an empty batch, or joins the confirmations already waiting, so it never races with them. The source it was
+       requested by is passed on to `process` only if every request of the batch has it: a batch including a
+       confirmation, or a recalculation without a source, is a delivery batch.
+    4. **Result Delivery**: Every caller receives the result (or the error) of the batch its confirmation was part of.
+    5. **Counters**: Count submitted confirmations and executed batches.
+    """
+
+    def __init__(self, process: Callable[..., Awaitable]) -> None:
+        """
+        Args:
+            process (Callable): The coroutine function applying a batch of confirmations of the same route,
+                called as `process(db, ginc, updates)`, or `process(db, ginc, updates, source=source)` for
+                a batch made only of recalculations requested with the same source.
+        """
+        self.process = process
+        self.submitted = 0
+        self.batches = 0
+        # a recalculation without confirmations is queued with update None
+        self._pending: Dict[str, List[Tuple[Optional[DeliveryMessage], asyncio.Future]]] = {}
+        # the source shared by all the requests of the pending batch, None for a delivery batch
+        self._sources: Dict[str, Optional[str]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, db, update: DeliveryMessage):
+        """
+        Queues a confirmation and waits until the batch including it has been applied.
+
+        Args:
+            db: The database the route is stored in.
+            update (DeliveryMessage): The delivery confirmation.
+
+        Returns:
+            The result of `process` for the batch including the confirmation.
+
+        Raises:
+            Exception: The error raised by `process` for that batch.
+        """
+        return await self.submit_many(db, [update])
+
+    async def submit_many(self, db, updates: List[DeliveryMessage]):
+        """
+        Queues several confirmations of the same route, which are applied in the same batch. See `submit`.
+        """
+        self.submitted += len(updates)
+        return await self._enqueue(db, updates[0].ginc, updates, None)
+
+    async def recalculate(self, db, ginc: str, source: Optional[str] = None):
+        """
+        Queues a recalculation of the route without new confirmations and waits until it has been applied.
+        If confirmations of the route are already waiting, the recalculation is the batch that applies them.
+
+        Args:
+            db: The database the route is stored in.
+            ginc (str): The identifier of the route.
+            source (Optional[str]): What requested the recalculation, passed on to `process` unless the batch also
+                includes confirmations or requests of another source.
+
+        Returns:
+            The result of `process` for the batch including the recalculation.
+
+        Raises:
+            Exception: The error raised by `process` for that batch.
+        """
+        return await self._enqueue(db, ginc, [], source)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the queue.
+        """
+        return {
+            'submitted': self.submitted,
+            'batches': self.batches,
+            'active_routes': len(self._workers)
+        }
+
+    async def _enqueue(self, db, ginc: str, updates: List[DeliveryMessage], source: Optional[str]):
+        future = asyncio.get_running_loop().create_future()
+        if not self._pending.get(ginc):
+            self._sources[ginc] = source
+        elif self._sources.get(ginc) != source:
+            self._sources[ginc] = None
+        self._pending.setdefault(ginc, []).extend([(update, future) for update in updates] or [(None, future)])
+        if ginc not in self._workers:
+            self._workers[ginc] = asyncio.create_task(self._drain(db, ginc))
+        return await future
+
+    async def _drain(self, db, ginc: str) -> None:
+        try:
+            while self._pending.get(ginc):
+                batch = self._pending.pop(ginc)
+                source = self._sources.pop(ginc, None)
+                options = {'source': source} if source is not None else {}
+                self.batches += 1
+                try:
+                    result = await self.process(db, ginc, [update for update, _ in batch if update is not None],
+                                                **options)
+                except Exception as ex:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(ex)
+                    continue
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._workers.pop(ginc, None)
@@ -0,0 +1,99 @@
+"""Routing Response Cache"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Sequence
+
+
+ROUTING_CACHE_SIZE = int(os.environ.get('ROUTING_CACHE_SIZE', 512))
+ROUTING_CACHE_TTL = int(os.environ.get('ROUTING_CACHE_TTL', 300))
+ROUTING_CACHE_BUCKET_SECONDS = int(os.environ.get('ROUTING_CACHE_BUCKET_SECONDS', 300))
+ROUTING_CACHE_PRECISION = int(os.environ.get('ROUTING_CACHE_PRECISION', 5))
+
+
+class RoutingCache():
+    """
+    The `RoutingCache` class keeps the TomTom routing responses of the last minutes, so that re-uploads, retried
+    route updates and repeated recalculations sending the same waypoints do not call TomTom again.
+
+    Key Responsibilities:
+    1. **Key**: Build a key from the normalized waypoint list, the routing parameters and the departure-time bucket.
+    2. **Eviction**: Keep at most `max_size` responses, evicting the least recently used.
+    3. **Expiry**: Discard responses older than `ttl_seconds`, so that the cached ETAs stay traffic-accurate.
+    4. **Counters**: Count hits, misses, expirations and evictions.
+
+    The cached responses are the decoded JSON documents and must be treated as read-only.
+    """
+
+    def __init__(self, max_size: int = ROUTING_CACHE_SIZE, ttl_seconds: int = ROUTING_CACHE_TTL,
+                 bucket_seconds: int = ROUTING_CACHE_BUCKET_SECONDS,
+                 precision: int = ROUTING_CACHE_PRECISION) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.bucket_seconds = max(bucket_seconds, 1)
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple] = OrderedDict()
+
+    def make_key(self, coordinates: Sequence[Sequence], parameters: Dict[str, str]) -> Hashable:
+        """
+        Builds the cache key of a routing request.
+
+        Args:
+            coordinates (Sequence[Sequence]): The waypoints, as (latitude, longitude) pairs of strings or numbers.
+            parameters (Dict[str, str]): The routing parameters (computeBestOrder, traffic, ...).
+
+        Returns:
+            Hashable: The key, including the current departure-time bucket.
+        """
+        waypoints = tuple((round(float(latitude), self.precision), round(float(longitude), self.precision))
+                          for latitude, longitude in coordinates)
+        return waypoints, tuple(sorted(parameters.items())), int(time.time() // self.bucket_seconds)
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        """
+        Returns the cached response for `key`, or None if it is missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        response, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def set(self, key: Hashable, response: dict) -> None:
+        """
+        Stores the response of a routing request.
+        """
+        self._entries[key] = (response, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'entries': len(self._entries)
+        }
+
+
+routing_cache = RoutingCache()
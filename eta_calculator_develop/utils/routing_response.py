@@ -0,0 +1,48 @@
+"""Decoding of the TomTom routing responses"""
+import json
+from typing import Dict, List
+
+
+SUMMARY_FIELDS = ("lengthInMeters", "travelTimeInSeconds", "trafficDelayInSeconds", "trafficLengthInMeters",
+                  "departureTime", "arrivalTime")
+
+
+def decode_routing_response(content: bytes) -> Dict:
+    """
+    Decodes a TomTom calculateRoute response and keeps only the fields used by the pipeline: the route and leg
+    summaries, the travel mode, the optimized waypoint order and, when the geometry was requested, the leg points.
+
+    Args:
+        content (bytes): The raw body of the response.
+
+    Returns:
+        Dict: A response with the same structure of the TomTom one, limited to the fields listed above.
+    """
+
+    json_response = json.loads(content)
+    route = json_response["routes"][0]
+
+    slim_route = {
+        "summary": _summary(route["summary"]),
+        "sections": [{"travelMode": route["sections"][0]["travelMode"]}] if route.get("sections") else [],
+        "legs": [_leg(leg) for leg in route["legs"]]
+    }
+
+    slim_response = {"routes": [slim_route]}
+    if json_response.get("optimizedWaypoints"):
+        slim_response["optimizedWaypoints"] = [
+            {"providedIndex": waypoint["providedIndex"], "optimizedIndex": waypoint["optimizedIndex"]}
+            for waypoint in json_response["optimizedWaypoints"]]
+    return slim_response
+
+
+def _summary(summary: Dict) -> Dict:
+    return {field: summary[field] for field in SUMMARY_FIELDS if field in summary}
+
+
+def _leg(leg: Dict) -> Dict:
+    slim_leg = {"summary": _summary(leg["summary"])}
+    points: List[Dict] = leg.get("points")
+    if points:
+        slim_leg["points"] = points
+    return slim_leg
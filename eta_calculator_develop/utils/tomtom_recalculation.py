@@ -1,10 +1,24 @@
-import requests
 from model.travel_data import TravelData
+from model.travel_matrix import TravelMatrix
 from model.device_message import DeliveryMessage
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from loguru import logger
+from utils.http_client import tomtom_client
+from utils.routing_cache import routing_cache
+from utils.routing_response import decode_routing_response
+from typing import List, Optional
 import os
-import pytz
+
+
+RECALCULATION_PARAMETERS = {
+    "routeType": "fastest",
+    "travelMode": "car",
+    "routeRepresentation": "summaryOnly",
+    "departAt": "now",
+    "computeBestOrder": "false",
+    "traffic": "true"
+}
+
 
 class TomTomRecalculation:
     """
@@ -19,18 +33,22 @@ class TomTomRecalculation:
     """
 
     @staticmethod
-    def order_travel_data(travel_data: TravelData) -> TravelData:
+    async def order_travel_data(travel_data: TravelData, matrix: Optional[TravelMatrix] = None) -> TravelData:
         """
         Updates the delivery status of a specific order and recalculates route details.
 
         Steps:
         1. Check if any stop is not delivered.
-        2. If undelivered stops exist, updates the travel data and calls TomTom's API.
-        3. Recalculates the route using TomTom’s services.
-        4. Adjusts the ETA based on the updated route data.
+        2. If undelivered stops exist, updates the travel data.
+        3. If the travel matrix of the route is given and contains every remaining waypoint, computes the legs
+           with lookups in the matrix, leaving now (see `matrix_travel_data`).
+        4. Otherwise recalculates the route using TomTom’s services, reusing the cached response when the same
+           remaining waypoints were routed in the current departure-time bucket, and records when it was routed.
+        5. Adjusts the ETA based on the updated route data.
 
         Args:
             travel_data (TravelData): The travel data containing the current route and stops.
+            matrix (Optional[TravelMatrix]): The travel matrix of the route, if it has one.
 
         Returns:
             TravelData: The updated travel data with new ETAs and route details.
@@ -42,16 +60,76 @@ class TomTomRecalculation:
 
             new_travel_data = TomTomRecalculation.update_travel_data_delivers(
                 travel_data)
-            tomtom_url = TomTomRecalculation.create_request_string(
-                new_travel_data)
-            json_response = TomTomRecalculation.tomtom_request(tomtom_url)
+            if matrix is not None:
+                matrix_travel_data = TomTomRecalculation.matrix_travel_data(new_travel_data, matrix)
+                if matrix_travel_data is not None:
+                    return matrix_travel_data
+            cache_key = routing_cache.make_key(
+                TomTomRecalculation.remaining_coordinates(new_travel_data), RECALCULATION_PARAMETERS)
+            json_response = routing_cache.get(cache_key)
+            if json_response is None:
+                tomtom_url = TomTomRecalculation.create_request_string(
+                    new_travel_data)
+                json_response = await TomTomRecalculation.tomtom_request(tomtom_url)
+                routing_cache.set(cache_key, json_response)
             ordered_travel_data = TomTomRecalculation.parse_tomtom_response(
                 json_response, new_travel_data)
+            ordered_travel_data.routed_at = datetime.now(timezone.utc)
             return ordered_travel_data
         else:
             logger.info("All deliveries were done")
             return travel_data
 
+    @staticmethod
+    def matrix_travel_data(travel_data: TravelData, matrix: TravelMatrix) -> Optional[TravelData]:
+        """
+        Recalculates the legs of the undelivered stops with the travel matrix of the route instead of TomTom.
+
+        Steps:
+        1. Looks up the remaining waypoints in the matrix.
+        2. Chains the legs from now: each stop departs when the previous one arrives, after the travel time
+           of the matrix.
+        3. Updates the summary with the totals of the remaining legs.
+
+        Args:
+            travel_data (TravelData): The travel data, with only undelivered stops.
+            matrix (TravelMatrix): The travel matrix of the route.
+
+        Returns:
+            Optional[TravelData]: The updated travel data, or None if a waypoint is not part of the matrix.
+        """
+        indexes = [matrix.index(latitude, longitude)
+                   for latitude, longitude in TomTomRecalculation.remaining_coordinates(travel_data)]
+        if None in indexes:
+            return None
+
+        started = departure_time = datetime.now(timezone.utc)
+        total_length = total_time = 0
+        for stop, origin, destination in zip(travel_data.stops, indexes, indexes[1:]):
+            length = matrix.length(origin, destination)
+            travel_time = matrix.duration(origin, destination)
+            arrival_time = departure_time + timedelta(seconds=travel_time)
+            stop.lengthInMeters = length
+            stop.travelTimeInSeconds = travel_time
+            stop.trafficDelayInSeconds = 0
+            stop.trafficLengthInMeters = 0
+            stop.departureTime = departure_time
+            stop.arrivalTime = arrival_time
+            departure_time = arrival_time
+            total_length += length
+            total_time += travel_time
+
+        summary = travel_data.summary
+        summary.lengthInMeters = total_length
+        summary.travelTimeInSeconds = total_time
+        summary.trafficDelayInSeconds = 0
+        summary.trafficLengthInMeters = 0
+        summary.departureTime = started
+        summary.arrivalTime = departure_time
+        travel_data.update_summary_endpoints()
+
+        return travel_data
+
     @staticmethod
     def create_request_string(travel_data: TravelData) -> str:
         """
@@ -68,6 +146,29 @@ class TomTomRecalculation:
             str: The formatted request string for the TomTom API.
         """
 
+        coordinate_list = TomTomRecalculation.remaining_coordinates(travel_data)
+        coordinate_str = ":".join(
+            [f"{coord[0]},{coord[1]}" for coord in coordinate_list])
+
+        return (
+            coordinate_str
+            + "/json?"
+            + "&".join(f"{key}={value}" for key, value in RECALCULATION_PARAMETERS.items())
+        )
+
+    @staticmethod
+    def remaining_coordinates(travel_data: TravelData) -> List[List[float]]:
+        """
+        Returns the waypoints still to be visited: the departure of the first undelivered stop
+        followed by the arrival of every undelivered stop.
+
+        Args:
+            travel_data (TravelData): The travel data containing the current stops.
+
+        Returns:
+            List[List[float]]: The (latitude, longitude) pairs of the remaining waypoints.
+        """
+
         departure_coordinates = None
         arrival_coordinates = []
 
@@ -83,28 +184,17 @@ class TomTomRecalculation:
                 arrival_coordinates.append(
                     [single_stop.arrivalLatitude, single_stop.arrivalLongitude])
 
-        coordinate_list = [departure_coordinates] + arrival_coordinates
-        coordinate_str = ":".join(
-            [f"{coord[0]},{coord[1]}" for coord in coordinate_list])
-
-        return (
-            coordinate_str
-            + "/json?routeType=fastest"
-            + "&travelMode=car"
-            + "&routeRepresentation=summaryOnly"
-            + "&departAt=now"
-            + "&computeBestOrder=false"
-            + "&traffic=true"
-        )
+        return [departure_coordinates] + arrival_coordinates
 
     @staticmethod
-    def tomtom_request(request_params: str) -> TravelData:
+    async def tomtom_request(request_params: str) -> TravelData:
         """
         Sends a request to the TomTom API to get route details.
 
         Steps:
-        1. Builds the full URL using the base URL, request parameters, and API key.
-        2. Sends the GET request to TomTom's API and processes the response.
+        1. Builds the request path using the request parameters.
+        2. Sends the GET request through the shared HTTP client, which pools connections,
+           applies the timeouts and retries transient failures, and processes the response.
 
         Args:
             request_params (str): The request parameters to be appended to the TomTom URL.
@@ -114,27 +204,18 @@ class TomTomRecalculation:
 
         Raises:
             ValueError: If the TomTom API key is not set.
-            requests.exceptions.RequestException: If there's an issue with the HTTP request.
+            httpx.HTTPError: If there's an issue with the HTTP request.
         """
 
-        baseUrl = "https://api.tomtom.com/routing/1/calculateRoute/"
         API_KEY = os.getenv("TOMTOM_API_KEY")
         if not API_KEY:
             raise ValueError("TOMTOM_API_KEY environment variable is not set.")
 
-        requestUrl = baseUrl + request_params + "&key=" + API_KEY
-        logger.info("Request URL: " + requestUrl + "\n")
-
-        response = requests.get(requestUrl)
-        # logger.info(response)
-        response.raise_for_status()
-
-        if response.status_code == 200:
-            jsonResult = response.json()
-            return jsonResult
-        else:
-            return None
+        requestPath = "/routing/1/calculateRoute/" + request_params
+        logger.info("Request path: " + requestPath + "\n")
 
+        response = await tomtom_client.get(requestPath, params={"key": API_KEY})
+        return decode_routing_response(response.content)
 
     @staticmethod
     def parse_tomtom_response(json_response: dict, travel_data: TravelData) -> TravelData:
@@ -184,8 +265,7 @@ class TomTomRecalculation:
                 leg_data["summary"]["arrivalTime"])
             # logger.info(f"the arrival time of the stop is {stop.arrivalTime}")
 
-        travel_data.summary.startAddress = travel_data.stops[0].departureAddress
-        travel_data.summary.endAddress = travel_data.stops[-1].arrivalAddress
+        travel_data.update_summary_endpoints()
 
         return travel_data
 
@@ -196,8 +276,9 @@ class TomTomRecalculation:
         Updates the route with delivery information for a specific stop.
 
         Steps:
-        1. Finds the stop based on the GSIN and updates the delivered status and delivery time.
-        2. Recalculates the route if the stop is successfully marked as delivered.
+        1. Finds the stop containing the GSIN and records its delivery time.
+        2. Marks the stop as delivered once every GSIN grouped in it has been delivered.
+        3. Recalculates the route if the stop is successfully marked as delivered.
 
         Args:
             travel_data (TravelData): The travel data containing the stops.
@@ -211,11 +292,14 @@ class TomTomRecalculation:
         delivered_at = update.delivery_time
 
         for stop in travel_data.stops:
-            if stop.gsin == gsin:
-                if stop.delivered is False:
-
-                    stop.delivered_at = delivered_at
-                    stop.delivered = True
+            stop_gsins = stop.gsins or [stop.gsin]
+            if gsin in stop_gsins:
+                if stop.delivered is False and gsin not in stop.delivered_gsins:
+
+                    stop.delivered_gsins[gsin] = delivered_at
+                    if all(stop_gsin in stop.delivered_gsins for stop_gsin in stop_gsins):
+                        stop.delivered_at = delivered_at
+                        stop.delivered = True
                 else:
                     logger.info(
                         "not possible to update route file, shipment already delivered")
@@ -223,7 +307,7 @@ class TomTomRecalculation:
 
         for stop in travel_data.delivered_stops:
             logger.info(f"Stop GSIN {stop.gsin} - Delivered_at: {stop.delivered_at}")
-            if stop.gsin == gsin:
+            if gsin in (stop.gsins or [stop.gsin]):
                 logger.info(
                     "not possible to update route file, shipment already delivered")
                 return travel_data
@@ -250,9 +334,9 @@ class TomTomRecalculation:
             TravelData: The updated travel data with delivered stops moved to `delivered_stops`.
         """
 
-        for stop in travel_data.stops:
-            if stop.delivered:
-                travel_data.delivered_stops.append(stop)
-                del travel_data.stops[travel_data.stops.index(stop)]
+        delivered_stops = [stop for stop in travel_data.stops if stop.delivered]
+        if delivered_stops:
+            travel_data.delivered_stops.extend(delivered_stops)
+            travel_data.stops = [stop for stop in travel_data.stops if not stop.delivered]
 
         return travel_data
@@ -1,12 +1,24 @@
-from typing import Dict, List
-import requests
+from typing import Dict, List, Optional, Tuple
 from model.delivery import Address
 from model.travel_data import StopSummary, Summary, TravelData
 from datetime import datetime
 from loguru import logger
+from utils.http_client import tomtom_client
+from utils.routing_cache import routing_cache
+from utils.routing_response import decode_routing_response
 import os
 
 
+ROUTING_PARAMETERS = {
+    "routeType": "fastest",
+    "travelMode": "car",
+    "routeRepresentation": "summaryOnly",
+    "departAt": "now",
+    "computeBestOrder": "true",
+    "traffic": "true"
+}
+
+
 class TomTom:
     """
     The TomTom class provides methods for interacting with the TomTom Routing API to calculate optimal routes
@@ -23,36 +35,59 @@ class TomTom:
     """
 
     @staticmethod
-    def order_travel_data(coordinates: List[str]) -> TravelData:
+    async def order_travel_data(coordinates: List[str], include_geometry: bool = False,
+                                waypoint_order: Optional[List[int]] = None) -> TravelData:
         """
         Generate a TravelData object enriched with route details and ETAs using TomTom's API.
 
+        Only the summaries and the optimized waypoint order are requested; the polylines of the legs are requested
+        only when `include_geometry` is True. When `waypoint_order` is given (see `RouteOptimizer`), the waypoints
+        are requested in that order, without `computeBestOrder`.
+
         Steps:
         1. Create a request URL with the provided coordinates.
-        2. Send the request to TomTom's routing service and obtains in response a JSON.
+        2. Send the request to TomTom's routing service and obtains in response a JSON, unless the same
+           waypoints were routed in the current departure-time bucket and the response is still cached.
         3. Parse the JSON response to extract route details and stop information.
         4. Populate a TravelData object with the calculated route data.
 
         Args:
             coordinates (List[str]): A list of coordinates (latitude, longitude) as strings.
+            include_geometry (bool): Whether to request the polyline of every leg; the stop coordinates are then
+                the ones snapped by TomTom instead of the requested ones.
+            waypoint_order (Optional[List[int]]): The index, in `coordinates`, of the arrival waypoint of each leg,
+                if the stops were already sequenced.
 
         Returns:
             TravelData: The enriched TravelData object containing route and stop information.
 
         Raises:
             ValueError: If the TOMTOM_API_KEY environment variable is not set.
-            HTTPError: If the TomTom API request fails.
+            HTTPStatusError: If the TomTom API request fails.
         """
 
-        tomtom_url = TomTom.create_request_string(coordinates)
-        json_response = TomTom.tomtom_request(tomtom_url)
+        parameters = ROUTING_PARAMETERS
+        if include_geometry:
+            parameters = {**ROUTING_PARAMETERS, "routeRepresentation": "polyline"}
+        if waypoint_order is not None:
+            parameters = {**parameters, "computeBestOrder": "false"}
+            coordinates = [coordinates[0]] + [coordinates[index] for index in waypoint_order]
+
+        cache_key = routing_cache.make_key(coordinates, parameters)
+        json_response = routing_cache.get(cache_key)
+        if json_response is None:
+            tomtom_url = TomTom.create_request_string(coordinates, parameters)
+            json_response = await TomTom.tomtom_request(tomtom_url)
+            routing_cache.set(cache_key, json_response)
         ordered_travel_data = TomTom.parse_tomtom_response(
-            json_response)
+            json_response, coordinates)
+        if waypoint_order is not None:
+            ordered_travel_data.waypoint_order = list(waypoint_order)
 
         return ordered_travel_data
 
     @staticmethod
-    def create_request_string(coordinate_list: List[str]) -> str:
+    def create_request_string(coordinate_list: List[str], parameters: Dict[str, str] = ROUTING_PARAMETERS) -> str:
         """
         Construct a TomTom API request string from a list of coordinates.
 
@@ -62,6 +97,7 @@ class TomTom:
 
         Args:
             coordinate_list (List[str]): A list of coordinates (latitude, longitude) as strings.
+            parameters (Dict[str, str]): The routing parameters of the request.
 
         Returns:
             str: A formatted request string to be used in the TomTom API URL.
@@ -74,23 +110,20 @@ class TomTom:
 
         return (
             coordinate_str[1:]
-            + "/json?routeType=fastest"
-            + "&travelMode=car"
-            + "&routeRepresentation=polyline"
-            + "&departAt=now"
-            + "&computeBestOrder=true"
-            + "&traffic=true"
+            + "/json?"
+            + "&".join(f"{key}={value}" for key, value in parameters.items())
         )
 
     @staticmethod
-    def tomtom_request(request_params: str) -> TravelData:
+    async def tomtom_request(request_params: str) -> TravelData:
         """
         Make a request to the TomTom API and return the JSON response.
 
         Steps:
-        1. Construct the full request URL using the provided parameters.
-        2. Send the request to TomTom's API.
-        3. Obtains the response which is in JSON format.
+        1. Construct the request path using the provided parameters.
+        2. Send the request to TomTom's API through the shared HTTP client, which pools connections,
+           applies the timeouts and retries transient failures.
+        3. Decodes the JSON response, keeping only the fields used by the pipeline.
 
         Args:
             request_params (str): The query string parameters for the TomTom request.
@@ -100,48 +133,45 @@ class TomTom:
 
         Raises:
             ValueError: If the TOMTOM_API_KEY environment variable is not set.
-            HTTPError: If the TomTom API request fails.
+            HTTPStatusError: If the TomTom API request fails.
         """
 
-        baseUrl = "https://api.tomtom.com/routing/1/calculateRoute/"
         API_KEY = os.getenv("TOMTOM_API_KEY")
 
         if not API_KEY:
             raise ValueError("TOMTOM_API_KEY environment variable is not set.")
 
-        requestUrl = baseUrl + request_params + "&key=" + API_KEY
-        logger.info("Request URL: " + requestUrl + "\n")
-
-        response = requests.get(requestUrl)
-        # logger.info(response)
-        response.raise_for_status()
+        requestPath = "/routing/1/calculateRoute/" + request_params
+        logger.info("Request path: " + requestPath + "\n")
 
-        if response.status_code == 200:
-            jsonResult = response.json()
-            return jsonResult
-        else:
-            return None
+        response = await tomtom_client.get(requestPath, params={"key": API_KEY})
+        return decode_routing_response(response.content)
 
     @staticmethod
-    def parse_tomtom_response(json_response: dict) -> TravelData:
+    def parse_tomtom_response(json_response: dict, coordinates: List[str] = None) -> TravelData:
         """
         Parse the response from TomTom and populate a TravelData object.
 
         Steps:
         1. Extract relevant information from the JSON response (e.g., route summary, stop details).
-        2. Create TravelData objects populated with the parsed data.
+        2. Locate the departure and arrival of each leg: the first and last point of the leg when the polyline was
+           requested, otherwise the requested coordinates in the optimized waypoint order.
+        3. Create TravelData objects populated with the parsed data.
 
         Args:
             json_response (dict): The JSON response from TomTom's API containing routing information.
+            coordinates (List[str]): The requested coordinates (latitude, longitude), needed when the response
+                does not contain the polylines.
 
         Returns:
             TravelData: A TravelData object populated with parsed information, including summary and stops.
         """
 
-        tomtom_start_latitude = json_response["routes"][0]["legs"][0]["points"][0]["latitude"]
-        tomtom_start_longitude = json_response["routes"][0]["legs"][0]["points"][0]["longitude"]
-        tomtom_end_latitude = json_response['routes'][0]['legs'][-1]['points'][-1]["latitude"]
-        tomtom_end_longitude = json_response['routes'][0]['legs'][-1]['points'][-1]["longitude"]
+        waypoint_order = TomTom.parse_waypoint_order(json_response)
+        leg_endpoints = TomTom.parse_leg_endpoints(json_response, coordinates, waypoint_order)
+
+        tomtom_start_latitude, tomtom_start_longitude = leg_endpoints[0][0]
+        tomtom_end_latitude, tomtom_end_longitude = leg_endpoints[-1][1]
         start_time_iso = datetime.fromisoformat(
             json_response["routes"][0]["summary"]["departureTime"])
         end_time_iso = datetime.fromisoformat(
@@ -149,7 +179,7 @@ class TomTom:
 
         route_summary = Summary(
 
-            travelMode=json_response["routes"][0]["sections"][0]["travelMode"],
+            travelMode=(json_response["routes"][0].get("sections") or [{"travelMode": ""}])[0]["travelMode"],
             lengthInMeters=json_response["routes"][0]["summary"]["lengthInMeters"],
             travelTimeInSeconds=json_response["routes"][0]["summary"]["travelTimeInSeconds"],
             trafficDelayInSeconds=json_response["routes"][0]["summary"]["trafficDelayInSeconds"],
@@ -168,11 +198,9 @@ class TomTom:
 
         stops = []
 
-        for leg_data in json_response["routes"][0]["legs"]:
-            tomtom_departure_latitude = leg_data["points"][0]["latitude"]
-            tomtom_departure_longitude = leg_data["points"][0]["longitude"]
-            tomtom_arrival_latitude = leg_data['points'][-1]["latitude"]
-            tomtom_arrival_longitude = leg_data['points'][-1]["longitude"]
+        for leg_data, (departure, arrival) in zip(json_response["routes"][0]["legs"], leg_endpoints):
+            tomtom_departure_latitude, tomtom_departure_longitude = departure
+            tomtom_arrival_latitude, tomtom_arrival_longitude = arrival
             departure_time_iso = datetime.fromisoformat(
                 leg_data["summary"]["departureTime"])
             arrival_time_iso = datetime.fromisoformat(
@@ -203,8 +231,62 @@ class TomTom:
             summary=route_summary,
             ginc="some_ginc",
             stops=stops,
-            delivered_stops=[]
+            delivered_stops=[],
+            waypoint_order=waypoint_order
 
         )
         # logger.info(tomtom_travel_data)
         return tomtom_travel_data
+
+    @staticmethod
+    def parse_waypoint_order(json_response: dict) -> List[int]:
+        """
+        Extract from the TomTom response the order in which the waypoints are visited.
+
+        TomTom lists in `optimizedWaypoints` the provided and optimized index of every waypoint except the
+        origin and the destination, which are fixed.
+
+        Args:
+            json_response (dict): The JSON response from TomTom's API containing routing information.
+
+        Returns:
+            List[int]: The index, in the requested coordinates, of the arrival waypoint of each leg.
+        """
+
+        legs_count = len(json_response["routes"][0]["legs"])
+        optimized_waypoints = sorted(json_response.get("optimizedWaypoints") or [],
+                                     key=lambda waypoint: waypoint["optimizedIndex"])
+        if len(optimized_waypoints) != legs_count - 1:
+            return list(range(1, legs_count + 1))
+
+        return [waypoint["providedIndex"] + 1 for waypoint in optimized_waypoints] + [legs_count]
+
+    @staticmethod
+    def parse_leg_endpoints(json_response: dict, coordinates: List[str],
+                            waypoint_order: List[int]) -> List[Tuple[Tuple[float, float], Tuple[float, float]]]:
+        """
+        Return the departure and arrival coordinates of each leg of the route.
+
+        Args:
+            json_response (dict): The JSON response from TomTom's API containing routing information.
+            coordinates (List[str]): The requested coordinates (latitude, longitude).
+            waypoint_order (List[int]): The index of the arrival waypoint of each leg, see `parse_waypoint_order`.
+
+        Returns:
+            List[Tuple[Tuple[float, float], Tuple[float, float]]]: The (departure, arrival) pair of each leg.
+
+        Raises:
+            ValueError: If the response has no polylines and the requested coordinates are not provided.
+        """
+
+        legs = json_response["routes"][0]["legs"]
+        if all(leg.get("points") for leg in legs):
+            return [((leg["points"][0]["latitude"], leg["points"][0]["longitude"]),
+                     (leg["points"][-1]["latitude"], leg["points"][-1]["longitude"])) for leg in legs]
+
+        if not coordinates:
+            raise ValueError("the requested coordinates are needed to parse a response without polylines")
+
+        points = [(float(latitude), float(longitude)) for latitude, longitude in coordinates]
+        departure_points = [0] + waypoint_order[:-1]
+        return [(points[departure], points[arrival]) for departure, arrival in zip(departure_points, waypoint_order)]
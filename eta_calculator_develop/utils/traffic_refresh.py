@@ -0,0 +1,196 @@
+"""Scheduled traffic refresh of the active routes"""
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from controller.db.eta_calculator_db import EtaDb
+from controller.db.route_document import RouteDocument
+from utils.http_client import tomtom_client
+
+
+TRAFFIC_REFRESH_ENABLED = os.environ.get('TRAFFIC_REFRESH_ENABLED', 'true').lower() == 'true'
+TRAFFIC_REFRESH_INTERVAL_SECONDS = int(os.environ.get('TRAFFIC_REFRESH_INTERVAL_SECONDS', 900))
+TRAFFIC_REFRESH_JITTER_SECONDS = int(os.environ.get('TRAFFIC_REFRESH_JITTER_SECONDS', 60))
+TRAFFIC_REFRESH_MIN_AGE_SECONDS = int(os.environ.get('TRAFFIC_REFRESH_MIN_AGE_SECONDS', 600))
+TRAFFIC_REFRESH_MAX_ROUTES = int(os.environ.get('TRAFFIC_REFRESH_MAX_ROUTES', 200))
+TRAFFIC_REFRESH_BATCH_SIZE = int(os.environ.get('TRAFFIC_REFRESH_BATCH_SIZE', 10))
+TRAFFIC_REFRESH_BATCH_INTERVAL_SECONDS = float(os.environ.get('TRAFFIC_REFRESH_BATCH_INTERVAL_SECONDS', 10))
+TRAFFIC_REFRESH_BATCH_JITTER_SECONDS = float(os.environ.get('TRAFFIC_REFRESH_BATCH_JITTER_SECONDS', 2))
+
+# the source of the recalculations requested by the refresh, and of their TomTom requests
+TRAFFIC_SOURCE = 'traffic'
+
+
+class TrafficRefresher():
+    """
+    The `TrafficRefresher` class periodically recalculates the remaining legs of the routes of the day, so that their
+    ETAs follow the traffic even when no delivery is confirmed.
+
+    Key Responsibilities:
+    1. **Scheduling**: An APScheduler interval job runs `refresh` every `interval_seconds`, shifted by a random
+       jitter of up to `jitter_seconds`; a run never overlaps the previous one.
+    2. **Route Selection**: The routes of today (personal_id) with stops still to be delivered are read with a
+       projection, least recently routed by TomTom first; the ones routed in the last `min_age_seconds`, after a
+       delivery or by a previous refresh, are skipped, and at most `max_routes` are refreshed per run, so that
+       the runs rotate through all the routes.
+    3. **Rate Limiting**: The routes are refreshed `batch_size` at a time, and two batches start at least
+       `batch_interval_seconds` apart, plus a random jitter of up to `batch_jitter_seconds`. The TomTom calls of a
+       run are therefore bounded by `max_routes`, and spread over `max_routes / batch_size` batch intervals.
+    4. **Counters**: Count runs, refreshed, skipped and failed routes, batch durations and the TomTom requests of
+       the refresh, the ones sent with the 'traffic' request source. A route whose recalculation also applies
+       confirmations is recalculated as a delivery (see `RouteUpdateQueue`), and its requests are not counted.
+    """
+
+    def __init__(self,
+                 process: Callable[..., Awaitable],
+                 enabled: bool = TRAFFIC_REFRESH_ENABLED,
+                 interval_seconds: int = TRAFFIC_REFRESH_INTERVAL_SECONDS,
+                 jitter_seconds: int = TRAFFIC_REFRESH_JITTER_SECONDS,
+                 min_age_seconds: int = TRAFFIC_REFRESH_MIN_AGE_SECONDS,
+                 max_routes: int = TRAFFIC_REFRESH_MAX_ROUTES,
+                 batch_size: int = TRAFFIC_REFRESH_BATCH_SIZE,
+                 batch_interval_seconds: float = TRAFFIC_REFRESH_BATCH_INTERVAL_SECONDS,
+                 batch_jitter_seconds: float = TRAFFIC_REFRESH_BATCH_JITTER_SECONDS) -> None:
+        """
+        Args:
+            process (Callable): The coroutine function recalculating a route, called as `process(db, ginc)`.
+        """
+        self.process = process
+        self.enabled = enabled
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.min_age_seconds = min_age_seconds
+        self.max_routes = max_routes
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval_seconds = batch_interval_seconds
+        self.batch_jitter_seconds = batch_jitter_seconds
+        self._metrics = {
+            'runs': 0,
+            'refreshed': 0,
+            'skipped': 0,
+            'failed': 0,
+            'batches': 0,
+            'batch_seconds_total': 0.0,
+            'batch_seconds_max': 0.0,
+            'last_batch_seconds': 0.0,
+            'tomtom_requests': 0,
+            'last_run_at': None,
+            'last_run_seconds': 0.0,
+            'last_run_tomtom_requests': 0
+        }
+        self._db: Optional[AsyncIOMotorDatabase] = None
+        self._scheduler: Optional[AsyncIOScheduler] = None
+
+    def start(self, db: AsyncIOMotorDatabase) -> None:
+        """
+        Schedules the periodic refresh of the routes stored in the database `db`.
+        """
+        self._db = db
+        if not self.enabled or self._scheduler is not None:
+            return
+        self._scheduler = AsyncIOScheduler()
+        self._scheduler.add_job(self.refresh, 'interval', seconds=self.interval_seconds, jitter=self.jitter_seconds,
+                                max_instances=1, coalesce=True, id='traffic_refresh')
+        self._scheduler.start()
+
+    def close(self) -> None:
+        """
+        Stops scheduling the refresh.
+        """
+        if self._scheduler is not None:
+            self._scheduler.shutdown(wait=False)
+            self._scheduler = None
+
+    async def refresh(self) -> int:
+        """
+        Refreshes the active routes of today that were not routed by TomTom recently.
+
+        Returns:
+            int: The number of routes refreshed.
+        """
+        if self._db is None:
+            return 0
+        started = time.monotonic()
+        requests_before = self.tomtom_requests()
+
+        gincs = await self.routes_to_refresh(datetime.now().strftime("%Y_%m_%d"))
+        refreshed = 0
+        for start in range(0, len(gincs), self.batch_size):
+            if start:
+                await asyncio.sleep(max(self.batch_interval_seconds - self._metrics['last_batch_seconds'], 0)
+                                    + random.uniform(0, self.batch_jitter_seconds))
+            refreshed += await self._refresh_batch(gincs[start:start + self.batch_size])
+
+        requests = self.tomtom_requests() - requests_before
+        elapsed = time.monotonic() - started
+        self._metrics['runs'] += 1
+        self._metrics['tomtom_requests'] += requests
+        self._metrics['last_run_at'] = datetime.now(timezone.utc).isoformat()
+        self._metrics['last_run_seconds'] = round(elapsed, 3)
+        self._metrics['last_run_tomtom_requests'] = requests
+        logger.info(f"traffic refresh: {refreshed} of {len(gincs)} routes refreshed in {elapsed:.1f}s "
+                    f"with {requests} TomTom requests")
+        return refreshed
+
+    async def routes_to_refresh(self, date: str) -> List[str]:
+        """
+        Returns the ginc of the active routes of the day `date` that were not routed by TomTom in the last
+        `min_age_seconds`, at most `max_routes` of them, the least recently routed first.
+        """
+        refreshed_after = datetime.now(timezone.utc) - timedelta(seconds=self.min_age_seconds)
+        gincs = []
+        try:
+            async for document in EtaDb.stream_active_routes(self._db, date):
+                routed_at = RouteDocument.decode_recalculation(document)['routed_at']
+                if routed_at is not None and routed_at > refreshed_after:
+                    self._metrics['skipped'] += 1
+                    continue
+                gincs.append(document['ginc'])
+                if len(gincs) == self.max_routes:
+                    break
+        except Exception as ex:
+            logger.error(f"traffic refresh, error reading the routes of {date}: {ex}")
+        return gincs
+
+    @staticmethod
+    def tomtom_requests() -> int:
+        """
+        Returns the number of TomTom requests sent so far by the recalculations of the refresh.
+        """
+        return tomtom_client.stats()['requests_by_source'].get(TRAFFIC_SOURCE, 0)
+
+    def stats(self) -> Dict:
+        """
+        Returns the counters of the refresh.
+        """
+        batches = self._metrics['batches']
+        return {
+            'enabled': self.enabled,
+            'interval_seconds': self.interval_seconds,
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self._metrics.items()},
+            'batch_seconds_avg': round(self._metrics['batch_seconds_total'] / batches, 3) if batches else 0.0
+        }
+
+    async def _refresh_batch(self, gincs: List[str]) -> int:
+        started = time.monotonic()
+        results = await asyncio.gather(*[self.process(self._db, ginc) for ginc in gincs], return_exceptions=True)
+        elapsed = time.monotonic() - started
+
+        failed = 0
+        for ginc, result in zip(gincs, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                logger.error(f"traffic refresh of route {ginc} failed: {getattr(result, 'detail', result)}")
+        self._metrics['refreshed'] += len(gincs) - failed
+        self._metrics['failed'] += failed
+        self._metrics['batches'] += 1
+        self._metrics['batch_seconds_total'] += elapsed
+        self._metrics['batch_seconds_max'] = max(self._metrics['batch_seconds_max'], elapsed)
+        self._metrics['last_batch_seconds'] = elapsed
+        return len(gincs) - failed
@@ -0,0 +1,191 @@
+"""Travel-time matrix of a route"""
+import asyncio
+import math
+import os
+import time
+from array import array
+from typing import Dict, List, Set, Tuple
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from controller.db.eta_calculator_db import EtaDb
+from model.travel_data import TravelData
+from model.travel_matrix import TravelMatrix, point_key
+from utils.http_client import tomtom_client
+
+
+ETA_ENGINE = os.environ.get('ETA_ENGINE', 'tomtom')
+TRAVEL_MATRIX_BACKEND = os.environ.get('TRAVEL_MATRIX_BACKEND', 'tomtom')
+TRAVEL_MATRIX_MAX_CELLS = int(os.environ.get('TRAVEL_MATRIX_MAX_CELLS', 2500))
+TRAVEL_MATRIX_SPEED_KMH = float(os.environ.get('TRAVEL_MATRIX_SPEED_KMH', 30))
+TRAVEL_MATRIX_DETOUR_FACTOR = float(os.environ.get('TRAVEL_MATRIX_DETOUR_FACTOR', 1.3))
+
+EARTH_RADIUS_METERS = 6371000
+
+MATRIX_OPTIONS = {
+    "departAt": "now",
+    "routeType": "fastest",
+    "travelMode": "car",
+    "traffic": "live"
+}
+
+
+class TravelMatrixService():
+    """
+    The `TravelMatrixService` class builds the travel-time matrix of a route once, at upload, so that the following
+    recalculations can compute the ETAs of the remaining stops with array lookups instead of a routing request.
+
+    Key Responsibilities:
+    1. **Engine Selection**: With ETA_ENGINE=matrix the routes get a matrix and are recalculated with it after
+       a delivery; with ETA_ENGINE=tomtom (the default) nothing changes.
+    2. **Backends**: The matrix comes from TomTom Matrix Routing (TRAVEL_MATRIX_BACKEND=tomtom), split in requests
+       of at most `max_cells` cells, or from a local stand-in (haversine) based on the great-circle distance,
+       a detour factor and an average speed. The cells TomTom cannot route fall back to the stand-in.
+    3. **Off the Request Path**: `schedule` builds and stores the matrix in a background task after the upload.
+    4. **Counters**: Count built matrices, failures, TomTom requests, build time and the recalculations
+       made with a matrix.
+    """
+
+    def __init__(self,
+                 engine: str = ETA_ENGINE,
+                 backend: str = TRAVEL_MATRIX_BACKEND,
+                 max_cells: int = TRAVEL_MATRIX_MAX_CELLS,
+                 speed_kmh: float = TRAVEL_MATRIX_SPEED_KMH,
+                 detour_factor: float = TRAVEL_MATRIX_DETOUR_FACTOR) -> None:
+        self.enabled = engine == 'matrix'
+        self.backend = backend
+        self.max_cells = max(max_cells, 1)
+        self.speed_meters_per_second = speed_kmh / 3.6
+        self.detour_factor = detour_factor
+        self._metrics = {
+            'built': 0,
+            'failures': 0,
+            'tomtom_requests': 0,
+            'fallback_cells': 0,
+            'build_seconds_total': 0.0,
+            'local_recalculations': 0,
+            'missing_matrices': 0
+        }
+        self._tasks: Set[asyncio.Task] = set()
+
+    def schedule(self, db: AsyncIOMotorDatabase, travel_data: TravelData) -> None:
+        """
+        Builds and stores the matrix of a route in the background, if the matrix engine is enabled.
+        """
+        if not self.enabled:
+            return
+        task = asyncio.create_task(self.build_and_store(db, travel_data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def build_and_store(self, db: AsyncIOMotorDatabase, travel_data: TravelData) -> bool:
+        """
+        Builds the matrix of the waypoints of a route and stores it.
+
+        Returns:
+            bool: True if the matrix was stored.
+        """
+        try:
+            matrix = await self.build(route_points(travel_data))
+        except Exception as ex:
+            self._metrics['failures'] += 1
+            logger.error(f"travel matrix of route {travel_data.ginc} not built: {ex}")
+            return False
+        return await EtaDb.add_route_matrix(db, travel_data.ginc, self.backend, matrix)
+
+    async def build(self, points: List[Tuple[float, float]]) -> TravelMatrix:
+        """
+        Builds the matrix of `points` with the configured backend.
+        """
+        started = time.monotonic()
+        durations, lengths = self.haversine_matrix(points)
+        if self.backend == 'tomtom':
+            await self.tomtom_matrix(points, durations, lengths)
+        self._metrics['built'] += 1
+        self._metrics['build_seconds_total'] += time.monotonic() - started
+        return TravelMatrix(points, durations, lengths)
+
+    def haversine_matrix(self, points: List[Tuple[float, float]]) -> Tuple[array, array]:
+        """
+        Returns the travel times and lengths estimated from the great-circle distances between `points`.
+        """
+        radians = [(math.radians(latitude), math.radians(longitude)) for latitude, longitude in points]
+        cosines = [math.cos(latitude) for latitude, _ in radians]
+        size = len(points)
+        durations, lengths = array('I', bytes(4 * size * size)), array('I', bytes(4 * size * size))
+        for origin, (origin_latitude, origin_longitude) in enumerate(radians):
+            for destination in range(origin + 1, size):
+                destination_latitude, destination_longitude = radians[destination]
+                term = (math.sin((destination_latitude - origin_latitude) / 2) ** 2
+                        + cosines[origin] * cosines[destination]
+                        * math.sin((destination_longitude - origin_longitude) / 2) ** 2)
+                length = 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(term, 1.0))) * self.detour_factor
+                duration = round(length / self.speed_meters_per_second)
+                lengths[origin * size + destination] = lengths[destination * size + origin] = round(length)
+                durations[origin * size + destination] = durations[destination * size + origin] = duration
+        return durations, lengths
+
+    async def tomtom_matrix(self, points: List[Tuple[float, float]], durations: array, lengths: array) -> None:
+        """
+        Fills `durations` and `lengths` with the route summaries of TomTom Matrix Routing, with groups of origins
+        sent concurrently against all the destinations. The cells without a route keep the haversine estimate.
+
+        Raises:
+            ValueError: If the TomTom API key is not set.
+            httpx.HTTPError: If there's an issue with the HTTP request.
+        """
+        api_key = os.getenv("TOMTOM_API_KEY")
+        if not api_key:
+            raise ValueError("TOMTOM_API_KEY environment variable is not set.")
+
+        size = len(points)
+        group_size = max(self.max_cells // size, 1)
+        destinations = [{"point": {"latitude": latitude, "longitude": longitude}} for latitude, longitude in points]
+
+        async def request(first: int) -> None:
+            origins = destinations[first:first + group_size]
+            response = await tomtom_client.request('POST', "/routing/matrix/2", params={"key": api_key},
+                                                   json={"origins": origins, "destinations": destinations,
+                                                         "options": MATRIX_OPTIONS})
+            self._metrics['tomtom_requests'] += 1
+            for cell in response.json().get("data", []):
+                summary = cell.get("routeSummary")
+                if summary is None:
+                    self._metrics['fallback_cells'] += 1
+                    continue
+                index = (first + cell["originIndex"]) * size + cell["destinationIndex"]
+                durations[index] = summary["travelTimeInSeconds"]
+                lengths[index] = summary["lengthInMeters"]
+
+        await asyncio.gather(*[request(first) for first in range(0, size, group_size)])
+
+    def record_recalculation(self, local: bool) -> None:
+        self._metrics['local_recalculations' if local else 'missing_matrices'] += 1
+
+    def stats(self) -> Dict:
+        """
+        Returns the counters of the service.
+        """
+        return {
+            'enabled': self.enabled,
+            'backend': self.backend,
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self._metrics.items()}
+        }
+
+
+def route_points(travel_data: TravelData) -> List[Tuple[float, float]]:
+    """
+    Returns the distinct waypoints of a route, in route order: the departure and the arrival of every stop, delivered
+    or not. The departures are usually the arrivals of the stops before, but not after a delivery out of order: the
+    first stop left then still departs from where the delivered one did.
+    """
+    points: Dict[Tuple, Tuple[float, float]] = {}
+    for stop in travel_data.delivered_stops + travel_data.stops:
+        points.setdefault(point_key(stop.departureLatitude, stop.departureLongitude),
+                          (stop.departureLatitude, stop.departureLongitude))
+        points.setdefault(point_key(stop.arrivalLatitude, stop.arrivalLongitude),
+                          (stop.arrivalLatitude, stop.arrivalLongitude))
+    return list(points.values())
+
+
+travel_matrices = TravelMatrixService()
@@ -0,0 +1,109 @@
+"""ZIP code delay table"""
+import asyncio
+import json
+import os
+import time
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+from loguru import logger
+
+
+ZIP_CODE_FILE = os.environ.get('ZIP_CODE_FILE',
+                               os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                            'zip_code.json'))
+ZIP_CODE_RELOAD_INTERVAL = float(os.environ.get('ZIP_CODE_RELOAD_INTERVAL', 30))
+DEFAULT_DELAY = int(os.environ.get('DEFAULT_DELAY', 100))
+
+
+class ZipDelayTable():
+    """
+    The `ZipDelayTable` class keeps in memory the delay (in seconds) of each ZIP code listed in zip_code.json,
+    so that computing the ETAs never reads the file.
+
+    Key Responsibilities:
+    1. **Preload**: The table is loaded once at startup into an immutable mapping.
+    2. **Hot Reload**: A background task reloads the file when its modification time changes; the admin endpoint
+       can force a reload. The new mapping replaces the old one in a single assignment, so readers always see
+       a complete table.
+    3. **Resilience**: If the file cannot be read or parsed, the previous table is kept.
+    """
+
+    def __init__(self, path: str = ZIP_CODE_FILE, default_delay: int = DEFAULT_DELAY) -> None:
+        self.path = path
+        self.default_delay = default_delay
+        self.reloads = 0
+        self._delays: Optional[Mapping[str, int]] = None
+        self._mtime: Optional[float] = None
+        self._loaded_at: Optional[float] = None
+
+    @property
+    def delays(self) -> Mapping[str, int]:
+        """
+        The current ZIP code delays. The table is loaded on first access if the lifespan did not load it.
+        """
+        if self._delays is None:
+            self.load()
+        return self._delays
+
+    def load(self) -> bool:
+        """
+        Reads the file and replaces the current table.
+
+        Returns:
+            bool: True if the table was replaced, False if the file could not be read or a delay is not a number.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path) as cap_file:
+                delays = {str(zip_code): int(delay) for zip_code, delay in json.load(cap_file).items()}
+        except (OSError, ValueError, TypeError, AttributeError) as ex:
+            logger.error(f'ZipDelayTable.load, error:{ex}')
+            if self._delays is None:
+                self._delays = MappingProxyType({})
+            return False
+
+        self._delays = MappingProxyType(delays)
+        self._mtime = mtime
+        self._loaded_at = time.time()
+        self.reloads += 1
+        logger.info(f"loaded {len(delays)} zip code delays from {self.path}")
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reloads the table if the modification time of the file changed since the last load.
+
+        Returns:
+            bool: True if the table was reloaded.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as ex:
+            logger.error(f'ZipDelayTable.reload_if_changed, error:{ex}')
+            return False
+        if mtime == self._mtime:
+            return False
+        return self.load()
+
+    async def watch(self, interval: float = ZIP_CODE_RELOAD_INTERVAL) -> None:
+        """
+        Checks the file every `interval` seconds, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.reload_if_changed)
+
+    def stats(self) -> Dict:
+        """
+        Returns the status of the table.
+        """
+        return {
+            'path': self.path,
+            'zip_codes': len(self._delays or {}),
+            'default_delay': self.default_delay,
+            'reloads': self.reloads,
+            'loaded_at': self._loaded_at
+        }
+
+
+zip_delays = ZipDelayTable()